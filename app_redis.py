@@ -1,133 +1,1719 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, g
+from flask import before_render_template, template_rendered
+import click
 import redis
 import hashlib
 import uuid
 import time
 import threading
+import queue
 import json
-from datetime import datetime, timedelta
+import math
+import atexit
+import os
+import socket
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
 
 app = Flask(__name__)
-app.secret_key = 'votre_cle_secrete'
+# Tous les workers (et events_server.py) doivent partager la même clé
+app.secret_key = os.environ.get('SECRET_KEY', 'votre_cle_secrete')
+# URL du flux SSE: /events (Flask) ou le serveur asyncio events_server.py
+app.config['EVENTS_URL'] = os.environ.get('EVENTS_URL', '/events')
+
+@app.context_processor
+def inject_events_url():
+    return {'events_url': app.config['EVENTS_URL']}
+
+# === Métriques (format texte Prometheus, exposées sur /metrics) ===
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+ROUNDTRIP_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+# Requêtes plus lentes journalisées (secondes, 0 pour désactiver)
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 0))
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+class Counter:
+    """Compteur Prometheus par jeu de labels"""
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.label_names, labels)} {value}")
+        return lines
+
+class Histogram:
+    """Histogramme cumulatif Prometheus par jeu de labels"""
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.values = {}   # labels -> [compte par seau..., compte total, somme]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            counts = self.values.setdefault(labels, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        names = self.label_names + ('le',)
+        with self._lock:
+            for labels, counts in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{format_labels(names, labels + (bound,))} {count}")
+                lines.append(f"{self.name}_bucket{format_labels(names, labels + ('+Inf',))} {counts[-2]}")
+                lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {counts[-2]}")
+                lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {counts[-1]:.6f}")
+        return lines
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', "Durée des requêtes HTTP",
+                            ('endpoint',))
+REQUESTS_TOTAL = Counter('http_requests_total', "Requêtes HTTP par statut",
+                         ('endpoint', 'status'))
+REQUEST_ROUNDTRIPS = Histogram('redis_roundtrips_per_request',
+                               "Allers-retours Redis par requête HTTP", ('endpoint',),
+                               ROUNDTRIP_BUCKETS)
+REQUEST_COMMANDS = Counter('redis_request_commands_total',
+                           "Commandes Redis envoyées pendant les requêtes HTTP", ('endpoint',))
+REDIS_COMMANDS = Counter('redis_commands_total', "Commandes Redis envoyées par le processus",
+                         ('command',))
+TEMPLATE_LATENCY = Histogram('template_render_seconds', "Durée du rendu des templates",
+                             ('template',))
+EVENTS_PUBLISHED = Counter('events_published_total', "Événements publiés par type", ('type',))
+PUBSUB_RECEIVED = Counter('pubsub_messages_received_total',
+                          "Messages pub/sub reçus par le broadcaster SSE")
+AUTO_ASSIGNMENTS_DEFERRED = Counter('auto_assignments_deferred_total',
+                                    "Attributions automatiques reportées (candidats déjà pris)")
+METRICS = (REQUEST_LATENCY, REQUESTS_TOTAL, REQUEST_ROUNDTRIPS, REQUEST_COMMANDS, REDIS_COMMANDS,
+           TEMPLATE_LATENCY, EVENTS_PUBLISHED, PUBSUB_RECEIVED, AUTO_ASSIGNMENTS_DEFERRED)
+
+# === Compteur d'appels Redis par requête ===
+# Chaque envoi sur une connexion (commande simple ou pipeline complet) est un
+# aller-retour. Le total est renvoyé dans l'en-tête X-Redis-Calls.
+REDIS_CALLS_WARNING = 20
+_redis_calls = threading.local()
+
+def count_redis_commands(names):
+    for name in names:
+        _redis_calls.commands = getattr(_redis_calls, 'commands', 0) + 1
+        REDIS_COMMANDS.inc((str(name).upper(),))
+
+class CountingConnection(redis.Connection):
+    """Connexion Redis qui compte les allers-retours et les commandes du thread courant"""
+    def send_packed_command(self, command, check_health=True):
+        _redis_calls.count = getattr(_redis_calls, 'count', 0) + 1
+        return super().send_packed_command(command, check_health)
+
+    def send_command(self, *args, **kwargs):
+        count_redis_commands(args[:1])
+        return super().send_command(*args, **kwargs)
+
+    def pack_commands(self, commands):
+        # Pipelines: toutes les commandes partent en un seul envoi
+        count_redis_commands(command[0] for command in commands)
+        return super().pack_commands(commands)
+
+# Un pool par processus: au-delà de REDIS_POOL_SIZE connexions, les threads
+# attendent (REDIS_POOL_TIMEOUT secondes) qu'une connexion se libère
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_POOL_SIZE = int(os.environ.get('REDIS_POOL_SIZE', 50))
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', 5))
+
+r = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
+    REDIS_URL, max_connections=REDIS_POOL_SIZE, timeout=REDIS_POOL_TIMEOUT,
+    connection_class=CountingConnection, decode_responses=True))
+
+def redis_calls_count():
+    """Nombre d'allers-retours Redis depuis le début de la requête courante"""
+    return getattr(_redis_calls, 'count', 0)
+
+def redis_commands_count():
+    """Nombre de commandes Redis depuis le début de la requête courante"""
+    return getattr(_redis_calls, 'commands', 0)
+
+@app.before_request
+def reset_redis_calls():
+    _redis_calls.count = 0
+    _redis_calls.commands = 0
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def report_redis_calls(response):
+    calls = redis_calls_count()
+    commands = redis_commands_count()
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'inconnu'
+    response.headers['X-Redis-Calls'] = str(calls)
+    REQUEST_LATENCY.observe((endpoint,), elapsed)
+    REQUESTS_TOTAL.inc((endpoint, str(response.status_code)))
+    REQUEST_ROUNDTRIPS.observe((endpoint,), calls)
+    REQUEST_COMMANDS.inc((endpoint,), commands)
+    if calls > REDIS_CALLS_WARNING:
+        print(f"⚠️ {request.method} {request.path}: {calls} appels Redis")
+    if SLOW_REQUEST_SECONDS and elapsed > SLOW_REQUEST_SECONDS:
+        print(f"🐢 {request.method} {request.path}: {elapsed * 1000:.0f} ms, "
+              f"{calls} allers-retours / {commands} commandes Redis")
+    return response
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    g.template_start = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def record_template_time(sender, template, context, **extra):
+    start = g.pop('template_start', None)
+    if start is not None:
+        TEMPLATE_LATENCY.observe((template.name,), time.perf_counter() - start)
+
+# === Import des données de test ===
+# Le fichier JSON est lu par morceaux: seuls les éléments du lot en cours sont
+# en mémoire. Chaque lot coûte une lecture et une écriture pipelinées, et
+# l'import est idempotent: un compte, un score ou un menu déjà présent n'est
+# pas écrasé, et un restaurant renommé est réindexé sous son nouveau nom.
+DATASET_FILE = 'donnees_fusionnees_avec_menus.json'
+IMPORT_BATCH_SIZE = 1000
+IMPORT_CHUNK_SIZE = 1 << 20   # caractères lus à la fois
+
+JSON_DELIMITERS = frozenset(' \t\r\n,:]}')
 
-r = redis.Redis(decode_responses=True)
+def iter_json_sections(path, chunk_size=IMPORT_CHUNK_SIZE):
+    """Parcourt un objet JSON {section: [éléments, ...]} sans le charger en entier.
+
+    Produit les paires (section, élément) dans l'ordre du fichier; les
+    sections qui ne sont pas des listes sont ignorées.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buf, pos = '', 0
+
+        def peek():
+            """Prochain caractère significatif ('' en fin de fichier)"""
+            nonlocal buf, pos
+            while True:
+                while pos < len(buf) and buf[pos] in ' \t\r\n':
+                    pos += 1
+                if pos < len(buf):
+                    return buf[pos]
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return ''
+                buf, pos = chunk, 0
+
+        def decode():
+            """Décode la valeur suivante, en lisant la suite du fichier si elle est coupée"""
+            nonlocal buf, pos
+            peek()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    value, end = None, None
+                # Un nombre coupé par la fin du morceau se décode quand même
+                # (12345 lu 12, 1.5 lu 1): n'accepter une valeur que suivie
+                # d'un séparateur, sinon lire la suite
+                if end is not None and end < len(buf) and buf[end] in JSON_DELIMITERS:
+                    pos = end
+                    return value
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    if end is None:
+                        decoder.raw_decode(buf, pos)   # lève l'erreur de syntaxe
+                    pos = end
+                    return value
+                buf, pos = buf[pos:] + chunk, 0
+
+        def expect(char):
+            nonlocal pos
+            if peek() != char:
+                raise ValueError(f"JSON invalide: '{char}' attendu à la position {pos}")
+            pos += 1
+
+        expect('{')
+        while peek() != '}':
+            section = decode()
+            expect(':')
+            if peek() != '[':
+                decode()
+            else:
+                expect('[')
+                while peek() != ']':
+                    yield section, decode()
+                    if peek() == ',':
+                        expect(',')
+                expect(']')
+            if peek() == ',':
+                expect(',')
+
+class DatasetImporter:
+    """Écrit les sections utilisateurs, livreurs et restaurants par lots pipelinés"""
+
+    SECTIONS = ('utilisateurs', 'livreurs', 'restaurants')
+
+    def __init__(self, batch_size=IMPORT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.batches = {section: [] for section in self.SECTIONS}
+        self.counts = {'lus': 0, 'comptes': 0, 'livreurs': 0, 'restaurants': 0, 'menus': 0,
+                       'ignorés': 0}
+        self.catalog_changed = False
+
+    def add(self, section, item):
+        batch = self.batches.get(section)
+        if batch is None:
+            return
+        self.counts['lus'] += 1
+        if not item.get('username'):
+            self.counts['ignorés'] += 1
+            return
+        batch.append(item)
+        if len(batch) >= self.batch_size:
+            self.flush(section)
+
+    def flush(self, section):
+        items, self.batches[section] = self.batches[section], []
+        if not items:
+            return
+        check_background_lease()
+        if section == 'restaurants':
+            self._write_restaurants(items)
+        else:
+            self._write_users(items, with_stats=section == 'livreurs')
+
+    def finish(self):
+        """Écrit les lots restants et invalide le catalogue s'il a changé"""
+        for section in self.SECTIONS:
+            self.flush(section)
+        if self.catalog_changed:
+            r.incr(RESTAURANTS_VERSION)
+            catalog_cache.invalidate()
+        return self.counts
+
+    def _write_users(self, items, with_stats):
+        pipe = r.pipeline(transaction=False)
+        for item in items:
+            username = item['username']
+            pipe.hsetnx("users", username, f"{item['password_hash']}:{item['role']}")
+            if with_stats:
+                avg_rating = item.get('livreur', {}).get('avg_rating', 4.5) # Note par défaut si non fournie
+                pipe.zadd("livreurs:scores", {username: avg_rating}, nx=True)
+                # Une livraison simulée pour justifier cette note
+                for field, value in (("total_rating", avg_rating), ("delivery_count", 1),
+                                     ("avg_rating", avg_rating)):
+                    pipe.hsetnx(f"livreur_stats:{username}", field, value)
+        results = pipe.execute()
+        step = 5 if with_stats else 1
+        self.counts['comptes'] += sum(results[::step])
+        if with_stats:
+            self.counts['livreurs'] += sum(results[1::step])
+
+    def _write_restaurants(self, items):
+        restaurants = []
+        for item in items:
+            if item.get('restaurant'):
+                restaurants.append(item)
+            else:
+                print(f"AVERTISSEMENT: Pas d'infos 'restaurant' pour {item['username']}")
+                self.counts['ignorés'] += 1
+        pipe = r.pipeline(transaction=False)
+        for item in restaurants:
+            pipe.hget(f"restaurant:info:{item['username']}", "name")
+            pipe.exists(f"menu:{item['username']}")
+        existing = pipe.execute()
+
+        pipe = r.pipeline(transaction=False)
+        accounts = []   # position des HSETNX de comptes dans le pipeline
+        indexed = []    # position des ZADD dans l'index par nom
+        for item, old_name, has_menu in zip(restaurants, existing[::2], existing[1::2]):
+            restaurant_id = item['username']
+            info = item['restaurant']
+            name = info.get("nom", restaurant_id)
+            accounts.append(len(pipe))
+            pipe.hsetnx("users", restaurant_id, f"{item['password_hash']}:{item['role']}")
+            pipe.hset(f"restaurant:info:{restaurant_id}", mapping={
+                "name": name,
+                "lon": str(info.get("longitude", 0.0)),
+                "lat": str(info.get("latitude", 0.0))
+            })
+            if old_name is not None and old_name != name:
+                # Restaurant renommé: retirer l'ancienne entrée de l'index
+                pipe.zrem(RESTAURANTS_INDEX, restaurant_member(restaurant_id, old_name))
+                self.catalog_changed = True
+            # Toujours indexer (idempotent): un restaurant déjà présent mais
+            # jamais indexé, par exemple chargé par un ancien import, l'est aussi
+            indexed.append(len(pipe))
+            pipe.zadd(RESTAURANTS_INDEX, {restaurant_member(restaurant_id, name): 0})
+            if not has_menu:
+                # Convertir la liste d'objets en dictionnaire {nom: prix}
+                menu_dict = {article['nom_article']: float(article['prix'])
+                             for article in info.get('menu', [])
+                             if 'nom_article' in article and 'prix' in article}
+                if menu_dict:
+                    pipe.hset(f"menu:{restaurant_id}", mapping=menu_dict)
+                    pipe.incr(f"menu:version:{restaurant_id}")
+                    self.counts['menus'] += 1
+        results = pipe.execute()
+        self.counts['comptes'] += sum(results[i] for i in accounts)
+        added = sum(results[i] for i in indexed)
+        self.counts['restaurants'] += added
+        if added:
+            self.catalog_changed = True
+
+def import_dataset(path, batch_size=IMPORT_BATCH_SIZE):
+    """Importe un fichier de données; retourne (compteurs, durée en secondes)"""
+    importer = DatasetImporter(batch_size)
+    start = time.perf_counter()
+    for section, item in iter_json_sections(path):
+        importer.add(section, item)
+    return importer.finish(), time.perf_counter() - start
+
+def import_summary(counts, elapsed, calls):
+    return (f"📦 {counts['lus']} entités lues en {elapsed:.1f}s "
+            f"({counts['lus'] / max(elapsed, 1e-9):.0f}/s, {calls} allers-retours Redis): "
+            f"{counts['comptes']} comptes, {counts['livreurs']} livreurs, "
+            f"{counts['restaurants']} restaurants indexés, {counts['menus']} menus créés, "
+            f"{counts['ignorés']} ignorés")
 
 def init_test_users():
+    """Charge les données de test depuis DATASET_FILE (sans écraser l'existant)"""
+    reset_redis_calls()
+    try:
+        counts, elapsed = import_dataset(DATASET_FILE)
+    except FileNotFoundError:
+        print(f"ERREUR: Le fichier '{DATASET_FILE}' est introuvable.")
+        return False
+    except ValueError:
+        # json.JSONDecodeError est une sous-classe de ValueError
+        print(f"ERREUR: Le fichier '{DATASET_FILE}' contient un JSON invalide.")
+        return False
+    print(import_summary(counts, elapsed, redis_calls_count()))
+    print("Initialisation des données de test depuis le JSON terminée.")
+    return True
+
+SEED_MARKER = 'seed:dataset'
+
+def seed_test_data():
+    """Charge DATASET_FILE s'il n'a pas déjà été importé dans cette version"""
     try:
-        # Ouvrir et lire le fichier JSON
-        with open('donnees_fusionnees_avec_menus.json', 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        stat = os.stat(DATASET_FILE)
     except FileNotFoundError:
-        print("ERREUR: Le fichier 'donnees_denormalisees.json' est introuvable.")
+        print(f"ERREUR: Le fichier '{DATASET_FILE}' est introuvable.")
         return
-    except json.JSONDecodeError:
-        print("ERREUR: Le fichier 'donnees_denormalisees.json' contient un JSON invalide.")
+    signature = f"{stat.st_size}:{int(stat.st_mtime)}"
+    if r.get(SEED_MARKER) == signature:
         return
+    if init_test_users():
+        r.set(SEED_MARKER, signature)
 
-    
-    # === Initialiser les utilisateurs (clients, managers) ===
-    for user in data.get('utilisateurs', []):
-        username = user.get('username')
-        if not username:
-            continue
-        
-        if not r.hexists("users", username):
-            r.hset("users", username, f"{user['password_hash']}:{user['role']}")
-            print(f"Utilisateur créé: {username} (rôle: {user['role']})")
+# === Catalogue des restaurants ===
+# restaurants:by_name est un sorted set (scores à 0, donc trié par ordre
+# lexicographique) dont les membres sont "<nom>:<id>". restaurants:version est
+# incrémenté à chaque modification et invalide les caches des workers.
+RESTAURANTS_INDEX = 'restaurants:by_name'
+RESTAURANTS_VERSION = 'restaurants:version'
+CATALOG_CACHE_TTL = 30
 
-    # === Initialiser les livreurs ===
-    for livreur_data in data.get('livreurs', []):
-        username = livreur_data.get('username')
-        if not username:
-            continue
-        
-        # 1. Créer l'utilisateur
-        if not r.hexists("users", username):
-            r.hset("users", username, f"{livreur_data['password_hash']}:{livreur_data['role']}")
-            print(f"Utilisateur (livreur) créé: {username}")
+class LRUCache:
+    """Petit cache LRU en mémoire, partagé entre les threads du worker"""
 
-        # 2. Initialiser les scores et statistiques
-        if not r.exists(f"livreur_stats:{username}"):
-            stats = livreur_data.get('livreur', {})
-            avg_rating = stats.get('avg_rating', 4.5) # Note par défaut si non fournie
-            
-            r.zadd("livreurs:scores", {username: avg_rating})
-            
-            # Initialiser aussi les stats complètes
-            r.hset(f"livreur_stats:{username}", mapping={
-                "total_rating": avg_rating,
-                "delivery_count": 1, # Simuler une livraison pour justifier cette note
-                "avg_rating": avg_rating
-            })
-            print(f"Stats livreur initialisées pour {username} (Score: {avg_rating})")
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
 
-    # === Initialiser les restaurants et leurs menus ===
-    for restaurant_data in data.get('restaurants', []):
-        username = restaurant_data.get('username') # username est l'ID (ex: "restaurant1")
-        if not username:
-            continue
-            
-        # 1. Créer l'utilisateur
-        if not r.hexists("users", username):
-            r.hset("users", username, f"{restaurant_data['password_hash']}:{restaurant_data['role']}")
-            print(f"Utilisateur (restaurant) créé: {username}")
-
-        info = restaurant_data.get('restaurant', {})
-        if not info:
-            print(f"AVERTISSEMENT: Pas d'infos 'restaurant' pour {username}")
-            continue
-            
-        # 2. Stocker les infos (nom, localisation)
-        r.hset(f"restaurant:info:{username}", mapping={
-            "name": info.get("nom", username),
-            "lon": str(info.get("longitude", 0.0)), # Assurer que c'est une chaîne
-            "lat": str(info.get("latitude", 0.0))  # Assurer que c'est une chaîne
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class VersionedCache:
+    """Cache LRU vidé quand un compteur de version Redis change.
+
+    La version n'est relue qu'une fois toutes les `ttl` secondes: une
+    modification faite par un autre worker est donc visible au plus tard
+    après `ttl` secondes, celles du worker courant immédiatement.
+    """
+
+    def __init__(self, version_key, ttl, max_entries=256):
+        self.version_key = version_key
+        self.ttl = ttl
+        self.entries = LRUCache(max_entries)
+        self.version = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.checked_at >= self.ttl:
+                version = r.get(self.version_key)
+                if version != self.version:
+                    self.entries.clear()
+                    self.version = version
+                self.checked_at = now
+
+        value = self.entries.get(key)
+        if value is None:
+            value = loader()
+            self.entries.put(key, value)
+        return value
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.checked_at = 0.0
+
+catalog_cache = VersionedCache(RESTAURANTS_VERSION, CATALOG_CACHE_TTL)
+
+def restaurant_member(restaurant_id, name):
+    return f"{name}:{restaurant_id}"
+
+def parse_restaurant_member(member):
+    name, restaurant_id = member.rsplit(':', 1)
+    return {"id": restaurant_id, "name": name}
+
+def save_restaurant_info(restaurant_id, name, lon, lat):
+    """Enregistre les infos d'un restaurant et met à jour l'index par nom"""
+    old_name = r.hget(f"restaurant:info:{restaurant_id}", "name")
+    pipe = r.pipeline()
+    if old_name is not None and old_name != name:
+        pipe.zrem(RESTAURANTS_INDEX, restaurant_member(restaurant_id, old_name))
+    pipe.hset(f"restaurant:info:{restaurant_id}", mapping={
+        "name": name,
+        "lon": str(lon), # Assurer que c'est une chaîne
+        "lat": str(lat)  # Assurer que c'est une chaîne
+    })
+    pipe.zadd(RESTAURANTS_INDEX, {restaurant_member(restaurant_id, name): 0})
+    if old_name != name:
+        pipe.incr(RESTAURANTS_VERSION)
+    pipe.execute()
+    if old_name != name:
+        catalog_cache.invalidate()
+
+def rebuild_restaurant_index():
+    """Reconstruit restaurants:by_name à partir des utilisateurs restaurants"""
+    restaurant_ids = [username for username, data in r.hscan_iter("users")
+                      if data.endswith(":restaurant")]
+    pipe = r.pipeline(transaction=False)
+    for restaurant_id in restaurant_ids:
+        pipe.hget(f"restaurant:info:{restaurant_id}", "name")
+    names = pipe.execute()
+
+    pipe = r.pipeline()
+    pipe.delete(RESTAURANTS_INDEX)
+    if restaurant_ids:
+        pipe.zadd(RESTAURANTS_INDEX, {
+            restaurant_member(restaurant_id, name or restaurant_id): 0
+            for restaurant_id, name in zip(restaurant_ids, names)
         })
+    pipe.incr(RESTAURANTS_VERSION)
+    pipe.execute()
+    catalog_cache.invalidate()
+    return len(restaurant_ids)
 
-        # 3. Stocker le menu
-        if not r.exists(f"menu:{username}"):
-            menu_list = info.get('menu', [])
-            # Convertir la liste d'objets en dictionnaire {nom: prix}
-            menu_dict = {item['nom_article']: float(item['prix']) for item in menu_list if 'nom_article' in item and 'prix' in item}
-            
-            if menu_dict:
-                r.hset(f"menu:{username}", mapping=menu_dict)
-                print(f"Menu créé pour {username} ({info.get('nom', '')})")
+def get_restaurant_catalog():
+    """Liste complète des restaurants triée par nom (mise en cache)"""
+    return catalog_cache.get('all', lambda: [
+        parse_restaurant_member(member) for member in r.zrange(RESTAURANTS_INDEX, 0, -1)
+    ])
+
+# === Menus ===
+# menu:version:<id> est incrémenté à chaque écriture du menu. Le JSON sérialisé
+# est mis en cache par (restaurant, version) et sert aussi d'ETag.
+menu_cache = LRUCache(max_entries=512)
+
+def save_menu(restaurant_id, menu_dict):
+    """Remplace le menu d'un restaurant et invalide les caches"""
+    pipe = r.pipeline()
+    pipe.delete(f"menu:{restaurant_id}")
+    pipe.hset(f"menu:{restaurant_id}", mapping=menu_dict)
+    pipe.incr(f"menu:version:{restaurant_id}")
+    pipe.execute()
+
+def get_menu_payload(restaurant_id, version):
+    """(corps JSON, ETag) du menu pour une version donnée, ou None si absent"""
+    cached = menu_cache.get((restaurant_id, version))
+    if cached is not None:
+        return cached
     
-    print("Initialisation des données de test depuis le JSON terminée.")
-    # =========================================================
+    menu_data = r.hgetall(f"menu:{restaurant_id}")
+    if not menu_data:
+        return None
+    # Convertir les prix en float
+    menu = {item: float(price) for item, price in menu_data.items()}
+    body = app.json.dumps({'status': 'success', 'menu': menu})
+    payload = (body, f"menu-{restaurant_id}-{version}")
+    menu_cache.put((restaurant_id, version), payload)
+    return payload
 
-def publish_event(event_type, data):
-    """Publie un événement sur le canal Redis"""
+def get_restaurant_page(page, per_page):
+    """Une page du catalogue: ZRANGE sur la tranche demandée + ZCARD"""
+    def load_page():
+        start = (page - 1) * per_page
+        pipe = r.pipeline(transaction=False)
+        pipe.zrange(RESTAURANTS_INDEX, start, start + per_page - 1)
+        pipe.zcard(RESTAURANTS_INDEX)
+        members, total = pipe.execute()
+        return [parse_restaurant_member(member) for member in members], total
+    return catalog_cache.get(('page', page, per_page), load_page)
+
+# === Canaux d'événements par audience ===
+# events:client:<id>, events:restaurant:<id>, events:driver:<id>,
+# events:drivers (tous les livreurs) et events:managers
+MANAGERS_CHANNEL = 'events:managers'
+DRIVERS_CHANNEL = 'events:drivers'
+
+def client_channel(username):
+    return f"events:client:{username}"
+
+def restaurant_channel(restaurant_id):
+    return f"events:restaurant:{restaurant_id}"
+
+def driver_channel(livreur_id):
+    return f"events:driver:{livreur_id}"
+
+def order_channels(order_data, drivers=()):
+    """Canaux concernés par une commande: son client, son restaurant, les managers"""
+    channels = [MANAGERS_CHANNEL]
+    if order_data.get('client'):
+        channels.append(client_channel(order_data['client']))
+    if order_data.get('restaurant'):
+        channels.append(restaurant_channel(order_data['restaurant']))
+    channels.extend(driver_channel(livreur_id) for livreur_id in drivers if livreur_id)
+    return channels
+
+def channels_for_session(role, username):
+    """Canaux écoutés par une connexion SSE selon le rôle de l'utilisateur"""
+    if role == 'client':
+        return [client_channel(username)]
+    if role == 'restaurant':
+        return [restaurant_channel(username)]
+    if role == 'livreur':
+        return [driver_channel(username), DRIVERS_CHANNEL]
+    if role == 'manager':
+        return [MANAGERS_CHANNEL]
+    return []
+
+# === Journal des événements ===
+# Chaque événement est ajouté au stream plafonné events:log (champs 'channels',
+# liste JSON de ses canaux, et 'message') puis publié sur ces canaux sous la
+# forme "<id du stream> <message JSON>". L'id devient le champ SSE 'id:': une
+# connexion qui revient avec son dernier id rejoue les événements manqués.
+EVENT_LOG = 'events:log'
+EVENT_LOG_MAXLEN = 10000          # ~ derniers événements conservés pour le rejeu
+EVENT_LOG_REPLAY_BATCH = 500      # entrées lues par XRANGE lors d'un rejeu
+
+LOG_AND_PUBLISH_LUA = """
+local function log_and_publish(log_key, channels, message)
+    local unique, seen = {}, {}
+    for _, channel in ipairs(channels) do
+        if not seen[channel] then
+            seen[channel] = true
+            table.insert(unique, channel)
+        end
+    end
+    local id = redis.call('XADD', log_key, 'MAXLEN', '~', %d, '*',
+                          'channels', cjson.encode(unique), 'message', message)
+    local payload = id .. ' ' .. message
+    for _, channel in ipairs(unique) do
+        redis.call('PUBLISH', channel, payload)
+    end
+    return id
+end
+""" % EVENT_LOG_MAXLEN
+
+PUBLISH_EVENT_SCRIPT = r.register_script(LOG_AND_PUBLISH_LUA + """
+-- KEYS: events:log
+return log_and_publish(KEYS[1], cjson.decode(ARGV[1]), ARGV[2])
+""")
+
+def publish_event(event_type, data, channels, pipe=None):
+    """Journalise un événement et le publie sur les canaux Redis de son audience.
+
+    Avec `pipe`, l'appel est ajouté au pipeline fourni sans l'exécuter.
+    """
+    channels = list(dict.fromkeys(channels))
+    if not channels:
+        return
     event_data = {
         'type': event_type,
         'data': data,
         'timestamp': datetime.now().isoformat()
     }
-    r.publish('system_events', json.dumps(event_data))
+    message = json.dumps(event_data)
+    EVENTS_PUBLISHED.inc((event_type,))
+    PUBLISH_EVENT_SCRIPT(keys=[EVENT_LOG], args=[json.dumps(channels), message],
+                         client=pipe if pipe is not None else r)
+
+def parse_event_id(event_id):
+    """Id de stream "<ms>-<seq>" en tuple comparable; ValueError s'il est invalide"""
+    ms, seq = event_id.split('-')
+    return int(ms), int(seq)
+
+def sse_frame(payload):
+    """Trame SSE d'un message publié ("<id> <JSON>", ou JSON seul sans id)"""
+    if payload.startswith('{'):
+        return "data: {}\n\n".format(payload)
+    event_id, _, message = payload.partition(' ')
+    return "id: {}\ndata: {}\n\n".format(event_id, message)
+
+def select_log_entries(entries, channels):
+    """Entrées XRANGE du journal destinées à l'un des canaux, en paires (id, message)"""
+    wanted = set(channels)
+    return [(event_id, fields['message']) for event_id, fields in entries
+            if wanted.intersection(json.loads(fields['channels']))]
+
+def replay_events(channels, last_event_id):
+    """Événements manqués depuis last_event_id sur ces canaux.
+
+    Retourne (événements, complet). `complet` est faux si l'id est invalide ou
+    déjà sorti du journal plafonné: le client doit alors se resynchroniser.
+    """
+    try:
+        parse_event_id(last_event_id)
+    except ValueError:
+        return [], False
+    pipe = r.pipeline(transaction=False)
+    pipe.xrange(EVENT_LOG, last_event_id, last_event_id)
+    pipe.xrange(EVENT_LOG, '(' + last_event_id, '+', count=EVENT_LOG_REPLAY_BATCH)
+    known, entries = pipe.execute()
+    if not known:
+        return [], False
+    events = []
+    while True:
+        events.extend(select_log_entries(entries, channels))
+        if len(entries) < EVENT_LOG_REPLAY_BATCH:
+            return events, True
+        entries = r.xrange(EVENT_LOG, '(' + entries[-1][0], '+', count=EVENT_LOG_REPLAY_BATCH)
+
+# === Diffusion des événements temps réel ===
+SSE_QUEUE_SIZE = 100          # messages en attente max par connexion SSE
+SSE_HEARTBEAT_SECONDS = 15    # commentaire envoyé aux connexions inactives
+RESYNC_MESSAGE = json.dumps({'type': 'resync'})
+
+class EventBroadcaster:
+    """Un seul abonnement pub/sub par processus, redistribué aux connexions SSE.
+
+    Chaque connexion dispose d'une file bornée. Si un client lent la laisse se
+    remplir, la file est vidée et remplacée par un unique message 'resync' qui
+    demande au navigateur de se resynchroniser.
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.subscribers = {}
+        self.by_channel = {}
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, channels):
+        """Enregistre une connexion sur ses canaux et retourne sa file de messages"""
+        subscriber = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+        with self._lock:
+            self.subscribers[subscriber] = set(channels)
+            for channel in channels:
+                self.by_channel.setdefault(channel, set()).add(subscriber)
+            if not self._thread or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='event-broadcaster',
+                                                daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            for channel in self.subscribers.pop(subscriber, ()):
+                listeners = self.by_channel.get(channel)
+                if listeners is not None:
+                    listeners.discard(subscriber)
+                    if not listeners:
+                        del self.by_channel[channel]
+
+    def connection_count(self):
+        return len(self.subscribers)
+
+    def dispatch(self, channel, data):
+        """Distribue un message aux connexions abonnées au canal"""
+        PUBSUB_RECEIVED.inc()
+        with self._lock:
+            targets = list(self.by_channel.get(channel, ()))
+        for subscriber in targets:
+            try:
+                subscriber.put_nowait(data)
+            except queue.Full:
+                self._coalesce(subscriber)
+
+    def _coalesce(self, subscriber):
+        self.dropped += 1
+        while True:
+            try:
+                subscriber.get_nowait()
+            except queue.Empty:
+                break
+        subscriber.put_nowait(RESYNC_MESSAGE)
+
+    def _run(self):
+        while True:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.psubscribe(self.pattern)
+                for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        self.dispatch(message['channel'], message['data'])
+            except redis.RedisError as e:
+                print(f"Erreur abonnement événements: {e}")
+                time.sleep(1)
+            finally:
+                pubsub.close()
+
+broadcaster = EventBroadcaster('events:*')
+
+# === Planificateur de timers ===
+# Les échéances sont stockées dans le sorted set timers:due (membre "<type>:<order_id>",
+# score = échéance en secondes epoch). Un timer réclamé passe dans timers:inflight le
+# temps de son exécution: un seul processus le déclenche, et il est rejoué si ce
+# processus s'arrête avant de l'avoir acquitté.
+TIMER_POLL_INTERVAL = 0.5   # secondes entre deux scrutations
+TIMER_BATCH_SIZE = 100      # timers réclamés par scrutation
+TIMER_LEASE_SECONDS = 30    # délai avant qu'un timer non acquitté soit rejoué
+
+TIMER_HANDLERS = {}
+BATCH_TIMER_TYPES = set()
+
+CLAIM_TIMERS_SCRIPT = r.register_script("""
+-- Réintégrer les timers dont le bail a expiré (processus arrêté en cours d'exécution)
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, member in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], member)
+    redis.call('ZADD', KEYS[1], ARGV[1], member)
+end
+-- Réclamer les timers échus
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, member in ipairs(due) do
+    redis.call('ZREM', KEYS[1], member)
+    redis.call('ZADD', KEYS[2], ARGV[3], member)
+end
+return due
+""")
+
+def timer_handler(timer_type, batch=False):
+    """Enregistre la fonction appelée à l'échéance d'un type de timer.
+
+    Avec batch=True, la fonction reçoit en une fois la liste des commandes dont
+    le timer a été réclamé dans le même tick du planificateur.
+    """
+    def decorator(func):
+        TIMER_HANDLERS[timer_type] = func
+        if batch:
+            BATCH_TIMER_TYPES.add(timer_type)
+        return func
+    return decorator
+
+def schedule_timer(timer_type, order_id, delay_seconds):
+    """Programme un timer persistant dans Redis"""
+    r.zadd("timers:due", {timer_member(timer_type, order_id): time.time() + delay_seconds})
+
+def deadline_ms(delay_seconds):
+    """Échéance en millisecondes epoch (stockée dans order_timer:<id> et envoyée aux pages)"""
+    return int((time.time() + delay_seconds) * 1000)
+
+def now_ms():
+    """Heure du serveur en millisecondes epoch, pour corriger l'horloge des navigateurs"""
+    return int(time.time() * 1000)
+
+def timer_member(timer_type, order_id):
+    """Membre de timers:due identifiant un timer"""
+    return f"{timer_type}:{order_id}"
+
+def order_timer_members(order_id):
+    """Tous les timers possibles d'une commande (pour les annuler)"""
+    return [timer_member(timer_type, order_id) for timer_type in TIMER_HANDLERS]
+
+def run_due_timers(now=None):
+    """Déclenche les timers échus et retourne le nombre de timers réclamés"""
+    now = now or time.time()
+    members = CLAIM_TIMERS_SCRIPT(keys=["timers:due", "timers:inflight"],
+                                  args=[now, TIMER_BATCH_SIZE, now + TIMER_LEASE_SECONDS],
+                                  client=r)
+    by_type = {}
+    for member in members:
+        timer_type, order_id = member.split(':', 1)
+        by_type.setdefault(timer_type, []).append(order_id)
+    
+    acked = []
+    try:
+        for timer_type, order_ids in by_type.items():
+            handler = TIMER_HANDLERS.get(timer_type)
+            is_batch = timer_type in BATCH_TIMER_TYPES
+            for batch in ([order_ids] if is_batch else [[order_id] for order_id in order_ids]):
+                label = timer_member(timer_type, ','.join(batch))
+                # Bail perdu: les timers restants seront rejoués par son nouveau détenteur
+                check_background_lease()
+                try:
+                    if handler:
+                        handler(batch if is_batch else batch[0])
+                except LeaseLost:
+                    raise
+                except redis.RedisError as e:
+                    # Laisser le timer dans timers:inflight: il sera rejoué après le bail
+                    print(f"Erreur Redis timer {label}: {e}")
+                    continue
+                except Exception as e:
+                    print(f"Erreur timer {label}: {e}")
+                acked.extend(timer_member(timer_type, order_id) for order_id in batch)
+    finally:
+        if acked:
+            r.zrem("timers:inflight", *acked)
+    return len(members)
+
+# === Tâches de fond (un seul processus à la fois) ===
+# Chaque worker démarre la boucle de fond, mais seul le détenteur du bail Redis
+# BACKGROUND_LEASE l'exécute: chargement des données de test, planificateur de
+# timers (dont l'archivage). Sans renouvellement pendant BACKGROUND_LEASE_SECONDS
+# (processus arrêté ou bloqué), un autre worker prend le relais. Le tampon des
+# positions et l'abonnement pub/sub restent par processus: ils portent les
+# données et les connexions SSE du worker.
+BACKGROUND_LEASE = 'lease:background'
+BACKGROUND_LEASE_SECONDS = 15
+SEED_ON_START = os.environ.get('SEED_ON_START', '1') == '1'
+
+RENEW_LEASE_SCRIPT = r.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+RELEASE_LEASE_SCRIPT = r.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+class LeaseLost(Exception):
+    """Le bail des tâches de fond a été perdu: le travail en cours doit s'arrêter"""
+
+class RedisLease:
+    """Bail exclusif dans Redis (SET NX PX), renouvelé par un thread dédié.
+
+    keep() acquiert ou renouvelle le bail au tiers de sa durée, indépendamment
+    du travail en cours (import, archivage), qui ne peut donc pas le laisser
+    expirer, tant que le thread qui travaille sous le bail est vivant: s'il
+    meurt, le bail est libéré pour qu'un autre processus prenne le relais.
+    held n'est vrai que si le dernier renouvellement réussi date de moins
+    d'une durée de bail.
+    """
+
+    def __init__(self, key, ttl_seconds):
+        self.key = key
+        self.ttl_ms = int(ttl_seconds * 1000)
+        self.token = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._held = False
+        self._renewed_at = 0.0
+
+    @property
+    def held(self):
+        return self._held and (time.monotonic() - self._renewed_at) * 1000 < self.ttl_ms
+
+    def refresh(self):
+        """Renouvelle le bail s'il est détenu, sinon tente de l'acquérir"""
+        now = time.monotonic()
+        if self._held:
+            self._held = bool(RENEW_LEASE_SCRIPT(keys=[self.key], args=[self.token, self.ttl_ms],
+                                                 client=r))
+        if not self._held:
+            self._held = bool(r.set(self.key, self.token, nx=True, px=self.ttl_ms))
+        if self._held:
+            self._renewed_at = now
+        return self._held
+
+    def keep(self, stop_event, owner):
+        """Boucle du thread de renouvellement, tant que le thread `owner` est vivant"""
+        while not stop_event.is_set() and owner.is_alive():
+            try:
+                self.refresh()
+            except redis.RedisError as e:
+                # held redevient faux de lui-même si Redis reste injoignable
+                print(f"Erreur bail {self.key}: {e}")
+            stop_event.wait(self.ttl_ms / 3000)
+        if not owner.is_alive():
+            print(f"⚠️ Thread {owner.name} arrêté: bail {self.key} libéré")
+            self.release()
+
+    def release(self):
+        if not self._held:
+            return
+        self._held = False
+        try:
+            RELEASE_LEASE_SCRIPT(keys=[self.key], args=[self.token], client=r)
+        except redis.RedisError:
+            pass  # le bail expirera de lui-même
+
+_background_lease = None
+
+def check_background_lease():
+    """Lève LeaseLost si la boucle de fond de ce processus a perdu son bail.
+
+    Appelée entre deux lots par les traitements longs (import, archivage,
+    timers); sans effet hors de la boucle de fond (commandes flask).
+    """
+    lease = _background_lease
+    if (lease is not None and threading.current_thread() is _background_thread and
+            not lease.held):
+        raise LeaseLost(lease.key)
+
+def on_lease_acquired():
+    """Reprise des tâches de fond par ce processus"""
+    # Avant le chargement des données de test, qui peut échouer sur un jeu invalide
+    schedule_order_archival()
+    if SEED_ON_START:
+        with app.app_context():
+            seed_test_data()
+
+def background_loop(stop_event, lease):
+    """Boucle de fond: ne travaille que lorsque ce processus détient le bail"""
+    keeper = threading.Thread(target=lease.keep, args=(stop_event, threading.current_thread()),
+                              name='background-lease', daemon=True)
+    keeper.start()
+    was_held = False
+    while not stop_event.is_set():
+        claimed = 0
+        try:
+            if not lease.held:
+                if was_held:
+                    print(f"⚠️ Bail {lease.key} perdu par {lease.token}")
+                was_held = False
+            else:
+                if not was_held:
+                    print(f"👑 Tâches de fond reprises par {lease.token}")
+                    on_lease_acquired()
+                    was_held = True
+                claimed = run_due_timers()
+        except LeaseLost:
+            print(f"⚠️ Bail {lease.key} perdu par {lease.token}: travail interrompu")
+            was_held = False
+        except redis.RedisError as e:
+            print(f"Erreur planificateur: {e}")
+        except Exception as e:
+            # Ne jamais laisser mourir le thread: le bail resterait détenu sans
+            # travail. Une reprise en échec (jeu de données invalide) n'est pas
+            # retentée à chaque scrutation: les timers tournent quand même
+            print(f"❌ Erreur tâches de fond: {e!r}")
+            was_held = lease.held
+        # Enchaîner immédiatement si le lot était plein
+        if claimed < TIMER_BATCH_SIZE:
+            stop_event.wait(TIMER_POLL_INTERVAL)
+    # Libérer le bail seulement une fois le travail en cours terminé
+    keeper.join()
+    lease.release()
+
+_background_stop = threading.Event()
+_background_thread = None
+
+def start_background_duties():
+    """Démarre la boucle de fond du processus (à appeler dans chaque worker, après le fork)"""
+    global _background_thread, _background_lease
+    if _background_thread and _background_thread.is_alive():
+        return
+    _background_stop.clear()
+    _background_lease = RedisLease(BACKGROUND_LEASE, BACKGROUND_LEASE_SECONDS)
+    _background_thread = threading.Thread(target=background_loop,
+                                          args=(_background_stop, _background_lease),
+                                          name='background-duties', daemon=True)
+    _background_thread.start()
+
+def stop_background_duties(timeout=5):
+    """Arrête la boucle de fond et libère le bail pour un autre worker"""
+    _background_stop.set()
+    if _background_thread:
+        _background_thread.join(timeout)
+
+atexit.register(stop_background_duties)
 
 def get_livreur_score(livreur_id):
     score = r.zscore("livreurs:scores", livreur_id)
     return float(score) if score else 0.0
 
-def get_all_orders_with_details():
-    orders = []
-    for key in r.keys("order:*"):
+def get_livreur_scores(livreur_ids):
+    """Scores de plusieurs livreurs en un seul appel (ZMSCORE)"""
+    livreur_ids = list(dict.fromkeys(livreur_ids))
+    if not livreur_ids:
+        return {}
+    scores = r.zmscore("livreurs:scores", livreur_ids)
+    return {livreur_id: float(score) if score else 0.0
+            for livreur_id, score in zip(livreur_ids, scores)}
+
+# === Index secondaires des commandes ===
+# Chaque commande est référencée dans des sorted sets triés par date de création:
+#   orders:all, orders:by_client:<client>, orders:by_restaurant:<restaurant>,
+#   orders:by_driver:<livreur>, orders:by_status:<statut>
+ORDER_STATUSES = ('pending', 'ready', 'assigned', 'delivered', 'cancelled')
+
+def order_score(order_data):
+    """Score d'index d'une commande (timestamp de création)"""
+    try:
+        return datetime.fromisoformat(order_data.get('created_at', '')).timestamp()
+    except ValueError:
+        return 0.0
+
+def index_order(order_data, pipe=None):
+    """Met à jour les index secondaires d'une commande"""
+    p = pipe if pipe is not None else r.pipeline(transaction=False)
+    order_id = order_data['id']
+    score = order_score(order_data)
+    status = order_data.get('status')
+
+    p.zadd("orders:all", {order_id: score})
+    if order_data.get('client'):
+        p.zadd(f"orders:by_client:{order_data['client']}", {order_id: score})
+    if order_data.get('restaurant'):
+        p.zadd(f"orders:by_restaurant:{order_data['restaurant']}", {order_id: score})
+    if order_data.get('assigned_driver'):
+        p.zadd(f"orders:by_driver:{order_data['assigned_driver']}", {order_id: score})
+
+    # Une commande n'apparaît que dans l'index de son statut courant
+    for other_status in ORDER_STATUSES:
+        if other_status != status:
+            p.zrem(f"orders:by_status:{other_status}", order_id)
+    if status:
+        p.zadd(f"orders:by_status:{status}", {order_id: score})
+
+    if pipe is None:
+        p.execute()
+
+# === Archivage des commandes terminées ===
+# Les commandes livrées ou annulées depuis plus de ARCHIVE_AFTER_SECONDS quittent
+# leur hash order:<id> (et orders:all, orders:by_status:*) pour une ligne JSON
+# compacte (valeurs de ARCHIVE_FIELDS, sans les noms de champs) dans un hash
+# par jour de création:
+#   orders:archive:<AAAA-MM-JJ>   identifiant -> ligne compacte
+#   orders:archived               identifiant -> date de création (localise le jour)
+# Les index par client, restaurant et livreur sont conservés pour l'historique.
+ARCHIVE_AFTER_SECONDS = int(os.environ.get('ARCHIVE_AFTER_SECONDS', 7 * 24 * 3600))
+ARCHIVE_INTERVAL_SECONDS = 3600   # période de la tâche d'archivage
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVED_ORDERS = 'orders:archived'
+TERMINAL_STATUSES = ('delivered', 'cancelled')
+ARCHIVE_FIELDS = ('client', 'restaurant', 'restaurant_name', 'restaurant_lon', 'restaurant_lat',
+                  'articles', 'total_price', 'status', 'created_at', 'assigned_driver',
+                  'client_rating', 'rated_at', 'status_at')
+
+def archive_key(score):
+    """Hash d'archive du jour de création d'une commande"""
+    return f"orders:archive:{datetime.fromtimestamp(score):%Y-%m-%d}"
+
+def pack_order(order_data):
+    """Ligne compacte: valeurs de ARCHIVE_FIELDS, puis les champs inconnus éventuels"""
+    row = [order_data.get(field) for field in ARCHIVE_FIELDS]
+    extra = {field: value for field, value in order_data.items()
+             if field != 'id' and field not in ARCHIVE_FIELDS}
+    if extra:
+        row.append(extra)
+    else:
+        while row and row[-1] is None:
+            row.pop()
+    return json.dumps(row, separators=(',', ':'), ensure_ascii=False)
+
+def unpack_order(order_id, packed):
+    """Inverse de pack_order: le même dict que HGETALL order:<id>"""
+    row = json.loads(packed)
+    order_data = {'id': order_id}
+    order_data.update((field, value) for field, value in zip(ARCHIVE_FIELDS, row)
+                      if value is not None)
+    if len(row) > len(ARCHIVE_FIELDS):
+        order_data.update(row[-1])
+    return order_data
+
+def load_archived_orders(order_ids):
+    """Commandes archivées par identifiant (ZMSCORE puis un HMGET par jour)"""
+    order_ids = list(order_ids)
+    if not order_ids:
+        return {}
+    by_day = {}
+    for order_id, score in zip(order_ids, r.zmscore(ARCHIVED_ORDERS, order_ids)):
+        if score is not None:
+            by_day.setdefault(archive_key(score), []).append(order_id)
+    if not by_day:
+        return {}
+    pipe = r.pipeline(transaction=False)
+    for day_key, day_ids in by_day.items():
+        pipe.hmget(day_key, day_ids)
+    return {order_id: unpack_order(order_id, packed)
+            for day_ids, rows in zip(by_day.values(), pipe.execute())
+            for order_id, packed in zip(day_ids, rows) if packed}
+
+def archive_batch(status, scored_ids):
+    """Archive un lot de commandes d'un statut terminal; retourne le nombre archivé.
+
+    Les hashes sont surveillés (WATCH): si une commande change entre la lecture
+    et l'écriture (note du client), le lot est relu.
+    """
+    order_keys = [f"order:{order_id}" for order_id, _ in scored_ids]
+    with r.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(*order_keys)
+                reads = r.pipeline(transaction=False)
+                for key in order_keys:
+                    reads.hgetall(key)
+                orders = reads.execute()
+
+                pipe.multi()
+                archived = 0
+                for (order_id, score), order_data in zip(scored_ids, orders):
+                    # Entrée d'index orpheline ou statut déjà modifié: seulement la retirer
+                    pipe.zrem(f"orders:by_status:{status}", order_id)
+                    if order_data.get('status') != status:
+                        continue
+                    pipe.hset(archive_key(score), order_id, pack_order(order_data))
+                    pipe.zadd(ARCHIVED_ORDERS, {order_id: score})
+                    pipe.zrem("orders:all", order_id)
+                    pipe.delete(f"order:{order_id}")
+                    archived += 1
+                pipe.execute()
+                return archived
+            except redis.WatchError:
+                continue
+
+def archive_orders(older_than=ARCHIVE_AFTER_SECONDS, batch_size=ARCHIVE_BATCH_SIZE):
+    """Archive les commandes terminées créées il y a plus de `older_than` secondes"""
+    cutoff = time.time() - older_than
+    archived = 0
+    for status in TERMINAL_STATUSES:
+        while True:
+            scored_ids = r.zrangebyscore(f"orders:by_status:{status}", '-inf', cutoff,
+                                         start=0, num=batch_size, withscores=True)
+            check_background_lease()
+            if scored_ids:
+                archived += archive_batch(status, scored_ids)
+            if len(scored_ids) < batch_size:
+                break
+    return archived
+
+@timer_handler('archive_orders')
+def run_order_archival(_):
+    """Tâche périodique d'archivage (reprogrammée à chaque exécution)"""
+    try:
+        archived = archive_orders()
+        if archived:
+            print(f"🗄️ {archived} commande(s) terminée(s) archivée(s)")
+    finally:
+        schedule_timer('archive_orders', 'all', ARCHIVE_INTERVAL_SECONDS)
+
+def schedule_order_archival():
+    """Programme la tâche d'archivage si aucun processus ne l'a déjà fait"""
+    r.zadd("timers:due", {timer_member('archive_orders', 'all'): time.time()}, nx=True)
+
+# === Statistiques d'exploitation ===
+# Mises à jour à chaque création et transition (dans le même aller-retour), elles
+# se lisent en temps constant quel que soit l'historique:
+#   stats:orders:by_status        statut -> nombre de commandes
+#   stats:restaurant_backlog      restaurant -> commandes en attente ou prêtes (sorted set)
+#   stats:minute:<minute epoch>   agrégats d'une minute (expirent après STATS_MINUTE_TTL)
+#   stats:day:<AAAA-MM-JJ>        agrégats d'une journée
+# Champs des agrégats: created, <statut> (transitions vers ce statut), dur:<statut>
+# et dur_n:<statut> (somme et nombre des durées passées dans le statut précédent).
+# Chaque commande garde dans status_at l'heure (epoch) de son dernier changement de statut.
+STATS_STATUS_COUNTS = 'stats:orders:by_status'
+STATS_BACKLOG = 'stats:restaurant_backlog'
+STATS_MINUTE_TTL = 2 * 3600
+STATS_DAY_TTL = 8 * 24 * 3600
+STATS_WINDOWS_MINUTES = (('5min', 5), ('1h', 60))
+STATS_STAGES = (('pending_to_ready', 'ready'), ('ready_to_assigned', 'assigned'),
+                ('assigned_to_delivered', 'delivered'))
+BACKLOG_STATUSES = ('pending', 'ready')
+
+def stats_minute_key(minute):
+    return f"stats:minute:{minute}"
+
+def stats_buckets(now):
+    """Agrégats touchés par un événement à l'instant `now` (epoch)"""
+    return {
+        'now': now,
+        'minute_key': stats_minute_key(int(now // 60)),
+        'day_key': f"stats:day:{datetime.fromtimestamp(now):%Y-%m-%d}",
+        'minute_ttl': STATS_MINUTE_TTL,
+        'day_ttl': STATS_DAY_TTL
+    }
+
+def record_order_created(order_data, pipe):
+    """Compte une nouvelle commande dans les statistiques"""
+    buckets = stats_buckets(float(order_data['status_at']))
+    pipe.hincrby(STATS_STATUS_COUNTS, order_data['status'], 1)
+    for key, ttl in ((buckets['minute_key'], STATS_MINUTE_TTL), (buckets['day_key'], STATS_DAY_TTL)):
+        pipe.hincrby(key, 'created', 1)
+        pipe.expire(key, ttl)
+    if order_data.get('restaurant'):
+        pipe.zincrby(STATS_BACKLOG, 1, order_data['restaurant'])
+
+def summarize_buckets(buckets, minutes):
+    """Totaux d'une fenêtre: commandes créées, débit, transitions et durées moyennes"""
+    totals = {}
+    for bucket in buckets:
+        for field, value in bucket.items():
+            totals[field] = totals.get(field, 0) + float(value)
+    created = int(totals.get('created', 0))
+    return {
+        'created': created,
+        'orders_per_minute': round(created / minutes, 2) if minutes else 0.0,
+        'transitions': {status: int(totals.get(status, 0)) for status in ORDER_STATUSES
+                        if status != 'pending'},
+        'avg_seconds': {stage: round(totals[f"dur:{status}"] / totals[f"dur_n:{status}"], 1)
+                        if totals.get(f"dur_n:{status}") else None
+                        for stage, status in STATS_STAGES}
+    }
+
+def get_manager_stats(backlog_limit=10):
+    """Vue d'ensemble en un aller-retour: statuts, fenêtres glissantes et backlog"""
+    now = time.time()
+    minute = int(now // 60)
+    longest = max(minutes for _, minutes in STATS_WINDOWS_MINUTES)
+    pipe = r.pipeline(transaction=False)
+    pipe.hgetall(STATS_STATUS_COUNTS)
+    for offset in range(longest):
+        pipe.hgetall(stats_minute_key(minute - offset))
+    pipe.hgetall(stats_buckets(now)['day_key'])
+    pipe.zrevrange(STATS_BACKLOG, 0, backlog_limit - 1, withscores=True)
+    results = pipe.execute()
+    status_counts, minute_buckets = results[0], results[1:longest + 1]
+    today, backlog = results[longest + 1], results[longest + 2]
+
+    midnight = datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+    windows = {label: summarize_buckets(minute_buckets[:minutes], minutes)
+               for label, minutes in STATS_WINDOWS_MINUTES}
+    windows['today'] = summarize_buckets([today], (now - midnight.timestamp()) / 60)
+    return {
+        'by_status': {status: int(status_counts.get(status, 0)) for status in ORDER_STATUSES},
+        'windows': windows,
+        'restaurant_backlog': [{'restaurant': restaurant, 'orders': int(count)}
+                               for restaurant, count in backlog],
+        'generated_at': now
+    }
+
+def rebuild_order_stats(batch_size=500):
+    """Recalcule les compteurs par statut et le backlog (les agrégats datés repartent de zéro)"""
+    counts = dict.fromkeys(ORDER_STATUSES, 0)
+    backlog = {}
+    for status in ORDER_STATUSES:
+        counts[status] = r.zcard(f"orders:by_status:{status}")
+        if status in BACKLOG_STATUSES:
+            order_ids = r.zrange(f"orders:by_status:{status}", 0, -1)
+            for i in range(0, len(order_ids), batch_size):
+                pipe = r.pipeline(transaction=False)
+                for order_id in order_ids[i:i + batch_size]:
+                    pipe.hget(f"order:{order_id}", "restaurant")
+                for restaurant in pipe.execute():
+                    if restaurant:
+                        backlog[restaurant] = backlog.get(restaurant, 0) + 1
+    # Les commandes archivées ont quitté orders:by_status:*
+    for day_key in r.scan_iter("orders:archive:*", count=batch_size):
+        for _, packed in r.hscan_iter(day_key, count=batch_size):
+            status = json.loads(packed)[ARCHIVE_FIELDS.index('status')]
+            counts[status] = counts.get(status, 0) + 1
+
+    pipe = r.pipeline()
+    pipe.delete(STATS_STATUS_COUNTS, STATS_BACKLOG)
+    pipe.hset(STATS_STATUS_COUNTS, mapping=counts)
+    if backlog:
+        pipe.zadd(STATS_BACKLOG, backlog)
+    pipe.execute()
+    return counts
+
+# === Machine à états des commandes ===
+# Chaque transition est appliquée par un seul script Lua (EVALSHA): vérification
+# du statut courant (et du propriétaire), mise à jour du hash et des index,
+# nettoyage des candidats/timers, journalisation et publication de l'événement.
+# Deux transitions concurrentes ne peuvent donc plus réussir toutes les deux.
+# Toutes les clés touchées sont déclarées dans KEYS (voir transition_keys); les
+# index par livreur (offres, intérêts), dont les noms dépendent du contenu des
+# ensembles, sont nettoyés juste après par transition_order.
+TRANSITION_SCRIPT = r.register_script(LOG_AND_PUBLISH_LUA + """
+-- KEYS: order:<id>, candidates:<id>, order_timer:<id>, timers:due, offers:<id>,
+--       orders:all, orders:open_offers, events:log, stats:orders:by_status,
+--       stats:restaurant_backlog, agrégat minute, agrégat jour,
+--       orders:by_status:<nouveau statut>,
+--       orders:by_status:<statut de départ> (un par statut de spec.from, dans l'ordre),
+--       orders:by_driver:<livreur> si la transition assigne un livreur
+-- ARGV[1]: description JSON de la transition (voir transition_order)
+local spec = cjson.decode(ARGV[1])
+local raw = redis.call('HGETALL', KEYS[1])
+if #raw == 0 then
+    return {'not_found'}
+end
+local order = {}
+for i = 1, #raw, 2 do
+    order[raw[i]] = raw[i + 1]
+end
+
+local previous = order['status'] or ''
+if spec.owner_field and order[spec.owner_field] ~= spec.owner then
+    return {'forbidden'}
+end
+local previous_index
+for i, status in ipairs(spec.from) do
+    if status == previous then
+        previous_index = KEYS[13 + i]
+    end
+end
+if not previous_index then
+    return {'invalid_status', previous}
+end
+
+-- Nouveau statut et champs associés
+local stats = spec.stats
+local since = tonumber(order['status_at'])
+local updates = {'status', spec.to, 'status_at', stats.now}
+order['status'] = spec.to
+order['status_at'] = stats.now
+for field, value in pairs(spec.fields) do
+    table.insert(updates, field)
+    table.insert(updates, value)
+    order[field] = value
+end
+redis.call('HSET', KEYS[1], unpack(updates))
+
+-- Index secondaires (le score est la date de création déjà indexée)
+local score = redis.call('ZSCORE', KEYS[6], spec.order_id)
+if score then
+    redis.call('ZREM', previous_index, spec.order_id)
+    redis.call('ZADD', KEYS[13], score, spec.order_id)
+    if spec.driver_index then
+        redis.call('ZADD', KEYS[14 + #spec.from], score, spec.order_id)
+    end
+end
+
+-- Statistiques: compteurs par statut, agrégats par minute et par jour, backlog
+redis.call('HINCRBY', KEYS[9], previous, -1)
+redis.call('HINCRBY', KEYS[9], spec.to, 1)
+for _, bucket in ipairs({{KEYS[11], stats.minute_ttl}, {KEYS[12], stats.day_ttl}}) do
+    redis.call('HINCRBY', bucket[1], spec.to, 1)
+    if since then
+        redis.call('HINCRBYFLOAT', bucket[1], 'dur:' .. spec.to, stats.now - since)
+        redis.call('HINCRBY', bucket[1], 'dur_n:' .. spec.to, 1)
+    end
+    redis.call('EXPIRE', bucket[1], bucket[2])
+end
+local was_backlog = previous == 'pending' or previous == 'ready'
+local is_backlog = spec.to == 'pending' or spec.to == 'ready'
+if order['restaurant'] and was_backlog ~= is_backlog then
+    redis.call('ZINCRBY', KEYS[10], is_backlog and 1 or -1, order['restaurant'])
+    redis.call('ZREMRANGEBYSCORE', KEYS[10], '-inf', 0)
+end
+
+-- Candidats (du mieux noté au moins bien noté), offres et timers
+local candidates = redis.call('ZREVRANGE', KEYS[2], 0, -1)
+local offered = redis.call('SMEMBERS', KEYS[5])
+local open_offer = redis.call('SISMEMBER', KEYS[7], spec.order_id) == 1
+if spec.cleanup then
+    redis.call('SREM', KEYS[7], spec.order_id)
+    redis.call('DEL', KEYS[2], KEYS[3], KEYS[5])
+    for _, member in ipairs(spec.timers) do
+        redis.call('ZREM', KEYS[4], member)
+    end
+end
+if spec.timer then
+    local timer_fields = {}
+    for field, value in pairs(spec.timer.fields) do
+        table.insert(timer_fields, field)
+        table.insert(timer_fields, value)
+    end
+    redis.call('HSET', KEYS[3], unpack(timer_fields))
+    redis.call('EXPIRE', KEYS[3], spec.timer.ttl)
+    redis.call('ZADD', KEYS[4], spec.timer.due_at, spec.timer.member)
+end
+
+-- Événement, publié sur les canaux de son audience
+local event = spec.event
+local prefixes = spec.channels
+local channels = {prefixes.managers}
+if order['client'] then
+    table.insert(channels, prefixes.client .. order['client'])
+end
+if order['restaurant'] then
+    table.insert(channels, prefixes.restaurant .. order['restaurant'])
+end
+if event.notify_candidates then
+    for _, candidate in ipairs(candidates) do
+        table.insert(channels, prefixes.driver .. candidate)
+    end
+end
+if event.notify_assigned and order['assigned_driver'] then
+    table.insert(channels, prefixes.driver .. order['assigned_driver'])
+end
+if event.notify_offered then
+    for _, driver in ipairs(offered) do
+        table.insert(channels, prefixes.driver .. driver)
+    end
+    if open_offer then
+        table.insert(channels, prefixes.drivers)
+    end
+end
+
+event.data[event.order_key] = order
+local message = cjson.encode({type = event.type, data = event.data, timestamp = event.timestamp})
+log_and_publish(KEYS[8], channels, message)
+
+return {'ok', cjson.encode(order), cjson.encode(candidates), previous, score and 1 or 0,
+        cjson.encode(offered)}
+""")
+
+TRANSITION_ERRORS = {
+    'not_found': 'Commande non trouvée',
+    'forbidden': 'Non autorisé',
+}
+
+def transition_order(order_id, to_status, from_statuses, event_type, event_data,
+                     fields=None, owner_field=None, owner=None, cleanup=False, timer=None,
+                     order_key='order', notify_candidates=False, notify_assigned=False,
+                     notify_offered=False):
+    """Applique une transition de statut en un seul aller-retour.
+
+    Retourne {'status': 'success', 'order', 'candidates', 'previous_status'}
+    ou {'status': 'error', 'message', 'current_status'} si la commande
+    n'existe pas, n'appartient pas à `owner` ou n'est pas dans `from_statuses`.
+    """
+    spec = {
+        'order_id': order_id,
+        'to': to_status,
+        'from': list(from_statuses),
+        'fields': fields or {},
+        'cleanup': cleanup,
+        'timers': order_timer_members(order_id),
+        'stats': stats_buckets(time.time()),
+        'channels': {
+            'managers': MANAGERS_CHANNEL,
+            'drivers': DRIVERS_CHANNEL,
+            'client': client_channel(''),
+            'restaurant': restaurant_channel(''),
+            'driver': driver_channel('')
+        },
+        'event': {
+            'type': event_type,
+            'data': event_data,
+            'order_key': order_key,
+            'timestamp': datetime.now().isoformat(),
+            'notify_candidates': notify_candidates,
+            'notify_assigned': notify_assigned,
+            'notify_offered': notify_offered
+        }
+    }
+    if owner_field:
+        spec['owner_field'] = owner_field
+        spec['owner'] = owner
+    if timer:
+        spec['timer'] = timer
+    driver = spec['fields'].get('assigned_driver')
+    spec['driver_index'] = bool(driver)
+
+    keys = [f"order:{order_id}", f"candidates:{order_id}", f"order_timer:{order_id}",
+            "timers:due", f"offers:{order_id}", "orders:all", OPEN_OFFERS, EVENT_LOG,
+            STATS_STATUS_COUNTS, STATS_BACKLOG, spec['stats']['minute_key'],
+            spec['stats']['day_key'], f"orders:by_status:{to_status}"]
+    keys += [f"orders:by_status:{status}" for status in spec['from']]
+    if driver:
+        keys.append(f"orders:by_driver:{driver}")
+    result = TRANSITION_SCRIPT(keys=keys, args=[json.dumps(spec)], client=r)
+    if result[0] != 'ok':
+        current_status = result[1] if len(result) > 1 else None
+        message = TRANSITION_ERRORS.get(
+            result[0], f"Transition impossible: la commande est {current_status}")
+        return {'status': 'error', 'message': message, 'current_status': current_status}
+
+    _, order_json, candidates_json, previous_status, indexed, offered_json = result
+    EVENTS_PUBLISHED.inc((event_type,))
+    order_data = json.loads(order_json)
+    candidates = list(json.loads(candidates_json))
+    pipe = r.pipeline(transaction=False)
+    if cleanup:
+        # Index par livreur: un aller-retour de plus; get_available_orders et
+        # get_my_interests ignorent de toute façon les commandes qui ne sont plus prêtes
+        for driver in json.loads(offered_json):
+            pipe.srem(f"driver_offers:{driver}", order_id)
+        for candidate in candidates:
+            pipe.srem(f"driver_interests:{candidate}", order_id)
+    if not indexed:
+        # Commande antérieure aux index: les construire maintenant
+        index_order(order_data, pipe)
+    if len(pipe):
+        pipe.execute()
+    return {
+        'status': 'success',
+        'order': order_data,
+        'candidates': candidates,
+        'previous_status': previous_status
+    }
+
+def rebuild_order_indexes(batch_size=500):
+    """Reconstruit les index à partir des hashes order:* existants"""
+    count = 0
+    pipe = r.pipeline(transaction=False)
+    for key in r.scan_iter("order:*", count=batch_size):
         order_data = r.hgetall(key)
-        if order_data:
-            orders.append(order_data)
-    # Trier par date (simulation, car nous n'avons pas de timestamp de création)
-    orders.sort(key=lambda x: x.get('id'), reverse=True)
+        if not order_data.get('id'):
+            continue
+        index_order(order_data, pipe)
+        count += 1
+        if count % batch_size == 0:
+            pipe.execute()
+    pipe.execute()
+    return count
+
+def rebuild_candidate_indexes(batch_size=500):
+    """Convertit les anciennes listes candidates:* en sorted sets et reconstruit driver_interests:*"""
+    count = 0
+    for key in r.scan_iter("candidates:*", count=batch_size):
+        order_id = key.split(':', 1)[1]
+        pipe = r.pipeline()
+        if r.type(key) == 'list':
+            scores = get_livreur_scores(r.lrange(key, 0, -1))
+            pipe.delete(key)
+            if scores:
+                pipe.zadd(key, scores)
+        else:
+            scores = dict(r.zrange(key, 0, -1, withscores=True))
+        for livreur in scores:
+            pipe.sadd(f"driver_interests:{livreur}", order_id)
+        pipe.execute()
+        count += 1
+    return count
+
+@app.cli.command('rebuild-indexes')
+def rebuild_indexes_command():
+    """Construit les index secondaires des commandes existantes"""
+    count = rebuild_order_indexes()
+    print(f"📇 Index reconstruits pour {count} commande(s)")
+    count = rebuild_candidate_indexes()
+    print(f"📇 Candidats réindexés pour {count} commande(s)")
+    counts = rebuild_order_stats()
+    print(f"📇 Statistiques recalculées pour {sum(counts.values())} commande(s)")
+    count = rebuild_restaurant_index()
+    print(f"📇 Index reconstruit pour {count} restaurant(s)")
+
+@app.cli.command('archive-orders')
+@click.option('--older-than', default=ARCHIVE_AFTER_SECONDS, show_default=True,
+              help="âge minimal (secondes) des commandes terminées à archiver")
+def archive_orders_command(older_than):
+    """Archive les commandes livrées ou annulées"""
+    archived = archive_orders(older_than)
+    print(f"🗄️ {archived} commande(s) terminée(s) archivée(s)")
+
+@app.cli.command('import-data')
+@click.argument('path', default=DATASET_FILE)
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True,
+              help="entités écrites par pipeline")
+def import_data_command(path, batch_size):
+    """Importe un fichier de données (comptes, livreurs, restaurants, menus)"""
+    reset_redis_calls()
+    counts, elapsed = import_dataset(path, batch_size)
+    print(import_summary(counts, elapsed, redis_calls_count()))
+
+def load_orders(order_ids, with_timers=False, with_candidates=False, with_archive=False):
+    """Charge plusieurs commandes (et leurs timers/candidats) en un seul aller-retour.
+
+    Avec with_archive=True, les commandes absentes sont cherchées dans l'archive
+    (un aller-retour de plus, seulement s'il en manque).
+    """
+    order_ids = list(order_ids)
+    if not order_ids:
+        return []
+
+    pipe = r.pipeline(transaction=False)
+    for order_id in order_ids:
+        pipe.hgetall(f"order:{order_id}")
+        if with_timers:
+            pipe.hgetall(f"order_timer:{order_id}")
+        if with_candidates:
+            pipe.zcard(f"candidates:{order_id}")
+    results = iter(pipe.execute())
+
+    loaded = {}
+    missing = []
+    for order_id in order_ids:
+        order_data = next(results)
+        timer_data = next(results) if with_timers else None
+        candidates_count = next(results) if with_candidates else None
+        if not order_data:
+            missing.append(order_id)
+            continue
+        if with_timers:
+            order_data['timer'] = timer_data
+        if with_candidates:
+            order_data['candidates_count'] = candidates_count
+        loaded[order_id] = order_data
+
+    if with_archive and missing:
+        for order_id, order_data in load_archived_orders(missing).items():
+            if with_timers:
+                order_data['timer'] = {}
+            if with_candidates:
+                order_data['candidates_count'] = 0
+            loaded[order_id] = order_data
+    return [loaded[order_id] for order_id in order_ids if order_id in loaded]
+
+def get_indexed_order_ids(index_key, statuses):
+    """Identifiants d'un index filtrés par statut, du plus récent au plus ancien"""
+    pipe = r.pipeline(transaction=False)
+    for status in statuses:
+        pipe.zinter([index_key, f"orders:by_status:{status}"],
+                    aggregate='MAX', withscores=True)
+    scored = [item for result in pipe.execute() for item in result]
+    scored.sort(key=lambda x: x[1], reverse=True)
+    return [order_id for order_id, _ in scored]
+
+def get_all_orders_with_details():
+    orders = load_orders(r.zrevrange("orders:all", 0, -1), with_timers=True, with_candidates=True)
+    scores = get_livreur_scores(order['assigned_driver'] for order in orders
+                                if order.get('assigned_driver'))
+    for order in orders:
+        if order.get('assigned_driver'):
+            order['driver_score'] = scores[order['assigned_driver']]
     return orders
 
 def get_assigned_orders_for_livreur(livreur_id):
-    orders = []
-    for key in r.keys("order:*"):
-        order_data = r.hgetall(key)
-        if (order_data.get('assigned_driver') == livreur_id and 
-            order_data.get('status') == 'assigned'):
-            orders.append(order_data)
-    return orders
+    return load_orders(get_indexed_order_ids(f"orders:by_driver:{livreur_id}", ['assigned']))
 
 @app.route('/')
 def index():
@@ -171,66 +1757,137 @@ def dashboard():
     
     role = session['role']
     username = session['username']
+    data = get_dashboard_data(role, username)
     
     if role == 'client':
-        orders = get_client_orders(username)
-        return render_template('client_simple.html', username=username, orders=orders)
+        return render_template('client_simple.html', username=username, orders=data['orders'],
+                               has_more=data['has_more'])
     elif role == 'manager':
-        all_orders = get_all_orders_with_details()
         return render_template('manager_simple.html', 
                              username=username,
-                             all_orders=all_orders,
-                             get_livreur_score=get_livreur_score)
+                             all_orders=data['orders'])
     elif role == 'restaurant':
         # MODIFIÉ: Obtenir les commandes pour ce restaurant spécifique
-        orders = get_restaurant_orders(username)
         restaurant_name = session.get('restaurant_name', username)
         return render_template('restaurant_simple.html', 
                              username=restaurant_name, # Afficher le nom complet
-                             orders=orders)
+                             orders=data['orders'])
     elif role == 'livreur':
-        available_orders = get_available_orders()
-        my_interests = get_my_interests(username)
-        assigned_orders = get_assigned_orders_for_livreur(username)
         return render_template('livreur_simple.html', 
                              username=username, 
-                             available_orders=available_orders, 
-                             my_interests=my_interests,
-                             assigned_orders=assigned_orders)
+                             available_orders=data['available_orders'], 
+                             my_interests=data['my_interests'],
+                             assigned_orders=data['assigned_orders'],
+                             now_ms=data['now_ms'])
     
     return redirect(url_for('login'))
 
+def get_dashboard_data(role, username):
+    """Données du tableau de bord d'un rôle (rendu HTML et resynchronisation JSON)"""
+    if role == 'client':
+        history = get_order_history(f"orders:by_client:{username}")
+        return {'orders': history['orders'], 'has_more': history['has_more']}
+    if role == 'manager':
+        return {'orders': get_all_orders_with_details()}
+    if role == 'restaurant':
+        return {'orders': get_restaurant_orders(username)}
+    if role == 'livreur':
+        return {
+            'available_orders': get_available_orders(username),
+            'my_interests': get_my_interests(username),
+            'assigned_orders': get_assigned_orders_for_livreur(username),
+            'now_ms': now_ms()
+        }
+    return {}
+
+def can_view_order(order_data, role, username):
+    """Vérifie qu'un utilisateur a le droit de consulter une commande"""
+    if role == 'manager':
+        return True
+    if role == 'client':
+        return order_data.get('client') == username
+    if role == 'restaurant':
+        return order_data.get('restaurant') == username
+    if role == 'livreur':
+        return (order_data.get('assigned_driver') == username or
+                order_data.get('status') == 'ready')
+    return False
+
+@app.route('/get_dashboard_data')
+def dashboard_data():
+    """Tableau de bord en JSON, utilisé par les pages pour se resynchroniser"""
+    if 'username' not in session:
+        return jsonify({'status': 'error', 'message': 'Non autorisé'}), 401
+    
+    data = get_dashboard_data(session['role'], session['username'])
+    return jsonify({'status': 'success', **data})
+
+@app.route('/get_order/<order_id>')
+def get_order(order_id):
+    """Détails d'une commande, pour mettre à jour une seule carte"""
+    if 'username' not in session:
+        return jsonify({'status': 'error', 'message': 'Non autorisé'}), 401
+    
+    orders = load_orders([order_id], with_timers=True, with_candidates=True, with_archive=True)
+    if not orders or not can_view_order(orders[0], session['role'], session['username']):
+        return jsonify({'status': 'error', 'message': 'Commande non trouvée'}), 404
+    return jsonify({'status': 'success', 'order': orders[0]})
+
+HISTORY_INDEXES = {
+    'client': 'orders:by_client:{}',
+    'restaurant': 'orders:by_restaurant:{}',
+    'livreur': 'orders:by_driver:{}',
+}
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+
+def get_order_history(index_key, page=0, per_page=HISTORY_PAGE_SIZE):
+    """Une page d'historique (commandes en cours et archivées), les plus récentes d'abord"""
+    start = page * per_page
+    pipe = r.pipeline(transaction=False)
+    pipe.zrevrange(index_key, start, start + per_page - 1)
+    pipe.zcard(index_key)
+    order_ids, total = pipe.execute()
+    return {
+        'orders': load_orders(order_ids, with_archive=True),
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'has_more': start + per_page < total
+    }
+
+@app.route('/get_order_history')
+def order_history():
+    """Historique paginé des commandes du client, du restaurant ou du livreur connecté"""
+    if session.get('role') not in HISTORY_INDEXES:
+        return jsonify({'status': 'error', 'message': 'Non autorisé'}), 401
+    
+    page = max(0, request.args.get('page', default=0, type=int))
+    per_page = min(max(1, request.args.get('per_page', default=HISTORY_PAGE_SIZE, type=int)),
+                   HISTORY_MAX_PAGE_SIZE)
+    index_key = HISTORY_INDEXES[session['role']].format(session['username'])
+    return jsonify({'status': 'success', **get_order_history(index_key, page, per_page)})
+
+@app.route('/manager/stats')
+def manager_stats():
+    """Statistiques d'exploitation en temps réel (compteurs maintenus à chaque transition)"""
+    if session.get('role') != 'manager':
+        return jsonify({'status': 'error', 'message': 'Non autorisé'}), 401
+    
+    return jsonify({'status': 'success', **get_manager_stats()})
+
 @app.route('/get_restaurants_paginated')
 def get_restaurants_paginated():
     if 'username' not in session:
         return jsonify({'status': 'error', 'message': 'Non autorisé'}), 401
     
     try:
-        page = int(request.args.get('page', 1))
-        per_page = int(request.args.get('per_page', 10))
-        
-        # Get all restaurant users
-        all_users = r.hgetall("users")
-        restaurants = []
-        
-        for username, data in all_users.items():
-            if data.endswith(":restaurant"):
-                info = r.hgetall(f"restaurant:info:{username}")
-                restaurants.append({
-                    "id": username,
-                    "name": info.get("name", username)
-                })
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = min(max(int(request.args.get('per_page', 10)), 1), 100)
         
-        # Sort by name for consistent pagination
-        restaurants.sort(key=lambda x: x['name'])
-        
-        # Calculate pagination
-        total_restaurants = len(restaurants)
+        # Only the requested slice of the name index is read
+        paginated_restaurants, total_restaurants = get_restaurant_page(page, per_page)
         total_pages = (total_restaurants + per_page - 1) // per_page
-        start_idx = (page - 1) * per_page
-        end_idx = start_idx + per_page
-        
-        paginated_restaurants = restaurants[start_idx:end_idx]
         
         return jsonify({
             'status': 'success', 
@@ -254,34 +1911,100 @@ def get_restaurants():
     if 'username' not in session:
         return jsonify({'status': 'error', 'message': 'Non autorisé'}), 401
     
-    restaurants = []
-    # On pourrait aussi utiliser r.keys("restaurant:info:*")
-    all_users = r.hgetall("users")
-    for username, data in all_users.items():
-        if data.endswith(":restaurant"):
-            info = r.hgetall(f"restaurant:info:{username}")
-            restaurants.append({
-                "id": username,
-                "name": info.get("name", username)
-            })
-    return jsonify({'status': 'success', 'restaurants': restaurants})
+    return jsonify({'status': 'success', 'restaurants': get_restaurant_catalog()})
 # ========================================================
 
+# Libellés saisis par les restaurants (nom, articles du menu)
+LABEL_MAX_LENGTH = 80
+MENU_MAX_ITEMS = 200
+MENU_MAX_PRICE = 10000
+
+def clean_label(value, max_length=LABEL_MAX_LENGTH):
+    """Libellé sur une ligne, espaces normalisés; None s'il est vide, trop long ou non imprimable"""
+    if not isinstance(value, str):
+        return None
+    value = ' '.join(value.split())
+    if not value or len(value) > max_length or not value.isprintable():
+        return None
+    return value
+
+@app.route('/update_restaurant_info', methods=['POST'])
+def update_restaurant_info():
+    """Modification du nom ou de la position d'un restaurant par lui-même"""
+    if session.get('role') != 'restaurant':
+        return jsonify({'status': 'error', 'message': 'Non autorisé'}), 401
+    
+    restaurant_id = session['username']
+    data = request.get_json() or {}
+    info = r.hgetall(f"restaurant:info:{restaurant_id}")
+    if 'name' in data:
+        name = clean_label(data['name'])
+        if name is None:
+            return jsonify({'status': 'error', 'message': 'Nom invalide'}), 400
+    else:
+        name = info.get('name') or restaurant_id
+    try:
+        lon = float(data.get('longitude', info.get('lon', 0.0)))
+        lat = float(data.get('latitude', info.get('lat', 0.0)))
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'Coordonnées invalides'}), 400
+    
+    save_restaurant_info(restaurant_id, name, lon, lat)
+    session['restaurant_name'] = name
+    return jsonify({'status': 'success', 'restaurant': {'id': restaurant_id, 'name': name}})
+
 # === NOUVELLE ROUTE: Obtenir le menu d'un restaurant ===
 @app.route('/get_menu/<restaurant_id>')
 def get_menu(restaurant_id):
     if 'username' not in session:
         return jsonify({'status': 'error', 'message': 'Non autorisé'}), 401
     
-    menu_data = r.hgetall(f"menu:{restaurant_id}")
-    if not menu_data:
+    # Seule la version est lue: le menu sérialisé vient du cache
+    version = r.get(f"menu:version:{restaurant_id}") or '0'
+    etag = f"menu-{restaurant_id}-{version}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    
+    payload = get_menu_payload(restaurant_id, version)
+    if payload is None:
         return jsonify({'status': 'error', 'message': 'Menu non trouvé'}), 404
     
-    # Convertir les prix en float
-    menu = {item: float(price) for item, price in menu_data.items()}
-    return jsonify({'status': 'success', 'menu': menu})
+    body, etag = payload
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 # ======================================================
 
+@app.route('/update_menu', methods=['POST'])
+def update_menu():
+    """Remplacement du menu par le restaurant connecté"""
+    if session.get('role') != 'restaurant':
+        return jsonify({'status': 'error', 'message': 'Non autorisé'}), 401
+    
+    data = request.get_json() or {}
+    menu = data.get('menu', {})
+    if not isinstance(menu, dict) or len(menu) > MENU_MAX_ITEMS:
+        return jsonify({'status': 'error', 'message': 'Menu invalide'}), 400
+    menu_dict = {}
+    for item, price in menu.items():
+        label = clean_label(item)
+        try:
+            price = float(price)
+        except (TypeError, ValueError):
+            price = None
+        if (label is None or price is None or not math.isfinite(price) or
+            not 0 <= price <= MENU_MAX_PRICE):
+            return jsonify({'status': 'error', 'message': 'Article ou prix invalide'}), 400
+        menu_dict[label] = price
+    if not menu_dict:
+        return jsonify({'status': 'error', 'message': 'Menu vide'}), 400
+    
+    save_menu(session['username'], menu_dict)
+    return jsonify({'status': 'success'})
+
 
 
 # === ROUTE MODIFIÉE: Passer une commande ===
@@ -314,11 +2037,17 @@ def passer_commande():
             "articles": articles_str,
             "total_price": total_price,
             "status": "pending",
-            "created_at": datetime.now().isoformat()
+            "created_at": datetime.now().isoformat(),
+            "status_at": time.time()
         }
         
-        r.hset(f"order:{id_commande}", mapping=details_commande)
-        publish_event('order_created', {'order_id': id_commande, 'details': details_commande})
+        pipe = r.pipeline(transaction=False)
+        pipe.hset(f"order:{id_commande}", mapping=details_commande)
+        index_order(details_commande, pipe)
+        record_order_created(details_commande, pipe)
+        pipe.execute()
+        publish_event('order_created', {'order_id': id_commande, 'details': details_commande},
+                      order_channels(details_commande))
         
         return jsonify({'status': 'success', 'order_id': id_commande})
     except Exception as e:
@@ -328,108 +2057,237 @@ def passer_commande():
 @app.route('/marquer_prete/<order_id>', methods=['POST'])
 def marquer_prete(order_id):
     try:
-        # Vérifier que le restaurant est autorisé
+        # Le restaurant doit être propriétaire d'une commande encore en attente
         restaurant_id = session.get('username')
-        order_data = r.hgetall(f"order:{order_id}")
-        
-        if order_data.get('restaurant') != restaurant_id:
-             return {'status': 'error', 'message': 'Non autorisé'}
-             
-        # Marquer la commande comme prête
-        r.hset(f"order:{order_id}", "status", "ready")
-        
-        # Démarrer la fenêtre de 60s pour les livreurs
-        start_acceptance_window(order_id)
+        result = start_acceptance_window(order_id, restaurant_id)
+        if result['status'] != 'success':
+            return {'status': 'error', 'message': result['message']}
         
         print(f"✅ Fenêtre d'acceptation ouverte pour {order_id}")
         return {'status': 'success'}
     except Exception as e:
         return {'status': 'error', 'message': str(e)}
 
-def start_acceptance_window(order_id):
-    """Démarre la fenêtre d'acceptation de 60s pour les livreurs"""
-    expiration_time = datetime.now() + timedelta(seconds=60)
-    r.hset(f"order_timer:{order_id}", 
-           mapping={
-               "type": "acceptance_window",
-               "expires_at": expiration_time.isoformat(),
-               "status": "active",
-               "created_at": datetime.now().isoformat()
-           })
-    r.expire(f"order_timer:{order_id}", 60)
-    
-    # Programmer l'expiration pour déclencher la décision manager
-    schedule_manager_decision(order_id, 60)
-    
-    # MODIFIÉ: Envoyer les détails de la commande dans l'événement
-    order_data = r.hgetall(f"order:{order_id}")
-    publish_event('order_ready', {
-        'order_id': order_id,
-        'expires_at': expiration_time.isoformat(),
-        'order_data': order_data # Envoyer les détails
-    })
+def start_acceptance_window(order_id, restaurant_id):
+    """Marque la commande prête et ouvre la fenêtre d'acceptation de 60s"""
+    deadline = deadline_ms(60)
+    result = transition_order(
+        order_id, "ready", ["pending"], 'order_ready',
+        {'order_id': order_id, 'deadline_ms': deadline},
+        owner_field='restaurant', owner=restaurant_id,
+        # Programmer l'expiration pour déclencher la décision manager
+        timer={
+            'fields': {
+                "type": "acceptance_window",
+                "deadline_ms": deadline,
+                "status": "active",
+                "created_at": datetime.now().isoformat()
+            },
+            'ttl': 60,
+            'member': timer_member('manager_decision', order_id),
+            'due_at': deadline / 1000
+        },
+        order_key='order_data')
+    if result['status'] == 'success':
+        # Proposer la commande aux livreurs les plus proches
+        dispatch_offers(order_id, result['order'], 0, deadline)
+    return result
 
-def schedule_manager_decision(order_id, delay_seconds):
-    """Programme la décision du manager après un délai"""
-    def start_manager_decision():
-        time.sleep(delay_seconds)
-        
-        # Vérifier si la commande existe toujours et n'est pas déjà assignée
-        order_data = r.hgetall(f"order:{order_id}")
-        if not order_data or order_data.get('status') != 'ready':
+# === Proposition des commandes aux livreurs proches ===
+# Une commande prête est proposée aux DISPATCH_K livreurs en ligne les plus
+# proches du restaurant (GEOSEARCH), dans un rayon élargi par anneaux toutes
+# les DISPATCH_RING_SECONDS tant que personne ne s'est montré intéressé. Après
+# le dernier anneau, elle est ouverte à tous les livreurs.
+#   offers:<commande>          livreurs à qui la commande a été proposée
+#   driver_offers:<livreur>    commandes proposées à un livreur
+#   orders:open_offers         commandes ouvertes à tous
+# Ces offres sont retirées à la fin de la fenêtre d'acceptation (close_offers),
+# à l'attribution ou à l'annulation (transition_order) et, par sécurité, à la
+# lecture par get_available_orders.
+#   livreurs:last_seen         dernière activité de chaque livreur
+DISPATCH_K = 10
+DISPATCH_RINGS_KM = (2, 5, 10)
+DISPATCH_RING_SECONDS = 15
+DRIVER_ONLINE_SECONDS = 1800
+OPEN_OFFERS = 'orders:open_offers'
+
+def touch_driver(livreur_id):
+    """Marque un livreur comme en ligne"""
+    r.zadd("livreurs:last_seen", {livreur_id: time.time()})
+
+def find_nearby_drivers(lon, lat, radius_km, exclude=(), limit=DISPATCH_K):
+    """Livreurs en ligne les plus proches d'un point, du plus proche au plus loin"""
+    nearby = r.geosearch("livreurs:positions", longitude=lon, latitude=lat,
+                         radius=radius_km, unit='km', sort='ASC',
+                         count=len(exclude) + 3 * limit)
+    nearby = [driver for driver in nearby if driver not in exclude]
+    if not nearby:
+        return []
+    last_seen = r.zmscore("livreurs:last_seen", nearby)
+    online_since = time.time() - DRIVER_ONLINE_SECONDS
+    return [driver for driver, seen in zip(nearby, last_seen)
+            if seen and seen >= online_since][:limit]
+
+def dispatch_offers(order_id, order_data, ring, deadline):
+    """Propose la commande aux livreurs de l'anneau `ring` et programme le suivant"""
+    offer = {'order_id': order_id, 'deadline_ms': deadline, 'order_data': order_data}
+    with r.pipeline() as pipe:
+        try:
+            # Une annulation survenue depuis la mise en état prête (ou pendant
+            # l'écriture) ne doit pas recréer d'offres déjà nettoyées
+            pipe.watch(f"order:{order_id}")
+            if pipe.hget(f"order:{order_id}", "status") != 'ready':
+                return
+            if ring < len(DISPATCH_RINGS_KM):
+                already_offered = pipe.smembers(f"offers:{order_id}")
+                drivers = find_nearby_drivers(order_data.get('restaurant_lon') or '2.333',
+                                              order_data.get('restaurant_lat') or '48.865',
+                                              DISPATCH_RINGS_KM[ring], exclude=already_offered)
+                pipe.multi()
+                if drivers:
+                    pipe.sadd(f"offers:{order_id}", *drivers)
+                    for driver in drivers:
+                        pipe.sadd(f"driver_offers:{driver}", order_id)
+                channels = [driver_channel(driver) for driver in drivers]
+                label = f"{len(drivers)} livreur(s) à moins de {DISPATCH_RINGS_KM[ring]} km"
+            else:
+                pipe.multi()
+                pipe.sadd(OPEN_OFFERS, order_id)
+                channels = [DRIVERS_CHANNEL]
+                label = "tous les livreurs"
+            pipe.hset(f"order_timer:{order_id}", "dispatch_ring", ring)
+            pipe.execute()
+        except redis.WatchError:
             return
-            
-        candidates = r.lrange(f"candidates:{order_id}", 0, -1)
-        
-        if candidates:
-            # Démarrer la fenêtre de décision du manager (60s)
-            expiration_time = datetime.now() + timedelta(seconds=60)
-            r.hset(f"order_timer:{order_id}", 
-                   mapping={
-                       "type": "manager_decision",
-                       "expires_at": expiration_time.isoformat(),
-                       "status": "active"
-                   })
-            r.expire(f"order_timer:{order_id}", 60)
-            
-            publish_event('manager_decision_started', {
-                'order_id': order_id,
-                'candidates_count': len(candidates),
-                'expires_at': expiration_time.isoformat()
-            })
-            
-            print(f"🔄 Fenêtre manager démarrée pour {order_id} avec {len(candidates)} candidats")
-            
-            # Programmer l'attribution automatique
-            schedule_auto_assignment(order_id, 60)
-        else:
-            publish_event('no_candidates', {'order_id': order_id})
-            print(f"❌ Aucun candidat pour {order_id}")
     
-    thread = threading.Thread(target=start_manager_decision, daemon=True)
-    thread.start()
+    if ring < len(DISPATCH_RINGS_KM):
+        schedule_timer('dispatch_ring', order_id, DISPATCH_RING_SECONDS)
+    if channels:
+        publish_event('order_ready', offer, channels)
+    print(f"📣 Commande {order_id} proposée à {label}")
+
+def close_offers(order_id):
+    """Retire la commande des offres des livreurs (fin de la fenêtre d'acceptation)"""
+    offered = r.smembers(f"offers:{order_id}")
+    pipe = r.pipeline(transaction=False)
+    for driver in offered:
+        pipe.srem(f"driver_offers:{driver}", order_id)
+    pipe.srem(OPEN_OFFERS, order_id)
+    pipe.delete(f"offers:{order_id}")
+    pipe.execute()
+
+@timer_handler('dispatch_ring')
+def widen_dispatch(order_id):
+    """Personne ne s'est montré intéressé: élargir le rayon de proposition"""
+    orders = load_orders([order_id], with_timers=True, with_candidates=True)
+    if not orders:
+        return
+    order_data = orders[0]
+    timer_data = order_data.pop('timer')
+    candidates_count = order_data.pop('candidates_count')
+    # Fenêtre déjà close (timer en retard): ne plus proposer la commande
+    if (order_data.get('status') != 'ready' or candidates_count or
+        timer_data.get('type') != 'acceptance_window' or
+        int(timer_data.get('deadline_ms', 0)) <= now_ms()):
+        return
+    ring = int(timer_data.get('dispatch_ring', 0)) + 1
+    dispatch_offers(order_id, order_data, ring, int(timer_data.get('deadline_ms', 0)))
+
+@timer_handler('manager_decision')
+def start_manager_decision(order_id):
+    """Fin de la fenêtre d'acceptation: ouvre la fenêtre de décision du manager"""
+    # Vérifier si la commande existe toujours et n'est pas déjà assignée
+    order_data = r.hgetall(f"order:{order_id}")
+    if not order_data or order_data.get('status') != 'ready':
+        return
+        
+    candidates_count = r.zcard(f"candidates:{order_id}")
+    # Plus aucun livreur ne peut candidater: retirer la commande des offres
+    close_offers(order_id)
+    
+    if candidates_count:
+        # Démarrer la fenêtre de décision du manager (60s)
+        deadline = deadline_ms(60)
+        r.hset(f"order_timer:{order_id}", 
+               mapping={
+                   "type": "manager_decision",
+                   "deadline_ms": deadline,
+                   "status": "active"
+               })
+        r.expire(f"order_timer:{order_id}", 60)
+        
+        publish_event('manager_decision_started', {
+            'order_id': order_id,
+            'timer_type': 'manager_decision',
+            'candidates_count': candidates_count,
+            'deadline_ms': deadline
+        }, order_channels(order_data))
+        
+        print(f"🔄 Fenêtre manager démarrée pour {order_id} avec {candidates_count} candidats")
+        
+        # Programmer l'attribution automatique
+        schedule_auto_assignment(order_id, 60)
+    else:
+        publish_event('no_candidates', {'order_id': order_id}, order_channels(order_data))
+        print(f"❌ Aucun candidat pour {order_id}")
 
 # ... (le reste de schedule_auto_assignment, choisir_livreur, marquer_livree, etc. reste identique)
 # ... (la fonction schedule_auto_assignment utilise déjà restaurant_lon/lat, ce qui est parfait)
 
+# === Candidatures des livreurs ===
+#   candidates:<commande>        livreurs intéressés, score = note du livreur au moment de l'intérêt
+#   driver_interests:<livreur>   commandes pour lesquelles le livreur s'est montré intéressé
+# Les deux sont nettoyés par transition_order (cleanup) à l'attribution et à l'annulation;
+# get_my_interests retire en plus les commandes qui ne sont plus prêtes.
+
+# Vérification de la fenêtre et de l'offre puis ZADD en une seule opération
+# atomique: une candidature tardive ne peut pas recréer candidates:<commande>
+# après sa suppression par TRANSITION_SCRIPT (clé orpheline, sans TTL).
+SHOW_INTEREST_SCRIPT = r.register_script("""
+-- KEYS: order_timer:<id>, offers:<id>, orders:open_offers, candidates:<id>,
+--       driver_interests:<livreur>, order:<id>
+-- ARGV: livreur, id de la commande, note du livreur
+if redis.call('HGET', KEYS[1], 'type') ~= 'acceptance_window' then
+    return {'closed'}
+end
+if redis.call('SISMEMBER', KEYS[2], ARGV[1]) == 0 and
+        redis.call('SISMEMBER', KEYS[3], ARGV[2]) == 0 then
+    return {'not_offered'}
+end
+local added = redis.call('ZADD', KEYS[4], 'NX', ARGV[3], ARGV[1])
+redis.call('SADD', KEYS[5], ARGV[2])
+return {'ok', added, redis.call('HGET', KEYS[6], 'restaurant')}
+""")
+
+INTEREST_ERRORS = {
+    'closed': 'Fenêtre d\'acceptation fermée',
+    'not_offered': 'Commande non proposée à ce livreur',
+}
+
 @app.route('/montrer_interet/<order_id>', methods=['POST'])
 def montrer_interet(order_id):
     try:
         livreur = session.get('username')
-        
-        # Vérifier si la fenêtre d'acceptation est encore ouverte
-        timer_data = r.hgetall(f"order_timer:{order_id}")
-        if not timer_data or timer_data.get('type') != 'acceptance_window':
-            return {'status': 'error', 'message': 'Fenêtre d\'acceptation fermée'}
-        
-        # Ajouter le livreur à la liste des candidats
-        r.rpush(f"candidates:{order_id}", livreur)
-        
+        driver_score = get_livreur_score(livreur)
+        
+        # Fenêtre d'acceptation ouverte et commande proposée à ce livreur: l'ajouter
+        # aux candidats (une seule fois) et à son index d'intérêts
+        result = SHOW_INTEREST_SCRIPT(
+            keys=[f"order_timer:{order_id}", f"offers:{order_id}", OPEN_OFFERS,
+                  f"candidates:{order_id}", f"driver_interests:{livreur}", f"order:{order_id}"],
+            args=[livreur, order_id, driver_score], client=r)
+        if result[0] != 'ok':
+            return {'status': 'error', 'message': INTEREST_ERRORS[result[0]]}
+        _, added, restaurant_id = result
+        if not added:
+            return {'status': 'success', 'message': 'Intérêt déjà enregistré'}
+        
+        # Le client n'est pas concerné par les candidatures
         publish_event('driver_interest', {
             'order_id': order_id,
             'driver_id': livreur,
-            'driver_score': get_livreur_score(livreur)
-        })
+            'driver_score': driver_score
+        }, [MANAGERS_CHANNEL, restaurant_channel(restaurant_id)])
         
         print(f"✅ {livreur} a montré son intérêt pour {order_id}")
         return {'status': 'success'}
@@ -439,19 +2297,15 @@ def montrer_interet(order_id):
 @app.route('/choisir_livreur/<order_id>/<livreur>', methods=['POST'])
 def choisir_livreur(order_id, livreur):
     try:
-        # Assigner la commande au livreur
-        r.hset(f"order:{order_id}", "status", "assigned")
-        r.hset(f"order:{order_id}", "assigned_driver", livreur)
-        
-        # Supprimer les candidats et les timers
-        r.delete(f"candidates:{order_id}")
-        r.delete(f"order_timer:{order_id}")
-        
-        publish_event('driver_assigned', {
-            'order_id': order_id,
-            'driver_id': livreur,
-            'assigned_by': session.get('username')
-        })
+        # Assigner la commande au livreur (si personne ne l'a fait entre-temps)
+        # et supprimer les candidats et les timers
+        result = transition_order(
+            order_id, "assigned", ["ready"], 'driver_assigned',
+            {'order_id': order_id, 'driver_id': livreur, 'assigned_by': session.get('username')},
+            fields={"assigned_driver": livreur}, cleanup=True,
+            notify_candidates=True, notify_assigned=True, notify_offered=True)
+        if result['status'] != 'success':
+            return {'status': 'error', 'message': result['message']}
         
         print(f"✅ Manager a choisi {livreur} pour {order_id}")
         return {'status': 'success'}
@@ -461,12 +2315,13 @@ def choisir_livreur(order_id, livreur):
 @app.route('/marquer_livree/<order_id>', methods=['POST'])
 def marquer_livree(order_id):
     try:
-        r.hset(f"order:{order_id}", "status", "delivered")
-        
-        publish_event('order_delivered', {
-            'order_id': order_id,
-            'driver_id': r.hget(f"order:{order_id}", "assigned_driver")
-        })
+        livreur = session.get('username')
+        result = transition_order(
+            order_id, "delivered", ["assigned"], 'order_delivered',
+            {'order_id': order_id, 'driver_id': livreur},
+            owner_field='assigned_driver', owner=livreur, notify_assigned=True)
+        if result['status'] != 'success':
+            return {'status': 'error', 'message': result['message']}
         
         print(f"✅ Commande {order_id} livrée")
         return {'status': 'success'}
@@ -475,25 +2330,53 @@ def marquer_livree(order_id):
 
 @app.route('/get_order_candidates/<order_id>')
 def get_order_candidates(order_id):
-    """Récupère les candidats pour une commande spécifique"""
+    """Récupère les candidats pour une commande spécifique (les `limit` mieux notés)"""
     try:
-        candidates = r.lrange(f"candidates:{order_id}", 0, -1)
-        candidates_with_scores = []
-        
-        for candidate in candidates:
-            score = get_livreur_score(candidate)
-            candidates_with_scores.append({
-                'id': candidate,
-                'score': score
-            })
-        
-        # Trier par score décroissant
-        candidates_with_scores.sort(key=lambda x: x['score'], reverse=True)
+        limit = request.args.get('limit', default=0, type=int)
+        pipe = r.pipeline(transaction=False)
+        pipe.zrevrange(f"candidates:{order_id}", 0, limit - 1, withscores=True)
+        pipe.hget(f"order:{order_id}", "status")
+        candidates, order_status = pipe.execute()
         
         return {
             'status': 'success', 
-            'candidates': candidates_with_scores,
-            'order_status': r.hget(f"order:{order_id}", "status")
+            'candidates': [{'id': candidate, 'score': score} for candidate, score in candidates],
+            'order_status': order_status
+        }
+    except Exception as e:
+        return {'status': 'error', 'message': str(e)}
+
+# Les pages décomptent elles-mêmes à partir de deadline_ms (tableau de bord et
+# événements SSE); ces routes ne servent qu'à rattraper une échéance inconnue.
+TIMER_STATUS_MAX_IDS = 100
+
+def timer_status(timer_data, now):
+    """Statut d'un timer à l'instant `now` (ms epoch)"""
+    if not timer_data:
+        return {'status': 'expired'}
+    deadline = int(timer_data.get('deadline_ms', 0))
+    return {
+        'status': 'active',
+        'deadline_ms': deadline,
+        'time_left': max(0, (deadline - now) // 1000),
+        'type': timer_data.get('type', 'unknown')
+    }
+
+@app.route('/get_timer_status')
+def get_timers_status():
+    """Statut de plusieurs timers en un seul aller-retour (?ids=id1,id2,...)"""
+    try:
+        order_ids = [order_id for order_id in request.args.get('ids', '').split(',')
+                     if order_id][:TIMER_STATUS_MAX_IDS]
+        pipe = r.pipeline(transaction=False)
+        for order_id in order_ids:
+            pipe.hgetall(f"order_timer:{order_id}")
+        now = now_ms()
+        return {
+            'status': 'success',
+            'now_ms': now,
+            'timers': {order_id: timer_status(timer_data, now)
+                       for order_id, timer_data in zip(order_ids, pipe.execute())}
         }
     except Exception as e:
         return {'status': 'error', 'message': str(e)}
@@ -502,37 +2385,85 @@ def get_order_candidates(order_id):
 def get_timer_status(order_id):
     """Récupère le statut et le temps restant d'un timer"""
     try:
-        timer_data = r.hgetall(f"order_timer:{order_id}")
-        if not timer_data:
-            return {'status': 'expired'}
-        
-        # Calculer le temps restant
-        expires_at = datetime.fromisoformat(timer_data['expires_at'])
-        time_left = max(0, (expires_at - datetime.now()).total_seconds())
-        
-        return {
-            'status': 'active',
-            'time_left': int(time_left),
-            'type': timer_data.get('type', 'unknown')
-        }
+        return timer_status(r.hgetall(f"order_timer:{order_id}"), now_ms())
     except Exception as e:
         return {'status': 'error', 'message': str(e)}
 
 @app.route('/events')
 def events():
     """Endpoint Server-Sent Events pour les mises à jour en temps réel"""
+    if 'username' not in session:
+        return jsonify({'status': 'error', 'message': 'Non autorisé'}), 401
+    
+    # Seuls les canaux concernant l'utilisateur connecté sont écoutés
+    channels = channels_for_session(session['role'], session['username'])
+    if session['role'] == 'livreur':
+        touch_driver(session['username'])
+    # Reconnexion: dernier id reçu (en-tête du navigateur ou paramètre des templates)
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    
     def generate():
-        pubsub = r.pubsub()
-        pubsub.subscribe('system_events')
-        
-        yield "data: {}\n\n".format(json.dumps({'type': 'connected'}))
-        
-        for message in pubsub.listen():
-            if message['type'] == 'message':
-                yield "data: {}\n\n".format(message['data'])
+        # Abonnement avant le rejeu: rien n'est perdu entre les deux
+        subscriber = broadcaster.subscribe(channels)
+        try:
+            yield "data: {}\n\n".format(json.dumps({'type': 'connected'}))
+            
+            replayed_until = None
+            if last_event_id:
+                missed, complete = replay_events(channels, last_event_id)
+                if not complete:
+                    yield "data: {}\n\n".format(RESYNC_MESSAGE)
+                for event_id, message in missed:
+                    yield "id: {}\ndata: {}\n\n".format(event_id, message)
+                if missed:
+                    replayed_until = parse_event_id(missed[-1][0])
+            
+            while True:
+                try:
+                    data = subscriber.get(timeout=SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    # Commentaire SSE: détecte et libère les connexions fermées
+                    yield ": heartbeat\n\n"
+                    continue
+                if replayed_until and not data.startswith('{'):
+                    # Déjà envoyé par le rejeu
+                    if parse_event_id(data.split(' ', 1)[0]) <= replayed_until:
+                        continue
+                    replayed_until = None
+                yield sse_frame(data)
+        finally:
+            broadcaster.unsubscribe(subscriber)
     
     return Response(generate(), mimetype='text/event-stream')
 
+@app.route('/metrics')
+def metrics():
+    """Métriques du processus au format texte Prometheus"""
+    pipe = r.pipeline(transaction=False)
+    pipe.zcard("timers:due")
+    pipe.zcount("timers:due", '-inf', time.time())
+    pipe.zcard("timers:inflight")
+    pipe.xlen(EVENT_LOG)
+    scheduled, overdue, inflight, logged = pipe.execute()
+    gauges = (
+        ('timers_scheduled', "Timers planifiés", scheduled),
+        ('timers_overdue', "Timers échus pas encore réclamés", overdue),
+        ('timers_inflight', "Timers réclamés non acquittés", inflight),
+        ('event_log_length', "Entrées du journal events:log", logged),
+        ('sse_connections', "Connexions SSE ouvertes sur ce processus",
+         broadcaster.connection_count()),
+        ('position_buffer_pending', "Positions GPS en attente d'écriture",
+         len(position_buffer.pending)),
+    )
+    lines = []
+    for name, help_text, value in gauges:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+    lines += ["# HELP sse_resyncs_total Files SSE vidées et remplacées par un resync",
+              "# TYPE sse_resyncs_total counter", f"sse_resyncs_total {broadcaster.dropped}"]
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
 # ... (debug_timers, force_auto_assign, logout restent identiques)
 @app.route('/debug_timers')
 def debug_timers():
@@ -541,12 +2472,14 @@ def debug_timers():
     for key in r.keys("order_timer:*"):
         order_id = key.split(":")[1]
         timer_data = r.hgetall(key)
-        candidates = r.lrange(f"candidates:{order_id}", 0, -1)
+        candidates = r.zrevrange(f"candidates:{order_id}", 0, -1)
         order_data = r.hgetall(f"order:{order_id}")
         
         timers_info.append({
             'order_id': order_id,
             'timer': timer_data,
+            'scheduled': {timer_type: r.zscore("timers:due", f"{timer_type}:{order_id}")
+                          for timer_type in TIMER_HANDLERS},
             'candidates': candidates,
             'order_status': order_data.get('status') if order_data else 'unknown'
         })
@@ -557,7 +2490,7 @@ def debug_timers():
 def force_auto_assign(order_id):
     """Forcer l'attribution automatique (pour tests) en utilisant le score et la distance"""
     try:
-        candidates = r.lrange(f"candidates:{order_id}", 0, -1)
+        candidates = r.zrevrange(f"candidates:{order_id}", 0, -1)
         
         if not candidates:
             return {'status': 'error', 'message': 'Aucun candidat'}
@@ -567,74 +2500,16 @@ def force_auto_assign(order_id):
         if not order_data:
             return {'status': 'error', 'message': 'Commande non trouvée'}
 
-        # Récupérer les coordonnées du restaurant
-        resto_lon = order_data.get('restaurant_lon')
-        resto_lat = order_data.get('restaurant_lat') 
-        
-        # Calculer le meilleur livreur basé sur score et distance
-        best_livreur = None
-        best_combined_score = -1
-        
-        for candidate in candidates:
-            # Récupérer le score
-            driver_score = get_livreur_score(candidate)
-            
-            # Récupérer la position
-            driver_pos = r.hgetall(f"livreur:{candidate}:position")
-            
-            if driver_pos:
-                # Calculer la distance
-                distance = calculate_distance(
-                    resto_lon, resto_lat,
-                    driver_pos['longitude'], driver_pos['latitude']
-                )
-                
-                # Score combiné: (score^2) / (distance + 1)
-                combined_score = (driver_score ** 2) / (distance + 1)
-                
-                if combined_score > best_combined_score:
-                    best_combined_score = combined_score
-                    best_livreur = candidate
-            else:
-                # Si pas de position, utiliser seulement le score
-                if driver_score > best_combined_score:
-                    best_combined_score = driver_score
-                    best_livreur = candidate
-        
-        if best_livreur:
-            r.hset(f"order:{order_id}", "status", "assigned")
-            r.hset(f"order:{order_id}", "assigned_driver", best_livreur)
-            r.delete(f"candidates:{order_id}")
-            r.delete(f"order_timer:{order_id}")
-            
-            # Récupérer les infos pour le log/l'événement
-            driver_pos = r.hgetall(f"livreur:{best_livreur}:position")
-            distance_info = ""
-            final_driver_score = get_livreur_score(best_livreur)
-            
-            if driver_pos:
-                distance = calculate_distance(
-                    resto_lon, resto_lat,
-                    driver_pos['longitude'], driver_pos['latitude']
-                )
-                distance_info = f" (distance: {distance}km)"
-
-            publish_event('auto_assignment', {
-                'order_id': order_id,
-                'driver_id': best_livreur,
-                'score': final_driver_score,
-                'distance': distance_info
-            })
-            
-            print(f"🤖 [FORCE] Attribution: {order_id} -> {best_livreur}{distance_info}")
-
+        result = assign_best_candidate(order_id, order_data, candidates, "[FORCE] Attribution")
+        if result['status'] == 'success':
+            best = result['best']
             return {'status': 'success', 
-                    'assigned_to': best_livreur,
-                    'score': final_driver_score,
-                    'combined_score': best_combined_score
+                    'assigned_to': best['id'],
+                    'score': best['score'],
+                    'combined_score': best['combined_score']
                    }
         else:
-            return {'status': 'error', 'message': 'Aucun livreur valide'}
+            return {'status': 'error', 'message': result['message']}
             
     except Exception as e:
         return {'status': 'error', 'message': str(e)}
@@ -647,80 +2522,75 @@ def logout():
 
 
 def get_client_orders(username):
-    orders = []
-    for key in r.keys("order:*"):
-        order_data = r.hgetall(key)
-        if order_data.get('client') == username:
-            orders.append(order_data)
-    # CORRIGÉ: Ajout d'une valeur par défaut '' pour le tri
-    orders.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-    return orders
+    # L'index est déjà trié par date de création décroissante
+    return load_orders(r.zrevrange(f"orders:by_client:{username}", 0, -1), with_archive=True)
 
 # === FONCTION MODIFIÉE: Obtenir les commandes du restaurant ===
 def get_restaurant_orders(restaurant_id):
-    orders = []
-    for key in r.keys("order:*"):
-        order_data = r.hgetall(key)
-        # Filtre par restaurant ET par statut
-        if (order_data.get('restaurant') == restaurant_id and
-            order_data.get('status') in ['pending', 'ready', 'assigned']):
-            orders.append(order_data)
-    # CORRIGÉ: Ajout d'une valeur par défaut '' pour le tri
-    orders.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-    return orders
+    # Filtre par restaurant ET par statut via l'intersection des index
+    order_ids = get_indexed_order_ids(f"orders:by_restaurant:{restaurant_id}",
+                                      ['pending', 'ready', 'assigned'])
+    return load_orders(order_ids, with_timers=True, with_candidates=True)
 # ==========================================================
 
-def get_available_orders():
+def get_available_orders(livreur_id):
+    """Commandes proposées au livreur (ou ouvertes à tous), les plus récentes d'abord"""
+    pipe = r.pipeline(transaction=False)
+    pipe.smembers(f"driver_offers:{livreur_id}")
+    pipe.smembers(OPEN_OFFERS)
+    offered, open_offers = pipe.execute()
     orders = []
-    for key in r.keys("order:*"):
-        order_data = r.hgetall(key)
+    loaded = load_orders(offered | open_offers, with_timers=True)
+    loaded.sort(key=lambda order: order.get('created_at', ''), reverse=True)
+    for order_data in loaded:
         # Commandes prêtes et avec fenêtre d'acceptation active
-        timer_data = r.hgetall(f"order_timer:{order_data['id']}")
+        timer_data = order_data['timer']
         if (order_data.get('status') == 'ready' and 
             timer_data and timer_data.get('type') == 'acceptance_window'):
             orders.append(order_data)
+    # Offres restées après la fin de leur fenêtre (ou commandes disparues)
+    stale = (offered | open_offers) - {order_data['id'] for order_data in orders}
+    if stale:
+        pipe = r.pipeline(transaction=False)
+        if offered & stale:
+            pipe.srem(f"driver_offers:{livreur_id}", *(offered & stale))
+        if open_offers & stale:
+            pipe.srem(OPEN_OFFERS, *(open_offers & stale))
+        pipe.execute()
     return orders
 
 def get_my_interests(username):
-    interests = []
-    for key in r.keys("candidates:*"):
-        order_id = key.split(":")[1]
-        candidates = r.lrange(f"candidates:{order_id}", 0, -1)
-        if username in candidates:
-            order_data = r.hgetall(f"order:{order_id}")
-            if order_data:
-                interests.append(order_data)
-    return interests
+    """Commandes prêtes pour lesquelles le livreur s'est montré intéressé"""
+    interests_key = f"driver_interests:{username}"
+    order_ids = r.smembers(interests_key)
+    orders = [order_data for order_data in load_orders(order_ids)
+              if order_data.get('status') == 'ready']
+    # Commandes disparues ou sorties de l'état prêt sans nettoyage
+    stale = order_ids - {order_data['id'] for order_data in orders}
+    if stale:
+        r.srem(interests_key, *stale)
+    orders.sort(key=lambda order: order.get('created_at', ''), reverse=True)
+    return orders
 
 @app.route('/annuler_commande/<order_id>', methods=['POST'])
 def annuler_commande(order_id):
     try:
         username = session.get('username')
         
-        # Vérifier que la commande appartient bien au client
-        order_data = r.hgetall(f"order:{order_id}")
-        if not order_data:
-            return {'status': 'error', 'message': 'Commande non trouvée'}
-        
-        if order_data.get('client') != username:
-            return {'status': 'error', 'message': 'Vous ne pouvez pas annuler cette commande'}
-        
-        # Vérifier si un livreur est déjà assigné
-        if order_data.get('status') == 'assigned':
-            return {'status': 'error', 'message': 'Impossible d\'annuler: un livreur a déjà été assigné'}
-        
-        # Annuler la commande
-        r.hset(f"order:{order_id}", "status", "cancelled")
-        
-        # Supprimer les candidats et timers associés
-        r.delete(f"candidates:{order_id}")
-        r.delete(f"order_timer:{order_id}")
-        
-        publish_event('order_cancelled', {
-            'order_id': order_id,
-            'client': username,
-            'reason': 'Annulé par le client'
-        })
+        # Annuler la commande si elle appartient au client et n'est pas encore
+        # assignée, puis supprimer les candidats, offres et timers associés.
+        # Les livreurs à qui elle avait été proposée sont prévenus.
+        result = transition_order(
+            order_id, "cancelled", ["pending", "ready"], 'order_cancelled',
+            {'order_id': order_id, 'client': username, 'reason': 'Annulé par le client'},
+            owner_field='client', owner=username, cleanup=True,
+            notify_candidates=True, notify_offered=True)
+        if result['status'] != 'success':
+            if result['message'] == TRANSITION_ERRORS['forbidden']:
+                return {'status': 'error', 'message': 'Vous ne pouvez pas annuler cette commande'}
+            if result['current_status'] == 'assigned':
+                return {'status': 'error', 'message': 'Impossible d\'annuler: un livreur a déjà été assigné'}
+            return {'status': 'error', 'message': result['message']}
         
         print(f"❌ Commande {order_id} annulée par {username}")
         return {'status': 'success'}
@@ -760,8 +2630,9 @@ def noter_livreur(order_id):
             return {'status': 'error', 'message': 'Aucun livreur assigné à cette commande'}
         
         # Enregistrer la note
-        r.hset(f"order:{order_id}", "client_rating", note)
-        r.hset(f"order:{order_id}", "rated_at", datetime.now().isoformat())
+        rated_at = datetime.now().isoformat()
+        r.hset(f"order:{order_id}", mapping={"client_rating": note, "rated_at": rated_at})
+        order_data.update({"client_rating": str(note), "rated_at": rated_at})
         
         # Mettre à jour la note moyenne du livreur
         update_livreur_score(livreur_id, float(note))
@@ -770,8 +2641,9 @@ def noter_livreur(order_id):
             'order_id': order_id,
             'driver_id': livreur_id,
             'rating': note,
-            'client': username
-        })
+            'client': username,
+            'order': order_data
+        }, [client_channel(username), driver_channel(livreur_id), MANAGERS_CHANNEL])
         
         print(f"⭐ Livreur {livreur_id} noté {note}/5 pour la commande {order_id}")
         return {'status': 'success', 'message': f'Merci! Vous avez noté {livreur_id} avec {note} étoiles'}
@@ -840,26 +2712,270 @@ def get_livreur_stats(livreur_id):
 
 
 # Ajouter cette fonction pour calculer la distance
+# === Distances ===
+# Noyau NumPy: les entrées sont des floats ou des tableaux de floats (degrés),
+# combinés par broadcasting.
+EARTH_RADIUS_KM = 6371
+
+def haversine_km(lon1, lat1, lon2, lat2):
+    """Distance haversine en km, élément par élément"""
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+def distances_from(origin_lon, origin_lat, lons, lats):
+    """Distances (km) d'une origine vers N points"""
+    return haversine_km(origin_lon, origin_lat, np.asarray(lons, dtype=float),
+                        np.asarray(lats, dtype=float))
+
+def distance_matrix_km(origin_lon, origin_lat, dest_lon, dest_lat):
+    """Matrice M x N des distances (km) entre M origines et N destinations"""
+    return haversine_km(np.asarray(origin_lon, dtype=float)[:, np.newaxis],
+                        np.asarray(origin_lat, dtype=float)[:, np.newaxis],
+                        np.asarray(dest_lon, dtype=float)[np.newaxis, :],
+                        np.asarray(dest_lat, dtype=float)[np.newaxis, :])
+
 def calculate_distance(lon1, lat1, lon2, lat2):
     """Calcule la distance en km entre deux points GPS"""
     try:
-        from math import radians, sin, cos, sqrt, atan2
-        
-        # Convertir les degrés en radians
-        lon1, lat1, lon2, lat2 = map(radians, [float(lon1), float(lat1), float(lon2), float(lat2)])
-        
-        # Formule de Haversine
-        dlon = lon2 - lon1
-        dlat = lat2 - lat1
-        a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-        c = 2 * atan2(sqrt(a), sqrt(1-a))
-        radius_earth = 6371  # Rayon de la Terre en km
-        
-        return round(radius_earth * c, 2)
-    except Exception as e:
+        return round(float(haversine_km(float(lon1), float(lat1), float(lon2), float(lat2))), 2)
+    except (TypeError, ValueError) as e:
         print(f"Erreur calcul distance: {e}")
         return float('inf')
 
+# === Moteur d'attribution automatique ===
+def rank_candidates(order_data, candidates):
+    """Classe les candidats d'une commande, du meilleur au moins bon.
+
+    Positions (GEOPOS sur livreurs:positions) et notes (ZMSCORE) sont lues en
+    un seul pipeline. Score combiné: (note^2) / (distance + 1), ou la note
+    seule pour un livreur sans position connue. À égalité, le premier
+    candidat de la liste (le mieux noté de candidates:<id>) l'emporte.
+    """
+    candidates = list(dict.fromkeys(candidates))
+    if not candidates:
+        return []
+    
+    resto_lon = order_data.get('restaurant_lon') or '2.333'  # Default Paris
+    resto_lat = order_data.get('restaurant_lat') or '48.865'  # Default Paris
+    
+    pipe = r.pipeline(transaction=False)
+    pipe.geopos("livreurs:positions", *candidates)
+    pipe.zmscore("livreurs:scores", candidates)
+    positions, scores = pipe.execute()
+    
+    located = [position for position in positions if position]
+    distances = iter(np.round(distances_from(float(resto_lon), float(resto_lat),
+                                             [position[0] for position in located],
+                                             [position[1] for position in located]), 2))
+    
+    ranking = []
+    for candidate, position, score in zip(candidates, positions, scores):
+        driver_score = float(score) if score else 0.0
+        if position:
+            distance = float(next(distances))
+            combined_score = (driver_score ** 2) / (distance + 1)
+        else:
+            distance = None
+            combined_score = driver_score
+        ranking.append({
+            'id': candidate,
+            'score': driver_score,
+            'distance': distance,
+            'combined_score': combined_score
+        })
+    
+    ranking.sort(key=lambda c: c['combined_score'], reverse=True)
+    return ranking
+
+def match_orders(orders):
+    """Attribution globale de plusieurs commandes à leurs candidats.
+
+    `orders` est une liste de (order_id, order_data, candidates). Le score
+    combiné de chaque couple commande/candidat est calculé sur une matrice
+    NumPy, puis l'affectation maximisant la somme des scores est résolue
+    (algorithme hongrois, un livreur par commande). Un livreur qui a déjà une
+    commande assignée (orders:by_driver:<livreur> ∩ orders:by_status:assigned)
+    n'est pas retenu. Une commande dont tous les candidats sont pris, dans ce
+    tick ou par une livraison en cours, n'est pas attribuée: elle est absente
+    du résultat (auto_assign la reporte au tick suivant).
+    Retourne {order_id: entrée du classement (voir rank_candidates)}.
+    """
+    orders = [(order_id, order_data, list(dict.fromkeys(candidates)))
+              for order_id, order_data, candidates in orders if candidates]
+    if not orders:
+        return {}
+    drivers = list(dict.fromkeys(c for _, _, candidates in orders for c in candidates))
+    column = {driver: j for j, driver in enumerate(drivers)}
+    
+    pipe = r.pipeline(transaction=False)
+    pipe.geopos("livreurs:positions", *drivers)
+    pipe.zmscore("livreurs:scores", drivers)
+    for driver in drivers:
+        pipe.zinter([f"orders:by_driver:{driver}", "orders:by_status:assigned"])
+    positions, scores, *assigned = pipe.execute()
+    
+    busy = np.array([bool(order_ids) for order_ids in assigned])
+    has_position = np.array([position is not None for position in positions])
+    driver_lon = np.array([position[0] if position else 0.0 for position in positions])
+    driver_lat = np.array([position[1] if position else 0.0 for position in positions])
+    driver_score = np.array([float(score) if score else 0.0 for score in scores])
+    resto_lon = np.array([float(data.get('restaurant_lon') or 2.333) for _, data, _ in orders])
+    resto_lat = np.array([float(data.get('restaurant_lat') or 48.865) for _, data, _ in orders])
+    
+    # Score combiné: (note^2) / (distance + 1), ou la note seule sans position
+    distance = np.round(distance_matrix_km(resto_lon, resto_lat, driver_lon, driver_lat), 2)
+    benefit = np.where(has_position, driver_score ** 2 / (distance + 1), driver_score)
+    allowed = np.zeros(benefit.shape, dtype=bool)
+    for i, (_, _, candidates) in enumerate(orders):
+        allowed[i, [column[c] for c in candidates]] = True
+    allowed[:, busy] = False
+    if not allowed.any():
+        return {}
+    
+    # Les couples interdits ont un coût supérieur à toute affectation autorisée
+    forbidden_cost = benefit.max() * len(orders) + 1
+    rows, cols = linear_sum_assignment(np.where(allowed, -benefit, forbidden_cost))
+    chosen = {i: j for i, j in zip(rows, cols) if allowed[i, j]}
+    
+    matches = {}
+    for i, (order_id, _, candidates) in enumerate(orders):
+        if i not in chosen:
+            continue
+        j = chosen[i]
+        matches[order_id] = {
+            'id': drivers[j],
+            'score': float(driver_score[j]),
+            'distance': float(distance[i, j]) if has_position[j] else None,
+            'combined_score': float(benefit[i, j])
+        }
+    return matches
+
+def assign_best_candidate(order_id, order_data, candidates, log_label):
+    """Attribue la commande au meilleur candidat et notifie les intéressés.
+
+    Retourne {'status': 'success', 'best': <entrée du classement>} ou un dict
+    d'erreur (aucun candidat, commande déjà assignée ou annulée entre-temps).
+    """
+    ranking = rank_candidates(order_data, candidates)
+    if not ranking:
+        return {'status': 'error', 'message': 'Aucun livreur valide'}
+    return assign_candidate(order_id, ranking[0], log_label)
+
+def assign_candidate(order_id, best, log_label):
+    """Applique l'attribution d'une commande au candidat `best`"""
+    distance_info = f" (distance: {best['distance']}km)" if best['distance'] is not None else ""
+    result = transition_order(
+        order_id, "assigned", ["ready"], 'auto_assignment',
+        {'order_id': order_id, 'driver_id': best['id'], 'score': best['score'],
+         'distance': distance_info},
+        fields={"assigned_driver": best['id']}, cleanup=True,
+        notify_candidates=True, notify_assigned=True, notify_offered=True)
+    if result['status'] != 'success':
+        print(f"⚠️ {log_label} abandonnée pour {order_id}: {result['message']}")
+        return result
+    
+    print(f"🤖 {log_label}: {order_id} -> {best['id']}{distance_info}")
+    return {'status': 'success', 'best': best}
+
+# === Positions GPS des livreurs (écriture différée) ===
+POSITION_FLUSH_SECONDS = 0.5      # intervalle d'écriture des positions en attente
+POSITION_EVENT_MIN_KM = 0.05      # déplacement minimal pour notifier les managers
+POSITION_EVENT_MAX_SECONDS = 30   # ... sauf si la dernière notification est trop ancienne
+
+class PositionBuffer:
+    """Tampon des positions GPS: seule la dernière position de chaque livreur est gardée.
+
+    Un thread par processus écrit le tampon toutes les POSITION_FLUSH_SECONDS
+    en un seul pipeline (un GEOADD groupé, les HSET des positions, un ZADD
+    livreurs:last_seen) accompagné d'un unique événement positions_updated
+    limité aux livreurs qui ont réellement bougé. Une position peut donc
+    arriver dans Redis avec jusqu'à POSITION_FLUSH_SECONDS de retard.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = {}
+        self.notified = {}  # livreur -> (lon, lat, instant de la dernière notification)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, livreur_id, longitude, latitude):
+        with self._lock:
+            self.pending[livreur_id] = (longitude, latitude, datetime.now().isoformat())
+            if not self._thread or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='position-buffer',
+                                                daemon=True)
+                self._thread.start()
+
+    def get(self, livreur_id):
+        """Position pas encore écrite dans Redis, ou None"""
+        with self._lock:
+            return self.pending.get(livreur_id)
+
+    def flush(self):
+        """Écrit les positions en attente et retourne leur nombre"""
+        with self._lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return 0
+        
+        drivers = list(batch)
+        now = time.time()
+        pipe = r.pipeline(transaction=False)
+        geo_values = []
+        for livreur_id, (longitude, latitude, updated_at) in batch.items():
+            geo_values.extend((longitude, latitude, livreur_id))
+            pipe.hset(f"livreur:{livreur_id}:position", mapping={
+                "longitude": str(longitude),
+                "latitude": str(latitude),
+                "updated_at": updated_at
+            })
+        pipe.geoadd("livreurs:positions", geo_values)
+        pipe.zadd("livreurs:last_seen", {livreur_id: now for livreur_id in drivers})
+        
+        # Ne notifier que les livreurs qui ont bougé (ou pas notifiés depuis longtemps)
+        previous = [self.notified.get(livreur_id, (np.nan, np.nan, 0.0)) for livreur_id in drivers]
+        moved_km = haversine_km(np.array([p[0] for p in previous]),
+                                np.array([p[1] for p in previous]),
+                                np.array([batch[d][0] for d in drivers]),
+                                np.array([batch[d][1] for d in drivers]))
+        stale = now - np.array([p[2] for p in previous]) >= POSITION_EVENT_MAX_SECONDS
+        notify = [livreur_id for livreur_id, km, is_stale in zip(drivers, moved_km, stale)
+                  if is_stale or not km < POSITION_EVENT_MIN_KM]
+        if notify:
+            # Seuls les managers suivent les positions des livreurs
+            publish_event('positions_updated', {'positions': [
+                {'driver_id': livreur_id, 'longitude': batch[livreur_id][0],
+                 'latitude': batch[livreur_id][1]}
+                for livreur_id in notify
+            ]}, [MANAGERS_CHANNEL], pipe)
+        
+        try:
+            pipe.execute()
+        except redis.RedisError:
+            # Remettre en attente les positions qui n'ont pas été remplacées
+            with self._lock:
+                for livreur_id, position in batch.items():
+                    self.pending.setdefault(livreur_id, position)
+            raise
+        for livreur_id in notify:
+            self.notified[livreur_id] = (batch[livreur_id][0], batch[livreur_id][1], now)
+        return len(batch)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Erreur écriture des positions: {e}")
+
+position_buffer = PositionBuffer(POSITION_FLUSH_SECONDS)
+atexit.register(position_buffer.flush)
+
 # Ajouter cette route pour mettre à jour la position du livreur
 @app.route('/update_position', methods=['POST'])
 def update_position():
@@ -872,110 +2988,68 @@ def update_position():
         if not longitude or not latitude:
             return {'status': 'error', 'message': 'Coordonnées manquantes'}
         
-        # Stocker la position du livreur
-        r.geoadd("livreurs:positions", (longitude, latitude, livreur_id))
+        try:
+            longitude, latitude = float(longitude), float(latitude)
+        except (TypeError, ValueError):
+            return {'status': 'error', 'message': 'Coordonnées invalides'}
+        if not (-180 <= longitude <= 180 and -85.05112878 <= latitude <= 85.05112878):
+            return {'status': 'error', 'message': 'Coordonnées invalides'}
         
-        # Stocker aussi dans un hash pour récupération facile
-        r.hset(f"livreur:{livreur_id}:position", mapping={
-            "longitude": longitude,
-            "latitude": latitude,
-            "updated_at": datetime.now().isoformat()
-        })
-        
-        publish_event('position_updated', {
-            'driver_id': livreur_id,
-            'longitude': longitude,
-            'latitude': latitude
-        })
+        # La position est écrite dans Redis (GEO + hash) par le tampon
+        position_buffer.add(livreur_id, longitude, latitude)
         
         return {'status': 'success', 'message': 'Position mise à jour'}
         
     except Exception as e:
         return {'status': 'error', 'message': str(e)}
 
+AUTO_ASSIGN_RETRY_SECONDS = 15
+
 # Modifier la fonction d'attribution automatique pour utiliser la distance
 def schedule_auto_assignment(order_id, delay_seconds):
     """Programme l'attribution automatique après un délai"""
-    def auto_assign():
-        time.sleep(delay_seconds)
-        
-        # Vérifier si la commande existe toujours et n'est pas déjà assignée
-        order_data = r.hgetall(f"order:{order_id}")
-        if not order_data or order_data.get('status') != 'ready':
-            return
-            
-        candidates = r.lrange(f"candidates:{order_id}", 0, -1)
-        
-        if candidates:
-            # Récupérer les coordonnées du restaurant
-            resto_lon = order_data.get('restaurant_lon', '2.333')  # Default Paris
-            resto_lat = order_data.get('restaurant_lat', '48.865')  # Default Paris
-            
-            # Calculer le meilleur livreur basé sur score et distance
-            best_livreur = None
-            best_score = -1
-            
-            for candidate in candidates:
-                # Récupérer le score
-                driver_score = get_livreur_score(candidate)
-                
-                # Récupérer la position
-                driver_pos = r.hgetall(f"livreur:{candidate}:position")
-                if driver_pos:
-                    # Calculer la distance
-                    distance = calculate_distance(
-                        resto_lon, resto_lat,
-                        driver_pos['longitude'], driver_pos['latitude']
-                    )
-                    
-                    # Score combiné: (score^2) / (distance + 1)
-                    # On donne plus de poids au score et on évite la division par zéro
-                    combined_score = (driver_score ** 2) / (distance + 1)
-                    
-                    if combined_score > best_score:
-                        best_score = combined_score
-                        best_livreur = candidate
-                else:
-                    # Si pas de position, utiliser seulement le score
-                    if driver_score > best_score:
-                        best_score = driver_score
-                        best_livreur = candidate
-            
-            if best_livreur:
-                # Assigner la commande
-                r.hset(f"order:{order_id}", "status", "assigned")
-                r.hset(f"order:{order_id}", "assigned_driver", best_livreur)
-                r.delete(f"candidates:{order_id}")
-                r.delete(f"order_timer:{order_id}")
-                
-                # Récupérer les infos pour le log
-                driver_pos = r.hgetall(f"livreur:{best_livreur}:position")
-                distance_info = ""
-                if driver_pos:
-                    distance = calculate_distance(
-                        resto_lon, resto_lat,
-                        driver_pos['longitude'], driver_pos['latitude']
-                    )
-                    distance_info = f" (distance: {distance}km)"
-                
-                publish_event('auto_assignment', {
-                    'order_id': order_id,
-                    'driver_id': best_livreur,
-                    'score': get_livreur_score(best_livreur),
-                    'distance': distance_info
-                })
-                
-                print(f"🤖 Attribution automatique: {order_id} -> {best_livreur}{distance_info}")
+    schedule_timer('auto_assignment', order_id, delay_seconds)
+
+@timer_handler('auto_assignment', batch=True)
+def auto_assign(order_ids):
+    """Fin des fenêtres manager échues dans le même tick: attribution globale"""
+    pipe = r.pipeline(transaction=False)
+    for order_id in order_ids:
+        pipe.hgetall(f"order:{order_id}")
+        pipe.zrevrange(f"candidates:{order_id}", 0, -1)
+    results = pipe.execute()
+    
+    # Ignorer les commandes disparues ou déjà assignées
+    pending = [(order_id, order_data, candidates)
+               for order_id, order_data, candidates in zip(order_ids, results[::2], results[1::2])
+               if order_data.get('status') == 'ready' and candidates]
     
-    thread = threading.Thread(target=auto_assign, daemon=True)
-    thread.start()
+    matches = match_orders(pending)
+    for order_id, best in matches.items():
+        assign_candidate(order_id, best, "Attribution automatique")
+    
+    # Tous les candidats sont pris (par une autre commande de ce tick ou une
+    # livraison en cours): ne pas donner deux commandes au même livreur,
+    # réessayer au tick suivant (le manager peut toujours choisir entre-temps)
+    for order_id, _, _ in pending:
+        if order_id not in matches:
+            AUTO_ASSIGNMENTS_DEFERRED.inc()
+            schedule_auto_assignment(order_id, AUTO_ASSIGN_RETRY_SECONDS)
+            print(f"⏳ Attribution automatique reportée pour {order_id}: candidats déjà attribués")
 
 # Ajouter une route pour récupérer la position actuelle
 @app.route('/get_my_position')
 def get_my_position():
     try:
         livreur_id = session.get('username')
-        position = r.hgetall(f"livreur:{livreur_id}:position")
+        pending = position_buffer.get(livreur_id)
+        if pending:
+            # Position reçue mais pas encore écrite dans Redis
+            longitude, latitude, updated_at = pending
+            position = {'longitude': str(longitude), 'latitude': str(latitude),
+                        'updated_at': updated_at}
+        else:
+            position = r.hgetall(f"livreur:{livreur_id}:position")
         
         if position:
             return {
@@ -990,25 +3064,7 @@ def get_my_position():
     except Exception as e:
         return {'status': 'error', 'message': str(e)}
 
-
-@app.context_processor
-def utility_processor():
-    def has_candidates(order_id):
-        return r.llen(f"candidates:{order_id}") > 0
-    
-    def get_candidates_count(order_id):
-        return r.llen(f"candidates:{order_id}")
-    
-    def get_timer_data(order_id):
-        return r.hgetall(f"order_timer:{order_id}")
-    
-    return {
-        'has_candidates': has_candidates,
-        'get_candidates_count': get_candidates_count,
-        'get_timer_data': get_timer_data
-    }
-
 if __name__ == '__main__':
-    with app.app_context():
-        init_test_users()
+    # Développement: un seul processus (en production: gunicorn -c gunicorn.conf.py wsgi:app)
+    start_background_duties()
     app.run(debug=True, port=5000, threaded=True)
@@ -0,0 +1,179 @@
+"""Benchmark de l'archivage des commandes terminées: mémoire par commande et historique paginé.
+
+Crée --orders commandes livrées ou annulées (hashes order:<id> indexés),
+mesure la mémoire Redis par commande (INFO memory), les archive toutes, puis
+mesure à nouveau la mémoire ainsi que les allers-retours et la latence d'une
+page d'historique client avant et après archivage. Vérifie aussi qu'une
+commande archivée se relit à l'identique.
+
+Sans INFO/MEMORY (serveurs de test), la mémoire est estimée par la taille
+des champs et valeurs stockés.
+
+Usage:
+    python bench_archive.py --orders 50000 --clients 500 --redis-url redis://localhost:6379/15
+
+ATTENTION: la base Redis ciblée est vidée (FLUSHDB) avant et après le benchmark.
+"""
+import argparse
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import redis
+
+import app_redis
+
+DISHES = ("Pizza", "Burger", "Salade", "Pâtes", "Sushi", "Tacos", "Curry", "Boisson")
+
+
+def make_order(now, n_clients, n_restaurants, n_livreurs):
+    """Commande terminée réaliste, créée dans les 60 derniers jours"""
+    items = random.sample(DISHES, random.randint(1, 3))
+    status = random.choice(('delivered', 'delivered', 'delivered', 'cancelled'))
+    restaurant = random.randint(1, n_restaurants)
+    created_at = now - timedelta(days=random.uniform(1, 60))
+    order = {
+        "id": uuid.uuid4().hex[:8],
+        "client": f"client{random.randint(1, n_clients)}",
+        "restaurant": f"restaurant{restaurant}",
+        "restaurant_name": f"Restaurant {restaurant}",
+        "restaurant_lon": f"{2.25 + random.random() * 0.2:.6f}",
+        "restaurant_lat": f"{48.80 + random.random() * 0.1:.6f}",
+        "articles": ", ".join(f"{random.randint(1, 3)}x {item}" for item in items),
+        "total_price": f"{random.uniform(8, 60):.1f}",
+        "status": status,
+        "created_at": created_at.isoformat()
+    }
+    if status == 'delivered':
+        order["assigned_driver"] = f"livreur{random.randint(1, n_livreurs)}"
+        if random.random() < 0.6:
+            order["client_rating"] = str(random.randint(1, 5))
+            order["rated_at"] = (created_at + timedelta(minutes=50)).isoformat()
+    return order
+
+
+def seed(r, n_orders, n_clients, n_restaurants, n_livreurs):
+    now = datetime.now()
+    orders = []
+    pipe = r.pipeline(transaction=False)
+    for i in range(n_orders):
+        order = make_order(now, n_clients, n_restaurants, n_livreurs)
+        orders.append(order)
+        pipe.hset(f"order:{order['id']}", mapping=order)
+        app_redis.index_order(order, pipe)
+        if i % 1000 == 999:
+            pipe.execute()
+    pipe.execute()
+    return orders
+
+
+def used_memory(r):
+    """Mémoire utilisée par Redis (octets), ou None si INFO n'est pas disponible"""
+    try:
+        return r.info('memory')['used_memory']
+    except redis.ResponseError:
+        return None
+
+
+# Estimations sans INFO: octets des noms et valeurs stockés, par commande
+def hot_payload(r, orders):
+    pipe = r.pipeline(transaction=False)
+    for order in orders:
+        pipe.hgetall(f"order:{order['id']}")
+    return sum(len(f"order:{order['id']}") +
+               sum(len(field.encode()) + len(value.encode()) for field, value in data.items())
+               for order, data in zip(orders, pipe.execute())) / len(orders)
+
+
+def archive_payload(orders):
+    archived = app_redis.load_archived_orders(order['id'] for order in orders)
+    return sum(len(order_id) + len(app_redis.pack_order(data).encode())
+               for order_id, data in archived.items()) / len(orders)
+
+
+def measure(fn, iterations):
+    """Retourne (allers-retours par appel, latence moyenne en ms)"""
+    fn()
+    app_redis.reset_redis_calls()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.perf_counter() - start
+    return app_redis.redis_calls_count() / iterations, elapsed / iterations * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15')
+    parser.add_argument('--orders', type=int, default=50000)
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--restaurants', type=int, default=200)
+    parser.add_argument('--livreurs', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    pool = redis.ConnectionPool.from_url(args.redis_url, decode_responses=True,
+                                         connection_class=app_redis.CountingConnection)
+    r = redis.Redis(connection_pool=pool)
+    app_redis.r = r
+
+    r.flushdb()
+    try:
+        baseline = used_memory(r)
+        print(f"Préparation de {args.orders} commandes terminées...")
+        orders = seed(r, args.orders, args.clients, args.restaurants, args.livreurs)
+        hot_memory = used_memory(r)
+        sample = random.sample(orders, min(2000, len(orders)))
+        hot_estimate = hot_payload(r, sample) if baseline is None else None
+        client = orders[0]['client']
+        index_key = f"orders:by_client:{client}"
+        last_page = max(0, (r.zcard(index_key) - 1) // app_redis.HISTORY_PAGE_SIZE)
+        history_before = [measure(lambda page=page: app_redis.get_order_history(index_key, page),
+                                  args.iterations) for page in (0, last_page)]
+
+        app_redis.reset_redis_calls()
+        start = time.perf_counter()
+        archived = app_redis.archive_orders(older_than=0)
+        archive_seconds = time.perf_counter() - start
+        archive_calls = app_redis.redis_calls_count()
+        archive_memory = used_memory(r)
+        print(f"✅ {archived} commandes archivées en {archive_seconds:.1f}s "
+              f"({archived / archive_seconds:.0f}/s, {archive_calls} allers-retours)\n")
+
+        if baseline is not None:
+            hot = (hot_memory - baseline) / args.orders
+            cold = (archive_memory - baseline) / args.orders
+            method = "INFO used_memory, index compris"
+        else:
+            hot, cold = hot_estimate, archive_payload(sample)
+            method = "estimation: octets stockés, hors index"
+        print(f"Mémoire par commande ({method})")
+        print(f"   hash order:<id>      {hot:>8.0f} o")
+        print(f"   archive par jour     {cold:>8.0f} o   (÷{hot / cold:.1f})\n")
+
+        history_after = [measure(lambda page=page: app_redis.get_order_history(index_key, page),
+                                 args.iterations) for page in (0, last_page)]
+        print(f"Historique de {client} ({r.zcard(index_key)} commandes, "
+              f"{app_redis.HISTORY_PAGE_SIZE} par page)")
+        print(f"{'page':<14}{'A/R chaud':>12}{'A/R archive':>14}{'ms chaud':>12}{'ms archive':>12}")
+        for label, (rt_hot, ms_hot), (rt_cold, ms_cold) in zip(
+                ('première', 'dernière'), history_before, history_after):
+            print(f"{label:<14}{rt_hot:>12.0f}{rt_cold:>14.0f}{ms_hot:>12.2f}{ms_cold:>12.2f}")
+
+        # Relecture à l'identique
+        restored = app_redis.load_archived_orders(order['id'] for order in sample)
+        ok = (archived == len(orders) and not r.exists(*(f"order:{o['id']}" for o in sample))
+              and all(restored.get(order['id']) == order for order in sample))
+    finally:
+        r.flushdb()
+
+    if not ok:
+        print("\n❌ Archive incomplète ou commandes relues différentes")
+        sys.exit(1)
+    print("\n✅ Commandes archivées relues à l'identique")
+
+
+if __name__ == '__main__':
+    main()
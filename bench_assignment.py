@@ -0,0 +1,111 @@
+"""Micro-benchmark du classement des candidats pour l'attribution automatique.
+
+Compare l'ancienne boucle (ZSCORE + HGETALL de la position par candidat, puis
+relecture pour le gagnant) au moteur actuel (GEOPOS + ZMSCORE en un pipeline)
+pour 10, 100 et 1 000 candidats.
+
+Usage:
+    python bench_assignment.py --sizes 10 100 1000 --redis-url redis://localhost:6379/15
+
+ATTENTION: la base Redis ciblée est vidée (FLUSHDB) avant et après le benchmark.
+"""
+import argparse
+import random
+import time
+
+import redis
+
+import app_redis
+
+RESTAURANT = {"restaurant_lon": "2.333", "restaurant_lat": "48.865"}
+
+
+# === Ancienne implémentation (une lecture par candidat) ===
+def legacy_best_candidate(r, order_data, candidates):
+    resto_lon = order_data.get('restaurant_lon', '2.333')
+    resto_lat = order_data.get('restaurant_lat', '48.865')
+    best_livreur = None
+    best_score = -1
+    for candidate in candidates:
+        score = r.zscore("livreurs:scores", candidate)
+        driver_score = float(score) if score else 0.0
+        driver_pos = r.hgetall(f"livreur:{candidate}:position")
+        if driver_pos:
+            distance = app_redis.calculate_distance(resto_lon, resto_lat,
+                                                    driver_pos['longitude'],
+                                                    driver_pos['latitude'])
+            combined_score = (driver_score ** 2) / (distance + 1)
+            if combined_score > best_score:
+                best_score = combined_score
+                best_livreur = candidate
+        elif driver_score > best_score:
+            best_score = driver_score
+            best_livreur = candidate
+    # Relecture pour le log et l'événement
+    r.hgetall(f"livreur:{best_livreur}:position")
+    r.zscore("livreurs:scores", best_livreur)
+    return best_livreur
+
+
+def seed(r, n_livreurs):
+    """Crée des livreurs notés, dont 90% ont une position autour de Paris"""
+    pipe = r.pipeline(transaction=False)
+    livreurs = [f"livreur{i}" for i in range(1, n_livreurs + 1)]
+    for livreur in livreurs:
+        pipe.zadd("livreurs:scores", {livreur: round(random.uniform(3, 5), 2)})
+        if random.random() < 0.9:
+            lon = 2.25 + random.random() * 0.2
+            lat = 48.80 + random.random() * 0.1
+            pipe.geoadd("livreurs:positions", (lon, lat, livreur))
+            pipe.hset(f"livreur:{livreur}:position", mapping={
+                "longitude": lon, "latitude": lat})
+    pipe.execute()
+    return livreurs
+
+
+def measure(fn, iterations):
+    """Retourne (allers-retours par appel, latence moyenne en ms)"""
+    fn()  # échauffement (connexions du pool)
+    app_redis.reset_redis_calls()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.perf_counter() - start
+    return app_redis.redis_calls_count() / iterations, elapsed * 1000 / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    pool = redis.ConnectionPool.from_url(args.redis_url, decode_responses=True,
+                                         connection_class=app_redis.CountingConnection)
+    r = redis.Redis(connection_pool=pool)
+    app_redis.r = r
+
+    r.flushdb()
+    livreurs = seed(r, max(args.sizes))
+
+    print(f"\n{'Candidats':<12}{'A/R avant':>12}{'A/R après':>12}{'ms avant':>12}{'ms après':>12}")
+    try:
+        for size in args.sizes:
+            candidates = random.sample(livreurs, size)
+            legacy = legacy_best_candidate(r, RESTAURANT, candidates)
+            current = app_redis.rank_candidates(RESTAURANT, candidates)[0]['id']
+            if legacy != current:
+                print(f"⚠️ Résultats différents pour {size} candidats: {legacy} / {current}")
+            rt_before, ms_before = measure(
+                lambda: legacy_best_candidate(r, RESTAURANT, candidates), args.iterations)
+            rt_after, ms_after = measure(
+                lambda: app_redis.rank_candidates(RESTAURANT, candidates), args.iterations)
+            print(f"{size:<12}{rt_before:>12.0f}{rt_after:>12.0f}"
+                  f"{ms_before:>12.2f}{ms_after:>12.2f}")
+    finally:
+        r.flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""Micro-benchmark des tableaux de bord: allers-retours Redis et latence par rôle.
+
+Compare, pour chaque rôle, l'ancien chargement (KEYS order:* puis un HGETALL par
+commande) au chargement actuel (index secondaires + pipeline).
+
+Usage:
+    python bench_dashboard.py --orders 5000 --redis-url redis://localhost:6379/15
+
+ATTENTION: la base Redis ciblée est vidée (FLUSHDB) avant et après le benchmark.
+"""
+import argparse
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import redis
+
+import app_redis
+
+
+class RoundTripCounter:
+    """Compte les allers-retours réseau (un envoi = un aller-retour)"""
+    round_trips = 0
+
+    def send_packed_command(self, command, check_health=True):
+        RoundTripCounter.round_trips += 1
+        return super().send_packed_command(command, check_health)
+
+
+class CountingConnection(RoundTripCounter, redis.Connection):
+    pass
+
+
+# === Anciennes implémentations (avant index et pipeline) ===
+def legacy_client_orders(r, username):
+    orders = []
+    for key in r.keys("order:*"):
+        order_data = r.hgetall(key)
+        if order_data.get('client') == username:
+            orders.append(order_data)
+    orders.sort(key=lambda x: x.get('created_at', ''), reverse=True)
+    return orders
+
+def legacy_restaurant_orders(r, restaurant_id):
+    orders = []
+    for key in r.keys("order:*"):
+        order_data = r.hgetall(key)
+        if (order_data.get('restaurant') == restaurant_id and
+            order_data.get('status') in ['pending', 'ready', 'assigned']):
+            orders.append(order_data)
+    orders.sort(key=lambda x: x.get('created_at', ''), reverse=True)
+    return orders
+
+def legacy_livreur_dashboard(r, livreur_id):
+    available = []
+    assigned = []
+    for key in r.keys("order:*"):
+        order_data = r.hgetall(key)
+        timer_data = r.hgetall(f"order_timer:{order_data['id']}")
+        if (order_data.get('status') == 'ready' and
+            timer_data and timer_data.get('type') == 'acceptance_window'):
+            available.append(order_data)
+        if (order_data.get('assigned_driver') == livreur_id and
+            order_data.get('status') == 'assigned'):
+            assigned.append(order_data)
+    interests = []
+    for key in r.keys("candidates:*"):
+        order_id = key.split(":")[1]
+        if livreur_id in r.zrange(f"candidates:{order_id}", 0, -1):
+            interests.append(r.hgetall(f"order:{order_id}"))
+    return available, interests, assigned
+
+def legacy_manager_orders(r):
+    orders = [r.hgetall(key) for key in r.keys("order:*")]
+    orders.sort(key=lambda x: x.get('id'), reverse=True)
+    return orders
+
+
+# === Implémentations actuelles ===
+def current_livreur_dashboard(livreur_id):
+    return (app_redis.get_available_orders(livreur_id),
+            app_redis.get_my_interests(livreur_id),
+            app_redis.get_assigned_orders_for_livreur(livreur_id))
+
+
+def seed(r, n_orders, n_clients, n_restaurants, n_livreurs):
+    """Crée des commandes synthétiques réparties sur tous les statuts"""
+    now = datetime.now()
+    statuses = ['pending', 'ready', 'assigned', 'delivered', 'delivered',
+                'delivered', 'cancelled']
+    pipe = r.pipeline(transaction=False)
+    for i in range(n_orders):
+        order_id = uuid.uuid4().hex[:8]
+        status = random.choice(statuses)
+        order = {
+            "id": order_id,
+            "client": f"client{random.randint(1, n_clients)}",
+            "restaurant": f"restaurant{random.randint(1, n_restaurants)}",
+            "restaurant_name": "Restaurant",
+            "restaurant_lon": "2.333",
+            "restaurant_lat": "48.865",
+            "articles": "1x Pizza, 1x Boisson",
+            "total_price": 15.0,
+            "status": status,
+            "created_at": (now - timedelta(minutes=n_orders - i)).isoformat()
+        }
+        if status in ('assigned', 'delivered'):
+            order["assigned_driver"] = f"livreur{random.randint(1, n_livreurs)}"
+        pipe.hset(f"order:{order_id}", mapping=order)
+        app_redis.index_order(order, pipe)
+        if status == 'ready':
+            pipe.hset(f"order_timer:{order_id}", mapping={
+                "type": "acceptance_window",
+                "deadline_ms": app_redis.deadline_ms(60),
+                "status": "active"
+            })
+            offered = {f"livreur{random.randint(1, n_livreurs)}" for _ in range(app_redis.DISPATCH_K)}
+            pipe.sadd(f"offers:{order_id}", *offered)
+            for livreur in offered:
+                pipe.sadd(f"driver_offers:{livreur}", order_id)
+            for livreur in random.sample(sorted(offered), 3):
+                pipe.zadd(f"candidates:{order_id}", {livreur: random.uniform(3, 5)})
+                pipe.sadd(f"driver_interests:{livreur}", order_id)
+        if i % 500 == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def measure(fn, iterations):
+    """Retourne (allers-retours par appel, latence moyenne en ms)"""
+    fn()  # échauffement (connexions du pool)
+    RoundTripCounter.round_trips = 0
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.perf_counter() - start
+    return RoundTripCounter.round_trips / iterations, elapsed * 1000 / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15')
+    parser.add_argument('--orders', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--restaurants', type=int, default=20)
+    parser.add_argument('--livreurs', type=int, default=30)
+    parser.add_argument('--iterations', type=int, default=5)
+    args = parser.parse_args()
+
+    pool = redis.ConnectionPool.from_url(args.redis_url, decode_responses=True,
+                                         connection_class=CountingConnection)
+    r = redis.Redis(connection_pool=pool)
+    app_redis.r = r
+
+    r.flushdb()
+    print(f"Préparation de {args.orders} commandes...")
+    seed(r, args.orders, args.clients, args.restaurants, args.livreurs)
+
+    scenarios = [
+        ("client",
+         lambda: legacy_client_orders(r, "client1"),
+         lambda: app_redis.get_client_orders("client1")),
+        ("restaurant",
+         lambda: legacy_restaurant_orders(r, "restaurant1"),
+         lambda: app_redis.get_restaurant_orders("restaurant1")),
+        ("livreur",
+         lambda: legacy_livreur_dashboard(r, "livreur1"),
+         lambda: current_livreur_dashboard("livreur1")),
+        ("manager",
+         lambda: legacy_manager_orders(r),
+         lambda: app_redis.get_all_orders_with_details()),
+    ]
+
+    print(f"\n{'Rôle':<12}{'A/R avant':>12}{'A/R après':>12}{'ms avant':>12}{'ms après':>12}")
+    try:
+        for role, before, after in scenarios:
+            rt_before, ms_before = measure(before, args.iterations)
+            rt_after, ms_after = measure(after, args.iterations)
+            print(f"{role:<12}{rt_before:>12.0f}{rt_after:>12.0f}"
+                  f"{ms_before:>12.1f}{ms_after:>12.1f}")
+    finally:
+        r.flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Benchmark du noyau de distances NumPy contre l'ancien calcul point par point.
+
+Pour chaque taille, compare l'ancienne fonction scalaire (imports math,
+conversions float() et try/except à chaque appel) à distances_from (une
+origine vers N livreurs) et à distance_matrix_km (M x N). Vérifie que les
+résultats arrondis au centième concordent et que l'accélération atteint le
+minimum demandé; le code de sortie est non nul sinon.
+
+Usage:
+    python bench_distance.py --sizes 10 100 1000 10000 --min-speedup 5
+"""
+import argparse
+import random
+import sys
+import time
+
+import numpy as np
+
+import app_redis
+
+
+# === Ancienne implémentation (un couple de points par appel) ===
+def legacy_calculate_distance(lon1, lat1, lon2, lat2):
+    try:
+        from math import radians, sin, cos, sqrt, atan2
+
+        lon1, lat1, lon2, lat2 = map(radians, [float(lon1), float(lat1), float(lon2), float(lat2)])
+        dlon = lon2 - lon1
+        dlat = lat2 - lat1
+        a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
+        c = 2 * atan2(sqrt(a), sqrt(1-a))
+        return round(6371 * c, 2)
+    except Exception as e:
+        print(f"Erreur calcul distance: {e}")
+        return float('inf')
+
+
+def random_points(n):
+    """Points aléatoires autour de Paris, en chaînes comme dans Redis"""
+    return ([str(2.25 + random.random() * 0.2) for _ in range(n)],
+            [str(48.80 + random.random() * 0.1) for _ in range(n)])
+
+
+def best_time(fn, repeat):
+    """Meilleur temps (s) sur `repeat` exécutions"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--origins', type=int, default=100,
+                        help="nombre d'origines pour la matrice M x N")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-speedup', type=float, default=5.0,
+                        help="accélération minimale exigée à partir de 1 000 points")
+    args = parser.parse_args()
+
+    failures = []
+    origin_lon, origin_lat = 2.333, 48.865
+    print(f"{'Points':<10}{'ms scalaire':>14}{'ms 1 x N':>12}{'x':>8}"
+          f"{'ms M x N':>12}{'x':>8}{'écart max':>12}")
+    for size in args.sizes:
+        lons, lats = random_points(size)
+        lon_array = np.array(lons, dtype=float)
+        lat_array = np.array(lats, dtype=float)
+        m_lons, m_lats = random_points(args.origins)
+
+        # Concordance avec l'ancienne fonction, arrondie au centième
+        expected = np.array([legacy_calculate_distance(origin_lon, origin_lat, lon, lat)
+                             for lon, lat in zip(lons, lats)])
+        actual = np.round(app_redis.distances_from(origin_lon, origin_lat, lon_array, lat_array), 2)
+        max_gap = float(np.max(np.abs(expected - actual)))
+        if max_gap > 0.01:
+            failures.append(f"{size} points: écart {max_gap:.4f} km")
+        scalar = [app_redis.calculate_distance(origin_lon, origin_lat, lon, lat)
+                  for lon, lat in zip(lons[:10], lats[:10])]
+        if scalar != list(expected[:10]):
+            failures.append(f"{size} points: calculate_distance diffère de l'ancienne fonction")
+
+        legacy_time = best_time(lambda: [legacy_calculate_distance(origin_lon, origin_lat, lon, lat)
+                                         for lon, lat in zip(lons, lats)], args.repeat)
+        vector_time = best_time(lambda: app_redis.distances_from(origin_lon, origin_lat,
+                                                                 lon_array, lat_array), args.repeat)
+        m_lon_array = np.array(m_lons, dtype=float)
+        m_lat_array = np.array(m_lats, dtype=float)
+        legacy_matrix_time = legacy_time * args.origins
+        matrix_time = best_time(lambda: app_redis.distance_matrix_km(m_lon_array, m_lat_array,
+                                                                     lon_array, lat_array), args.repeat)
+
+        speedup = legacy_time / vector_time
+        matrix_speedup = legacy_matrix_time / matrix_time
+        print(f"{size:<10}{legacy_time * 1000:>14.2f}{vector_time * 1000:>12.3f}{speedup:>8.0f}"
+              f"{matrix_time * 1000:>12.2f}{matrix_speedup:>8.0f}{max_gap:>12.3f}")
+        if size >= 1000 and speedup < args.min_speedup:
+            failures.append(f"{size} points: accélération {speedup:.1f}x < {args.min_speedup}x")
+
+    if failures:
+        print("\n❌ " + "\n❌ ".join(failures))
+        sys.exit(1)
+    print("\n✅ Résultats identiques au centième près, accélération conforme")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Test de charge des événements temps réel: octets poussés par client connecté.
+
+Simule des connexions SSE pour chaque rôle (abonnées via le broadcaster de
+l'application), joue des cycles de vie complets de commandes à travers les
+routes Flask, puis compare les octets reçus par connexion avec ce qu'aurait
+reçu chaque connexion si tous les événements étaient diffusés à tout le monde.
+
+Usage:
+    python bench_events.py --clients 200 --livreurs 100 --orders 100
+
+ATTENTION: la base Redis ciblée est vidée (FLUSHDB) avant et après le benchmark.
+"""
+import argparse
+import hashlib
+import random
+import time
+from collections import defaultdict
+
+import redis
+
+import app_redis
+
+PASSWORD = '123456'
+
+
+def create_users(r, role, names):
+    password_hash = hashlib.sha256(PASSWORD.encode()).hexdigest()
+    r.hset("users", mapping={name: f"{password_hash}:{role}" for name in names})
+
+
+def login(username, role):
+    client = app_redis.app.test_client()
+    response = client.post('/login', data={'username': username, 'password': PASSWORD,
+                                           'role': role})
+    if response.status_code != 302:
+        raise RuntimeError(f"Connexion impossible pour {username}")
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--restaurants', type=int, default=20)
+    parser.add_argument('--livreurs', type=int, default=100)
+    parser.add_argument('--managers', type=int, default=2)
+    parser.add_argument('--orders', type=int, default=100)
+    parser.add_argument('--pings', type=int, default=5,
+                        help="mises à jour GPS par livreur")
+    args = parser.parse_args()
+
+    r = redis.Redis.from_url(args.redis_url, decode_responses=True)
+    app_redis.r = r
+    app_redis.SSE_QUEUE_SIZE = 10 ** 6  # ne rien perdre pendant la mesure
+    r.flushdb()
+
+    users = {
+        'client': [f"client{i}" for i in range(1, args.clients + 1)],
+        'restaurant': [f"restaurant{i}" for i in range(1, args.restaurants + 1)],
+        'livreur': [f"livreur{i}" for i in range(1, args.livreurs + 1)],
+        'manager': [f"manager{i}" for i in range(1, args.managers + 1)],
+    }
+    for role, names in users.items():
+        create_users(r, role, names)
+    for name in users['restaurant']:
+        r.hset(f"restaurant:info:{name}", mapping={"name": name, "lon": "2.333",
+                                                   "lat": "48.865"})
+
+    # Connexions SSE simulées: une file par utilisateur
+    connections = {(role, name): app_redis.broadcaster.subscribe(
+                       app_redis.channels_for_session(role, name))
+                   for role, names in users.items() for name in names}
+
+    time.sleep(0.5)  # laisser le broadcaster s'abonner
+
+    sessions = {(role, name): login(name, role)
+                for role, names in users.items() for name in names}
+
+    print(f"Simulation de {args.orders} commandes et "
+          f"{args.livreurs * args.pings} positions GPS...")
+    start = time.perf_counter()
+    for livreur in users['livreur']:
+        for _ in range(args.pings):
+            sessions[('livreur', livreur)].post('/update_position', json={
+                'longitude': str(2.3 + random.random() / 10),
+                'latitude': str(48.8 + random.random() / 10)})
+    app_redis.position_buffer.flush()
+
+    for _ in range(args.orders):
+        client = random.choice(users['client'])
+        restaurant = random.choice(users['restaurant'])
+        order_id = sessions[('client', client)].post('/passer_commande', json={
+            'restaurant_id': restaurant,
+            'items': [{'item': 'Pizza', 'quantity': 1, 'price': 12.0}]}).get_json()['order_id']
+        sessions[('restaurant', restaurant)].post(f'/marquer_prete/{order_id}')
+        # Seuls les livreurs à qui la commande a été proposée peuvent candidater
+        offered = sorted(r.smembers(f"offers:{order_id}")) or users['livreur']
+        interested = random.sample(offered, min(3, len(offered)))
+        for livreur in interested:
+            sessions[('livreur', livreur)].post(f'/montrer_interet/{order_id}')
+        manager = random.choice(users['manager'])
+        sessions[('manager', manager)].post(f'/choisir_livreur/{order_id}/{interested[0]}')
+        sessions[('livreur', interested[0])].post(f'/marquer_livree/{order_id}')
+    elapsed = time.perf_counter() - start
+    time.sleep(1)  # laisser les derniers messages arriver
+
+    # Chaque événement publié est horodaté: les messages distincts reçus
+    # constituent la référence « diffusion à tous »
+    received = defaultdict(list)
+    published = set()
+    for (role, _), subscriber in connections.items():
+        total = 0
+        while not subscriber.empty():
+            message = subscriber.get_nowait()
+            published.add(message)
+            total += len(app_redis.sse_frame(message))
+        received[role].append(total)
+
+    broadcast_bytes = sum(len(app_redis.sse_frame(message)) for message in published)
+    print(f"{len(published)} événements publiés en {elapsed:.1f}s, "
+          f"{len(connections)} connexions\n")
+    print(f"{'Rôle':<12}{'connexions':>12}{'Ko/connexion':>16}{'Ko si diffusion':>18}")
+    for role, sizes in received.items():
+        print(f"{role:<12}{len(sizes):>12}{sum(sizes) / len(sizes) / 1024:>16.1f}"
+              f"{broadcast_bytes / 1024:>18.1f}")
+    total_targeted = sum(sum(sizes) for sizes in received.values())
+    print(f"\nTotal poussé: {total_targeted / 1024:.0f} Ko "
+          f"(diffusion à tous: {broadcast_bytes * len(connections) / 1024:.0f} Ko)")
+
+    r.flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""Benchmark de l'import des données de test, avec générateur de données synthétiques.
+
+Génère un fichier au format de donnees_fusionnees_avec_menus.json (écrit au
+fil de l'eau), l'importe avec l'import par lots pipelinés, le réimporte pour
+vérifier l'idempotence (aucune nouvelle écriture) en mesurant le pic mémoire,
+et, avec --with-legacy, le compare à l'ancien init_test_users (json.load puis
+HEXISTS/EXISTS et écritures entité par entité).
+
+Usage:
+    python bench_import.py --users 200000 --livreurs 20000 --restaurants 50000
+    python bench_import.py --users 20000 --restaurants 5000 --with-legacy
+    python bench_import.py --restaurants 50000 --generate-only donnees.json
+
+ATTENTION: la base Redis ciblée est vidée (FLUSHDB) avant et après le benchmark.
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import redis
+
+import app_redis
+
+DISHES = ("Pizza", "Burger", "Salade", "Pâtes", "Sushi", "Tacos", "Curry", "Boisson",
+          "Dessert", "Soupe", "Wrap", "Poke")
+
+
+def write_section(f, name, items):
+    f.write(f'  "{name}": [')
+    for i, item in enumerate(items):
+        f.write(',\n    ' if i else '\n    ')
+        f.write(json.dumps(item, ensure_ascii=False))
+    f.write('\n  ]')
+
+
+def generate_dataset(path, n_users, n_livreurs, n_restaurants, menu_items):
+    """Écrit un jeu de données synthétique sans le construire en mémoire"""
+    password_hash = hashlib.sha256(b'123456').hexdigest()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{\n')
+        write_section(f, 'utilisateurs', (
+            {"username": f"client{i}", "password_hash": password_hash, "role": "client"}
+            for i in range(1, n_users + 1)))
+        f.write(',\n')
+        write_section(f, 'livreurs', (
+            {"username": f"livreur{i}", "password_hash": password_hash, "role": "livreur",
+             "livreur": {"avg_rating": round(random.uniform(3, 5), 2)}}
+            for i in range(1, n_livreurs + 1)))
+        f.write(',\n')
+        write_section(f, 'restaurants', (
+            {"username": f"restaurant{i}", "password_hash": password_hash, "role": "restaurant",
+             "restaurant": {
+                 "nom": f"{random.choice(DISHES)} {i}",
+                 "longitude": round(2.25 + random.random() * 0.2, 6),
+                 "latitude": round(48.80 + random.random() * 0.1, 6),
+                 "menu": [{"nom_article": dish, "prix": round(random.uniform(3, 25), 2)}
+                          for dish in random.sample(DISHES, menu_items)]}}
+            for i in range(1, n_restaurants + 1)))
+        f.write('\n}\n')
+
+
+# === Ancienne implémentation (json.load puis une écriture par entité) ===
+def legacy_import(r, path):
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    for user in data.get('utilisateurs', []):
+        username = user.get('username')
+        if not r.hexists("users", username):
+            r.hset("users", username, f"{user['password_hash']}:{user['role']}")
+            print(f"Utilisateur créé: {username} (rôle: {user['role']})")
+    for livreur_data in data.get('livreurs', []):
+        username = livreur_data.get('username')
+        if not r.hexists("users", username):
+            r.hset("users", username, f"{livreur_data['password_hash']}:{livreur_data['role']}")
+            print(f"Utilisateur (livreur) créé: {username}")
+        if not r.exists(f"livreur_stats:{username}"):
+            avg_rating = livreur_data.get('livreur', {}).get('avg_rating', 4.5)
+            r.zadd("livreurs:scores", {username: avg_rating})
+            r.hset(f"livreur_stats:{username}", mapping={
+                "total_rating": avg_rating, "delivery_count": 1, "avg_rating": avg_rating})
+            print(f"Stats livreur initialisées pour {username} (Score: {avg_rating})")
+    for restaurant_data in data.get('restaurants', []):
+        username = restaurant_data.get('username')
+        if not r.hexists("users", username):
+            r.hset("users", username, f"{restaurant_data['password_hash']}:{restaurant_data['role']}")
+            print(f"Utilisateur (restaurant) créé: {username}")
+        info = restaurant_data.get('restaurant', {})
+        app_redis.save_restaurant_info(username, info.get("nom", username),
+                                       info.get("longitude", 0.0), info.get("latitude", 0.0))
+        if not r.exists(f"menu:{username}"):
+            menu_dict = {item['nom_article']: float(item['prix']) for item in info.get('menu', [])}
+            if menu_dict:
+                app_redis.save_menu(username, menu_dict)
+                print(f"Menu créé pour {username} ({info.get('nom', '')})")
+
+
+def snapshot(r):
+    """Empreinte du contenu importé, pour comparer deux imports"""
+    return (r.hlen("users"), r.zcard("livreurs:scores"), r.zcard(app_redis.RESTAURANTS_INDEX),
+            r.dbsize())
+
+
+def run(label, fn, measure_memory=False):
+    """Exécute un import; retourne (secondes, allers-retours, pic mémoire en Mo ou None)"""
+    if measure_memory:
+        tracemalloc.start()
+    app_redis.reset_redis_calls()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    peak = None
+    if measure_memory:
+        peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+    return elapsed, app_redis.redis_calls_count(), peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15')
+    parser.add_argument('--users', type=int, default=200000)
+    parser.add_argument('--livreurs', type=int, default=20000)
+    parser.add_argument('--restaurants', type=int, default=50000)
+    parser.add_argument('--menu-items', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=app_redis.IMPORT_BATCH_SIZE)
+    parser.add_argument('--with-legacy', action='store_true',
+                        help="compare avec l'ancien import (lent au-delà de quelques milliers)")
+    parser.add_argument('--generate-only', metavar='FICHIER',
+                        help="écrit seulement le jeu de données synthétique")
+    args = parser.parse_args()
+
+    if args.generate_only:
+        generate_dataset(args.generate_only, args.users, args.livreurs, args.restaurants,
+                         args.menu_items)
+        print(f"✅ {args.generate_only}: {os.path.getsize(args.generate_only) / 1024 / 1024:.1f} Mo")
+        return
+
+    pool = redis.ConnectionPool.from_url(args.redis_url, decode_responses=True,
+                                         connection_class=app_redis.CountingConnection)
+    r = redis.Redis(connection_pool=pool)
+    app_redis.r = r
+    entities = args.users + args.livreurs + args.restaurants
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'donnees.json')
+        generate_dataset(path, args.users, args.livreurs, args.restaurants, args.menu_items)
+        print(f"Jeu de données: {entities} entités, "
+              f"{os.path.getsize(path) / 1024 / 1024:.1f} Mo\n")
+        print(f"{'Import':<16}{'s':>8}{'entités/s':>12}{'A/R Redis':>12}{'pic Mo':>10}")
+
+        r.flushdb()
+        try:
+            elapsed, calls, _, (counts, _) = run(
+                'lots', lambda: app_redis.import_dataset(path, args.batch_size))
+            print(f"{'par lots':<16}{elapsed:>8.1f}{entities / elapsed:>12.0f}{calls:>12}{'':>10}")
+            expected = snapshot(r)
+
+            # Réimport: aucune écriture nouvelle attendue
+            elapsed, calls, peak, (again, _) = run(
+                'réimport', lambda: app_redis.import_dataset(path, args.batch_size),
+                measure_memory=True)
+            print(f"{'réimport':<16}{elapsed:>8.1f}{entities / elapsed:>12.0f}{calls:>12}"
+                  f"{peak:>10.1f}")
+            created = again['comptes'] + again['livreurs'] + again['restaurants'] + again['menus']
+
+            ok = snapshot(r) == expected and created == 0 and counts['lus'] == entities
+            if args.with_legacy:
+                r.flushdb()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    elapsed, calls, peak, _ = run('ancien', lambda: legacy_import(r, path),
+                                                  measure_memory=True)
+                print(f"{'ancien':<16}{elapsed:>8.1f}{entities / elapsed:>12.0f}{calls:>12}"
+                      f"{peak:>10.1f}")
+                ok = ok and snapshot(r) == expected
+        finally:
+            r.flushdb()
+
+    if not ok:
+        print("\n❌ Le réimport ou l'ancien import ne donne pas le même contenu")
+        sys.exit(1)
+    print("\n✅ Import idempotent, contenu identique")
+
+
+if __name__ == '__main__':
+    main()
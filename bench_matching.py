@@ -0,0 +1,134 @@
+"""Benchmark de l'attribution globale (match_orders) contre la boucle commande par commande.
+
+Simule un coup de feu: des commandes dont la fenêtre manager se ferme sur
+plusieurs ticks successifs, chacune avec les livreurs proches du restaurant
+comme candidats, les livreurs les mieux notés étant candidats partout. Les
+attributions de chaque tick sont écrites dans les index (orders:by_driver:<livreur>,
+orders:by_status:assigned) et aucune livraison ne se termine pendant le
+benchmark: un livreur attribué reste occupé aux ticks suivants. Une commande
+non attribuée est reportée au tick suivant. Compare la latence, le score
+combiné total, la distance moyenne, le nombre de commandes en cours en trop
+par livreur (tous ticks confondus), le nombre de reports et les commandes
+toujours en attente après le dernier tick.
+
+Usage:
+    python bench_matching.py --orders 1000 --livreurs 5000 --ticks 5 --redis-url redis://localhost:6379/15
+
+ATTENTION: la base Redis ciblée est vidée (FLUSHDB) avant et après le benchmark.
+"""
+import argparse
+import random
+import time
+from collections import Counter
+
+import numpy as np
+import redis
+
+import app_redis
+
+
+def seed_drivers(r, n_livreurs):
+    """Livreurs notés et positionnés dans Paris"""
+    livreurs = [f"livreur{i}" for i in range(1, n_livreurs + 1)]
+    lon = 2.25 + np.random.rand(n_livreurs) * 0.17
+    lat = 48.81 + np.random.rand(n_livreurs) * 0.09
+    pipe = r.pipeline(transaction=False)
+    for i, livreur in enumerate(livreurs):
+        pipe.zadd("livreurs:scores", {livreur: round(random.uniform(3, 5), 2)})
+        pipe.geoadd("livreurs:positions", (float(lon[i]), float(lat[i]), livreur))
+        if i % 1000 == 999:
+            pipe.execute()
+    pipe.execute()
+    return livreurs, lon, lat
+
+
+def make_orders(n_orders, livreurs, lon, lat, n_candidates, n_stars):
+    """Commandes avec leurs candidats: les plus proches plus quelques « stars »"""
+    stars = livreurs[:n_stars]
+    orders = []
+    for i in range(n_orders):
+        resto_lon = 2.25 + random.random() * 0.17
+        resto_lat = 48.81 + random.random() * 0.09
+        nearest = np.argsort((lon - resto_lon) ** 2 + (lat - resto_lat) ** 2)[:n_candidates]
+        candidates = [livreurs[j] for j in nearest] + random.sample(stars, 3)
+        random.shuffle(candidates)
+        orders.append((f"order{i}",
+                       {"restaurant_lon": str(resto_lon), "restaurant_lat": str(resto_lat)},
+                       candidates))
+    return orders
+
+
+def per_order_loop(orders):
+    """Ancienne stratégie: chaque commande prend son meilleur candidat"""
+    return {order_id: app_redis.rank_candidates(order_data, candidates)[0]
+            for order_id, order_data, candidates in orders}
+
+
+def run_ticks(r, strategy, orders, n_ticks):
+    """Répartit les commandes sur n_ticks ticks; retourne (attributions, reports, secondes)"""
+    for key in r.scan_iter("orders:by_driver:*"):
+        r.delete(key)
+    r.delete("orders:by_status:assigned")
+    per_tick = -(-len(orders) // n_ticks)
+    matches, pending, deferrals, elapsed = {}, [], 0, 0.0
+    for tick in range(n_ticks):
+        pending += orders[tick * per_tick:(tick + 1) * per_tick]
+        start = time.perf_counter()
+        matched = strategy(pending)
+        elapsed += time.perf_counter() - start
+        # Attributions de ce tick: le livreur a désormais une commande en cours
+        pipe = r.pipeline(transaction=False)
+        for order_id, match in matched.items():
+            pipe.zadd(f"orders:by_driver:{match['id']}", {order_id: tick})
+            pipe.zadd("orders:by_status:assigned", {order_id: tick})
+        pipe.execute()
+        matches.update(matched)
+        pending = [order for order in pending if order[0] not in matched]
+        deferrals += len(pending)
+    return matches, deferrals, elapsed
+
+
+def summarize(name, matches, deferrals, elapsed, n_orders):
+    drivers = Counter(match['id'] for match in matches.values())
+    double_booked = sum(count - 1 for count in drivers.values() if count > 1)
+    distances = [match['distance'] for match in matches.values() if match['distance'] is not None]
+    total = sum(match['combined_score'] for match in matches.values())
+    print(f"{name:<18}{elapsed * 1000:>10.0f}{total:>14.0f}{np.mean(distances):>14.2f}"
+          f"{double_booked:>12}{deferrals:>12}{n_orders - len(matches):>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15')
+    parser.add_argument('--orders', type=int, default=1000)
+    parser.add_argument('--livreurs', type=int, default=5000)
+    parser.add_argument('--candidates', type=int, default=10,
+                        help="livreurs proches candidats par commande")
+    parser.add_argument('--stars', type=int, default=20,
+                        help="livreurs très bien notés candidats partout")
+    parser.add_argument('--ticks', type=int, default=5,
+                        help="ticks du planificateur sur lesquels les commandes sont réparties")
+    args = parser.parse_args()
+
+    r = redis.Redis.from_url(args.redis_url, decode_responses=True)
+    app_redis.r = r
+    r.flushdb()
+    try:
+        print(f"Préparation de {args.livreurs} livreurs et {args.orders} commandes...")
+        livreurs, lon, lat = seed_drivers(r, args.livreurs)
+        # Les « stars » ont la meilleure note
+        r.zadd("livreurs:scores", {livreur: 5.0 for livreur in livreurs[:args.stars]})
+        orders = make_orders(args.orders, livreurs, lon, lat, args.candidates, args.stars)
+
+        print(f"\n{'Stratégie':<18}{'ms':>10}{'score total':>14}{'km moyen':>14}"
+              f"{'doublons':>12}{'reports':>12}{'en attente':>12}")
+        for name, strategy in (("commande/commande", per_order_loop),
+                               ("globale", app_redis.match_orders)):
+            matches, deferrals, elapsed = run_ticks(r, strategy, orders, args.ticks)
+            summarize(name, matches, deferrals, elapsed, len(orders))
+    finally:
+        r.flushdb()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Test de charge des positions GPS: 5 000 livreurs à 1 Hz.
+
+Rejoue --seconds secondes de pings (un par livreur et par seconde, la moitié
+des livreurs étant à l'arrêt avec un bruit GPS de quelques mètres) avec
+l'ancienne écriture directe (GEOADD + HSET + événement par ping) puis avec le
+tampon d'écriture différée, vidé toutes les POSITION_FLUSH_SECONDS de temps
+simulé. Compare les allers-retours Redis, les événements et octets poussés
+aux managers, et le débit de pings absorbé.
+
+Usage:
+    python bench_positions.py --livreurs 5000 --seconds 10 --redis-url redis://localhost:6379/15
+
+ATTENTION: la base Redis ciblée est vidée (FLUSHDB) avant et après le benchmark.
+"""
+import argparse
+import json
+import random
+import time
+from datetime import datetime
+
+import redis
+
+import app_redis
+
+
+# === Ancienne implémentation (écriture directe à chaque ping) ===
+def legacy_update_position(r, livreur_id, longitude, latitude):
+    r.geoadd("livreurs:positions", (longitude, latitude, livreur_id))
+    r.hset(f"livreur:{livreur_id}:position", mapping={
+        "longitude": longitude,
+        "latitude": latitude,
+        "updated_at": datetime.now().isoformat()
+    })
+    message = json.dumps({'type': 'position_updated',
+                          'data': {'driver_id': livreur_id, 'longitude': longitude,
+                                   'latitude': latitude},
+                          'timestamp': datetime.now().isoformat()})
+    r.publish(app_redis.MANAGERS_CHANNEL, message)
+    return len(message)
+
+
+def simulate_pings(n_livreurs, seconds):
+    """Pings (livreur, lon, lat) seconde par seconde"""
+    positions = {f"livreur{i}": [2.25 + random.random() * 0.2, 48.80 + random.random() * 0.1]
+                 for i in range(1, n_livreurs + 1)}
+    moving = set(random.sample(sorted(positions), n_livreurs // 2))
+    for _ in range(seconds):
+        tick = []
+        for livreur, position in positions.items():
+            # ~8 m/s pour les livreurs en course, bruit GPS de ~3 m sinon
+            step = 0.0001 if livreur in moving else 0.00003
+            position[0] += random.uniform(-step, step)
+            position[1] += random.uniform(-step, step)
+            tick.append((livreur, position[0], position[1]))
+        yield tick
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15')
+    parser.add_argument('--livreurs', type=int, default=5000)
+    parser.add_argument('--seconds', type=int, default=10)
+    args = parser.parse_args()
+
+    pool = redis.ConnectionPool.from_url(args.redis_url, decode_responses=True,
+                                         connection_class=app_redis.CountingConnection)
+    r = redis.Redis(connection_pool=pool)
+    app_redis.r = r
+    r.flushdb()
+
+    pings = list(simulate_pings(args.livreurs, args.seconds))
+    total_pings = args.livreurs * args.seconds
+    print(f"{total_pings} pings ({args.livreurs} livreurs x {args.seconds}s)\n")
+    print(f"{'Écriture':<12}{'A/R Redis':>12}{'événements':>12}{'Ko poussés':>12}{'pings/s':>12}")
+
+    try:
+        # Écriture directe
+        pushed = 0
+        app_redis.reset_redis_calls()
+        start = time.perf_counter()
+        for tick in pings:
+            for livreur, lon, lat in tick:
+                pushed += legacy_update_position(r, livreur, lon, lat)
+        elapsed = time.perf_counter() - start
+        print(f"{'directe':<12}{app_redis.redis_calls_count():>12}{total_pings:>12}"
+              f"{pushed / 1024:>12.0f}{total_pings / elapsed:>12.0f}")
+        r.flushdb()
+
+        # Tampon, vidé toutes les POSITION_FLUSH_SECONDS de temps simulé
+        # (intervalle du thread de fond assez long pour qu'il n'intervienne pas)
+        published = []
+        original_publish = app_redis.publish_event
+
+        def counting_publish(event_type, data, channels, pipe=None):
+            published.append(len(json.dumps({'type': event_type, 'data': data,
+                                              'timestamp': datetime.now().isoformat()})))
+            original_publish(event_type, data, channels, pipe)
+
+        app_redis.publish_event = counting_publish
+        buffer = app_redis.PositionBuffer(interval=3600)
+        per_flush = max(1, int(args.livreurs * app_redis.POSITION_FLUSH_SECONDS))
+        app_redis.reset_redis_calls()
+        start = time.perf_counter()
+        for tick in pings:
+            for i, (livreur, lon, lat) in enumerate(tick, 1):
+                buffer.add(livreur, lon, lat)
+                if i % per_flush == 0:
+                    buffer.flush()
+            buffer.flush()
+        elapsed = time.perf_counter() - start
+        app_redis.publish_event = original_publish
+        print(f"{'tampon':<12}{app_redis.redis_calls_count():>12}{len(published):>12}"
+              f"{sum(published) / 1024:>12.0f}{total_pings / elapsed:>12.0f}")
+    finally:
+        r.flushdb()
+
+
+if __name__ == '__main__':
+    main()
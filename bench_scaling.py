@@ -0,0 +1,136 @@
+"""Benchmark de montée en charge multi-processus: débit de la suite Locust de 1 à N workers.
+
+Pour chaque nombre de workers, démarre l'application sous gunicorn
+(gunicorn.conf.py, wsgi:app) et events_server.py pour les flux SSE, lance
+locustfile.py sans interface avec le même nombre d'utilisateurs, puis relève
+le débit (requêtes/s), le p50/p95 et le taux d'échec agrégés. La base est
+vidée puis réensemencée par Locust avant chaque palier, pour que chaque
+mesure parte du même état. Le tableau final donne l'accélération par rapport
+à un worker et l'efficacité (accélération / workers).
+
+Les utilisateurs Locust attendent entre deux tâches: prévoir assez
+d'utilisateurs (--users) pour saturer un worker, sinon le débit plafonne dès
+le premier palier. Le générateur de charge tourne sur la même machine: avec
+beaucoup de workers, répartir Locust sur plusieurs processus
+(--locust-processes) pour qu'il ne devienne pas le goulot d'étranglement.
+
+Usage:
+    python bench_scaling.py --workers 1 2 4 8 --users 400 --duration 60
+    python bench_scaling.py --workers 1 2 4 --worker-class gevent --locust-processes 4
+
+ATTENTION: la base Redis ciblée est vidée (FLUSHDB) avant chaque palier et après le benchmark.
+"""
+import argparse
+import csv
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import redis
+
+
+def wait_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def start_app(workers, args, env):
+    env = dict(env, WEB_CONCURRENCY=str(workers), GUNICORN_BIND=f"127.0.0.1:{args.port}",
+               GUNICORN_WORKER_CLASS=args.worker_class)
+    return subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+                             'wsgi:app'], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run_locust(args, csv_prefix):
+    """Lance la suite Locust; retourne la ligne agrégée du CSV des statistiques"""
+    command = [sys.executable, '-m', 'locust', '-f', 'locustfile.py', '--headless',
+               '--host', f"http://127.0.0.1:{args.port}",
+               '-u', str(args.users), '-r', str(args.spawn_rate), '-t', f"{args.duration}s",
+               '--csv', csv_prefix, '--only-summary', '--seed-redis-url', args.redis_url,
+               '--events-url', f"http://127.0.0.1:{args.events_port}/events"]
+    if args.locust_processes > 1:
+        command += ['--processes', str(args.locust_processes)]
+    # Code de sortie non nul si un SLO n'est pas respecté: le débit reste mesurable
+    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with open(f"{csv_prefix}_stats.csv", newline='') as f:
+        for row in csv.DictReader(f):
+            if row['Name'] == 'Aggregated':
+                return row
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count()])
+    parser.add_argument('--worker-class', choices=('gthread', 'gevent'), default='gthread')
+    parser.add_argument('--users', type=int, default=400)
+    parser.add_argument('--spawn-rate', type=int, default=50)
+    parser.add_argument('--duration', type=int, default=60, help="secondes par palier")
+    parser.add_argument('--locust-processes', type=int, default=1)
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--events-port', type=int, default=5101)
+    args = parser.parse_args()
+
+    r = redis.Redis.from_url(args.redis_url, decode_responses=True)
+    env = dict(os.environ, REDIS_URL=args.redis_url, SEED_ON_START='0')
+    events = subprocess.Popen([sys.executable, 'events_server.py', '--port', str(args.events_port)],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for workers in sorted(set(args.workers)):
+                r.flushdb()
+                app = start_app(workers, args, env)
+                try:
+                    if not wait_ready(f"http://127.0.0.1:{args.port}/login"):
+                        print(f"❌ gunicorn ({workers} workers) ne répond pas")
+                        sys.exit(1)
+                    print(f"⏱️ {workers} worker(s) {args.worker_class}, {args.users} utilisateurs, "
+                          f"{args.duration}s...")
+                    row = run_locust(args, os.path.join(tmp, f"w{workers}"))
+                    holder = r.get('lease:background')
+                finally:
+                    stop(app)
+                if row is None:
+                    print(f"❌ Pas de statistiques Locust pour {workers} worker(s)")
+                    sys.exit(1)
+                requests = int(row['Request Count'])
+                results.append((workers, float(row['Requests/s']), float(row['50%']),
+                                float(row['95%']),
+                                int(row['Failure Count']) / requests if requests else 0.0))
+                print(f"   bail des tâches de fond: {holder}")
+    finally:
+        stop(events)
+        r.flushdb()
+
+    base = results[0][1]
+    print(f"\n{'workers':<10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'échecs':>10}"
+          f"{'accél.':>10}{'effic.':>10}")
+    for workers, rps, p50, p95, fail_ratio in results:
+        speedup = rps / base if base else 0.0
+        print(f"{workers:<10}{rps:>10.0f}{p50:>10.0f}{p95:>10.0f}{fail_ratio:>10.1%}"
+              f"{speedup:>10.2f}{speedup * results[0][0] / workers:>10.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""Test de charge du serveur SSE asyncio: des milliers de connexions /events locales.
+
+Lance events_server.py dans un sous-processus (ou vise --url), ouvre
+--connections flux SSE authentifiés par des cookies de session Flask signés
+(clients, restaurants, livreurs, managers), publie --events événements ciblés
+sur les canaux Redis puis mesure le temps d'ouverture, la mémoire et les
+threads du serveur par connexion, les messages livrés et la latence de bout
+en bout.
+
+Usage:
+    python bench_sse.py --connections 10000 --events 500 --redis-url redis://localhost:6379/15
+
+Pour comparer avec le générateur Flask, viser l'application déjà lancée (même
+clé secrète, donc mêmes cookies):
+    python bench_sse.py --connections 500 --url http://127.0.0.1:5000/events
+
+ATTENTION: la base Redis ciblée est vidée (FLUSHDB) avant et après le benchmark.
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+
+import aiohttp
+import numpy as np
+import redis
+
+import app_redis
+import events_server
+
+ROLE_SHARES = (('client', 0.85), ('restaurant', 0.05), ('livreur', 0.09), ('manager', 0.01))
+
+
+def make_users(n_connections):
+    """(rôle, nom) pour chaque connexion, selon la répartition ROLE_SHARES"""
+    users = []
+    for role, share in ROLE_SHARES:
+        count = max(1, int(n_connections * share))
+        users.extend((role, f"{role}{i}") for i in range(1, count + 1))
+    return users[:n_connections]
+
+
+def session_cookie(role, username):
+    """Cookie signé identique à celui posé par /login"""
+    serializer = app_redis.app.session_interface.get_signing_serializer(app_redis.app)
+    return {app_redis.app.config['SESSION_COOKIE_NAME']:
+            serializer.dumps({'username': username, 'role': role})}
+
+
+def process_status(pid):
+    """(RSS en Ko, nombre de threads) d'un processus, via /proc (Linux)"""
+    values = {}
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                key, _, value = line.partition(':')
+                values[key] = value.split()[0] if value.split() else ''
+    except OSError:
+        return None, None
+    return int(values.get('VmRSS', 0)), int(values.get('Threads', 0))
+
+
+class SSEClient:
+    """Connexion SSE de test: compte les messages reçus et leur latence"""
+
+    def __init__(self, role, username):
+        self.role = role
+        self.username = username
+        self.connected = asyncio.Event()
+        self.latencies = []
+
+    async def run(self, http, url):
+        async with http.get(url, cookies=session_cookie(self.role, self.username)) as response:
+            if response.status != 200:
+                raise RuntimeError(f"{self.username}: HTTP {response.status}")
+            async for line in response.content:
+                if not line.startswith(b'data: '):
+                    continue
+                message = json.loads(line[6:])
+                if message.get('type') == 'connected':
+                    self.connected.set()
+                elif message.get('type') == 'bench':
+                    self.latencies.append(time.time() - message['data']['sent'])
+
+
+async def wait_for_server(url, timeout=10):
+    stats_url = url.rsplit('/', 1)[0] + '/events/stats'
+    deadline = time.time() + timeout
+    async with aiohttp.ClientSession() as http:
+        while time.time() < deadline:
+            try:
+                async with http.get(stats_url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Serveur SSE injoignable: {url}")
+
+
+async def run_bench(args, url, server_pid):
+    users = make_users(args.connections)
+    rss_before, _ = process_status(server_pid) if server_pid else (None, None)
+
+    clients = [SSEClient(role, name) for role, name in users]
+    connector = aiohttp.TCPConnector(limit=0, force_close=True)
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=None)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as http:
+        # Ouverture par vagues pour ne pas saturer la file d'acceptation
+        start = time.perf_counter()
+        tasks = []
+        for i in range(0, len(clients), args.ramp):
+            wave = clients[i:i + args.ramp]
+            tasks.extend(asyncio.create_task(client.run(http, url)) for client in wave)
+            await asyncio.wait_for(asyncio.gather(*(client.connected.wait() for client in wave)),
+                                   timeout=60)
+        open_seconds = time.perf_counter() - start
+        print(f"✅ {len(clients)} connexions ouvertes en {open_seconds:.1f}s")
+
+        if server_pid:
+            rss_after, threads = process_status(server_pid)
+            per_connection = (rss_after - rss_before) / len(clients)
+            print(f"   serveur: {rss_after / 1024:.0f} Mo RSS, {threads} threads, "
+                  f"~{per_connection:.1f} Ko par connexion")
+
+        # Événements ciblés: un destinataire (client, restaurant ou livreur) ou tous les managers
+        expected = 0
+        by_channel = {}
+        for client in clients:
+            for channel in app_redis.channels_for_session(client.role, client.username):
+                by_channel[channel] = by_channel.get(channel, 0) + 1
+        channels = sorted(by_channel)
+        start = time.perf_counter()
+        for i in range(args.events):
+            channel = random.choice(channels)
+            app_redis.publish_event('bench', {'sent': time.time(), 'n': i}, [channel])
+            expected += by_channel[channel]
+            if args.rate:
+                await asyncio.sleep(1 / args.rate)
+            elif i % 50 == 49:
+                await asyncio.sleep(0)
+        publish_seconds = time.perf_counter() - start
+
+        # Laisser les derniers messages arriver
+        deadline = time.time() + 10
+        while sum(len(c.latencies) for c in clients) < expected and time.time() < deadline:
+            await asyncio.sleep(0.1)
+
+        latencies = np.array([l for c in clients for l in c.latencies]) * 1000
+        delivered = len(latencies)
+        print(f"✅ {args.events} événements publiés en {publish_seconds:.1f}s, "
+              f"{delivered}/{expected} messages livrés")
+        if delivered:
+            print(f"   latence: p50 {np.percentile(latencies, 50):.1f} ms, "
+                  f"p99 {np.percentile(latencies, 99):.1f} ms, max {latencies.max():.1f} ms")
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return delivered == expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15')
+    parser.add_argument('--connections', type=int, default=10000)
+    parser.add_argument('--events', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=0,
+                        help="événements par seconde (0: au plus vite)")
+    parser.add_argument('--ramp', type=int, default=500,
+                        help="connexions ouvertes par vague")
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--url', help="flux SSE déjà lancé (sinon events_server.py est démarré)")
+    args = parser.parse_args()
+
+    events_server.raise_open_files_limit()
+    r = redis.Redis.from_url(args.redis_url, decode_responses=True)
+    app_redis.r = r
+    r.flushdb()
+    server = None
+    url = args.url
+    try:
+        if not url:
+            url = f"http://127.0.0.1:{args.port}/events"
+            server = subprocess.Popen([sys.executable, 'events_server.py', '--port', str(args.port),
+                                       '--redis-url', args.redis_url])
+            asyncio.run(wait_for_server(url))
+        ok = asyncio.run(run_bench(args, url, server.pid if server else None))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        r.flushdb()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+"""Serveur SSE asyncio pour /events, à lancer à côté de app_redis.py.
+
+Le générateur /events de Flask occupe un thread par connexion ouverte. Ce
+serveur tient les connexions SSE dans une seule boucle asyncio: un unique
+abonnement pub/sub Redis par processus, redistribué à des files bornées (une
+par connexion, avec le même message 'resync' que l'application Flask quand un
+client lent la laisse déborder). Une connexion qui revient avec Last-Event-ID
+rejoue les événements manqués depuis le journal events:log, comme /events.
+
+L'authentification réutilise le cookie de session signé de Flask (même clé
+secrète, même nom de cookie): aucune session supplémentaire n'est créée.
+
+Usage:
+    python events_server.py --port 5001 --redis-url redis://localhost:6379/0
+
+En production, router /events vers ce serveur derrière le même domaine que
+l'application. En développement, lancer Flask avec EVENTS_URL pointant vers ce
+serveur et autoriser son origine:
+    EVENTS_URL=http://localhost:5001/events python app_redis.py
+    python events_server.py --port 5001 --allow-origin http://localhost:5000
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import redis.asyncio as aioredis
+from aiohttp import web
+from itsdangerous import BadSignature
+
+from app_redis import (app, channels_for_session, SSE_QUEUE_SIZE, SSE_HEARTBEAT_SECONDS,
+                       RESYNC_MESSAGE, EVENT_LOG, EVENT_LOG_REPLAY_BATCH, parse_event_id,
+                       sse_frame, select_log_entries)
+
+CONNECTED_MESSAGE = "data: {}\n\n".format(json.dumps({'type': 'connected'})).encode()
+HEARTBEAT_MESSAGE = b": heartbeat\n\n"
+RESYNC_FRAME = sse_frame(RESYNC_MESSAGE).encode()
+REDIS_POOL_SIZE = 20   # connexions Redis partagées (pub/sub compris); les requêtes en plus attendent
+
+
+class AsyncEventBroadcaster:
+    """Équivalent asyncio de EventBroadcaster.
+
+    Un message reçu de Redis est encodé une seule fois et la même chaîne
+    d'octets est déposée dans la file de chaque connexion concernée: la
+    mémoire par connexion est bornée par SSE_QUEUE_SIZE références.
+    """
+
+    def __init__(self, redis_client, pattern):
+        self.redis = redis_client
+        self.pattern = pattern
+        self.by_channel = {}
+        self.subscribers = {}
+        self.dropped = 0
+
+    def subscribe(self, channels):
+        """Enregistre une connexion sur ses canaux et retourne sa file de messages"""
+        subscriber = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.subscribers[subscriber] = channels
+        for channel in channels:
+            self.by_channel.setdefault(channel, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        for channel in self.subscribers.pop(subscriber, ()):
+            listeners = self.by_channel.get(channel)
+            if listeners is not None:
+                listeners.discard(subscriber)
+                if not listeners:
+                    del self.by_channel[channel]
+
+    def connection_count(self):
+        return len(self.subscribers)
+
+    def dispatch(self, channel, data):
+        """Distribue un message aux connexions abonnées au canal"""
+        listeners = self.by_channel.get(channel)
+        if not listeners:
+            return
+        payload = sse_frame(data).encode()
+        for subscriber in listeners:
+            try:
+                subscriber.put_nowait(payload)
+            except asyncio.QueueFull:
+                self._coalesce(subscriber)
+
+    def _coalesce(self, subscriber):
+        self.dropped += 1
+        while not subscriber.empty():
+            subscriber.get_nowait()
+        subscriber.put_nowait(RESYNC_FRAME)
+
+    async def run(self):
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.psubscribe(self.pattern)
+                async for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        self.dispatch(message['channel'], message['data'])
+            except aioredis.RedisError as e:
+                print(f"Erreur abonnement événements: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+
+REDIS = web.AppKey('redis', aioredis.Redis)
+BROADCASTER = web.AppKey('broadcaster', AsyncEventBroadcaster)
+BROADCASTER_TASK = web.AppKey('broadcaster_task', asyncio.Task)
+ALLOWED_ORIGINS = web.AppKey('allowed_origins', set)
+
+
+def load_session(request):
+    """Décode le cookie de session Flask, ou None s'il est absent ou invalide"""
+    cookie = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return None
+    serializer = app.session_interface.get_signing_serializer(app)
+    try:
+        return serializer.loads(cookie, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return None
+
+
+async def replay_events(redis_client, channels, last_event_id):
+    """Version asyncio de app_redis.replay_events: (événements manqués, complet)"""
+    try:
+        parse_event_id(last_event_id)
+    except ValueError:
+        return [], False
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.xrange(EVENT_LOG, last_event_id, last_event_id)
+        pipe.xrange(EVENT_LOG, '(' + last_event_id, '+', count=EVENT_LOG_REPLAY_BATCH)
+        known, entries = await pipe.execute()
+    if not known:
+        return [], False
+    events = []
+    while True:
+        events.extend(select_log_entries(entries, channels))
+        if len(entries) < EVENT_LOG_REPLAY_BATCH:
+            return events, True
+        entries = await redis_client.xrange(EVENT_LOG, '(' + entries[-1][0], '+',
+                                            count=EVENT_LOG_REPLAY_BATCH)
+
+
+def frame_event_id(frame):
+    """Id de stream d'une trame SSE encodée, ou None"""
+    if not frame.startswith(b'id: '):
+        return None
+    return parse_event_id(frame[4:frame.index(b'\n')].decode())
+
+
+def cors_headers(request):
+    """En-têtes CORS pour les origines autorisées (EventSource withCredentials)"""
+    origin = request.headers.get('Origin')
+    if origin and origin in request.app[ALLOWED_ORIGINS]:
+        return {'Access-Control-Allow-Origin': origin,
+                'Access-Control-Allow-Credentials': 'true',
+                'Vary': 'Origin'}
+    return {}
+
+
+async def events(request):
+    """Endpoint Server-Sent Events pour les mises à jour en temps réel"""
+    session = load_session(request)
+    if not session or 'username' not in session:
+        return web.json_response({'status': 'error', 'message': 'Non autorisé'}, status=401,
+                                 headers=cors_headers(request))
+
+    # Seuls les canaux concernant l'utilisateur connecté sont écoutés
+    channels = channels_for_session(session['role'], session['username'])
+    if session['role'] == 'livreur':
+        await request.app[REDIS].zadd("livreurs:last_seen", {session['username']: time.time()})
+    # Reconnexion: dernier id reçu (en-tête du navigateur ou paramètre des templates)
+    last_event_id = request.headers.get('Last-Event-ID') or request.query.get('last_event_id')
+
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+        **cors_headers(request)
+    })
+    await response.prepare(request)
+
+    # Abonnement avant le rejeu: rien n'est perdu entre les deux
+    broadcaster = request.app[BROADCASTER]
+    subscriber = broadcaster.subscribe(channels)
+    try:
+        await response.write(CONNECTED_MESSAGE)
+
+        replayed_until = None
+        if last_event_id:
+            missed, complete = await replay_events(request.app[REDIS], channels, last_event_id)
+            if not complete:
+                await response.write(RESYNC_FRAME)
+            for event_id, message in missed:
+                await response.write("id: {}\ndata: {}\n\n".format(event_id, message).encode())
+            if missed:
+                replayed_until = parse_event_id(missed[-1][0])
+
+        while True:
+            try:
+                payload = await asyncio.wait_for(subscriber.get(), SSE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                # Commentaire SSE: détecte et libère les connexions fermées
+                payload = HEARTBEAT_MESSAGE
+            if replayed_until and payload.startswith(b'id: '):
+                # Déjà envoyé par le rejeu
+                if frame_event_id(payload) <= replayed_until:
+                    continue
+                replayed_until = None
+            await response.write(payload)
+    except ConnectionResetError:
+        pass
+    finally:
+        broadcaster.unsubscribe(subscriber)
+    return response
+
+
+async def stats(request):
+    """Connexions ouvertes et resynchronisations forcées"""
+    broadcaster = request.app[BROADCASTER]
+    return web.json_response({'connections': broadcaster.connection_count(),
+                              'dropped': broadcaster.dropped})
+
+
+async def start_broadcaster(application):
+    application[BROADCASTER_TASK] = asyncio.create_task(application[BROADCASTER].run())
+
+
+async def stop_broadcaster(application):
+    application[BROADCASTER_TASK].cancel()
+    await application[REDIS].aclose()
+
+
+def raise_open_files_limit():
+    """Monte la limite de descripteurs au maximum autorisé (une socket par connexion)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            return soft
+    return hard
+
+
+def create_app(redis_url, allowed_origins=()):
+    pool = aioredis.BlockingConnectionPool.from_url(redis_url, max_connections=REDIS_POOL_SIZE,
+                                                    decode_responses=True)
+    redis_client = aioredis.Redis(connection_pool=pool)
+    application = web.Application()
+    application[REDIS] = redis_client
+    application[BROADCASTER] = AsyncEventBroadcaster(redis_client, 'events:*')
+    application[ALLOWED_ORIGINS] = set(allowed_origins)
+    application.router.add_get('/events', events)
+    application.router.add_get('/events/stats', stats)
+    application.on_startup.append(start_broadcaster)
+    application.on_cleanup.append(stop_broadcaster)
+    return application
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--redis-url', default=os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+    parser.add_argument('--allow-origin', action='append', default=[],
+                        help="origine autorisée à ouvrir /events (répétable)")
+    args = parser.parse_args()
+
+    limit = raise_open_files_limit()
+    print(f"📡 Serveur SSE sur http://{args.host}:{args.port}/events "
+          f"(limite de descripteurs: {limit})")
+    web.run_app(create_app(args.redis_url, args.allow_origin), host=args.host, port=args.port,
+                backlog=4096, print=None)
+
+
+if __name__ == '__main__':
+    main()
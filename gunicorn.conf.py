@@ -0,0 +1,43 @@
+"""Configuration gunicorn: N workers pré-forkés, threads ou gevent.
+
+Usage:
+    gunicorn -c gunicorn.conf.py wsgi:app
+    WEB_CONCURRENCY=8 GUNICORN_WORKER_CLASS=gevent gunicorn -c gunicorn.conf.py wsgi:app
+
+Variables d'environnement:
+    WEB_CONCURRENCY         nombre de workers (défaut: nombre de coeurs)
+    GUNICORN_BIND           adresse d'écoute (défaut: 0.0.0.0:5000)
+    GUNICORN_WORKER_CLASS   gthread (défaut) ou gevent
+    GUNICORN_THREADS        threads par worker gthread (défaut: 8)
+    GUNICORN_CONNECTIONS    connexions simultanées par worker gevent (défaut: 1000)
+    REDIS_POOL_SIZE         connexions Redis par worker (défaut: threads + 4, ou 50 en gevent)
+    REDIS_URL, SECRET_KEY   partagés par tous les workers
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+worker_connections = int(os.environ.get('GUNICORN_CONNECTIONS', 1000))
+
+# Chaque requête tient au plus une connexion Redis; les threads de fond
+# (planificateur, tampon de positions, pub/sub) en gardent quelques-unes
+os.environ.setdefault('REDIS_POOL_SIZE', str(50 if worker_class == 'gevent' else threads + 4))
+
+# Importer l'application dans chaque worker, après le fork: pas de connexion
+# Redis ni de thread hérités du processus maître
+preload_app = False
+
+# Les flux /events restent ouverts: le timeout ne concerne que les workers bloqués
+timeout = 60
+graceful_timeout = 20
+keepalive = 5
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')
+
+
+def worker_exit(server, worker):
+    # Libérer le bail tout de suite pour qu'un autre worker reprenne les tâches de fond
+    from app_redis import stop_background_duties
+    stop_background_duties()
@@ -1,33 +1,406 @@
-from locust import HttpUser, task, between
+"""Suite de charge Locust: cycle de vie complet des commandes pour les quatre rôles.
 
-class RedisAppUser(HttpUser):
-    wait_time = between(1, 2)
+Chaque utilisateur simulé se connecte avec son propre compte et garde un flux
+/events ouvert. Les clients consultent les restaurants, commandent et notent,
+les restaurants marquent les commandes prêtes, les livreurs envoient leur
+position GPS chaque seconde, se montrent intéressés et livrent, et les
+managers choisissent un livreur pour une partie des commandes (les autres
+passent par les timers d'attribution automatique).
+
+À l'arrêt, la suite affiche p50/p95/p99 par endpoint, la latence de
+livraison des événements SSE et les percentiles de bout en bout des
+commandes (création -> prête -> intérêt -> attribuée -> livrée -> notée),
+les compare aux seuils SLO ci-dessous (et, si fourni, à un rapport
+précédent) et termine avec un code de sortie non nul en cas d'échec.
+
+Usage:
+    locust -f locustfile.py --host http://127.0.0.1:5000 --headless -u 170 -r 20 -t 5m \\
+        --seed-redis-url redis://localhost:6379/0 --slo-report slo.json
+
+    # Comparer une nouvelle version au rapport précédent
+    locust -f locustfile.py --host http://127.0.0.1:5000 --headless -u 170 -r 20 -t 5m \\
+        --slo-report slo_new.json --slo-baseline slo.json
+
+--seed-redis-url crée les comptes (mot de passe 123456), restaurants, menus
+et positions des livreurs dans la base de l'application, sans la vider.
+Les latences de bout en bout supposent que tous les rôles tournent dans le
+même processus Locust (exécution locale, pas de workers distribués).
+"""
+import itertools
+import json
+import random
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import gevent
+import numpy as np
+from locust import HttpUser, task, between, constant, events
+
+PASSWORD = '123456'
+CENTER = (2.333, 48.865)
+GPS_SPREAD = 0.03               # ~3 km autour du centre
+MENU = {"Pizza": 12.0, "Boisson": 3.0, "Salade": 9.5}
+PREPARATION_SECONDS = 5         # délai avant qu'un restaurant marque une commande prête
+DELIVERY_SECONDS = 10           # durée simulée d'une course
+MANAGER_PICK_RATIO = 0.5        # part des commandes attribuées à la main par les managers
+
+# Seuils SLO en ms (p95, p99) par endpoint, 'default' pour les autres
+SLO_MS = {
+    'default': (300, 1000),
+    '/get_dashboard_data': (250, 800),
+    '/update_position': (50, 200),
+    '/passer_commande': (200, 800),
+    '/events': (200, 1000),
+    '/manager/stats': (50, 200),
+}
+SSE_SLO_MS = (500, 2000)        # livraison des événements (publication -> réception)
+ORDER_SLO_SECONDS = {           # depuis la création de la commande (p95, p99)
+    'ready': (30, 60),
+    'assigned': (120, 180),
+    'delivered': (150, 210),
+}
+MAX_FAILURE_RATIO = 0.01
+BASELINE_TOLERANCE = 0.20       # régression maximale du p95 par rapport au rapport précédent
+
+STAGES = ('created', 'ready', 'interest', 'assigned', 'delivered', 'rated')
+ORDER_TIMELINE = defaultdict(dict)   # commande -> étape -> horodatage
+CONFLICTS = Counter()                # courses perdues attendues (commande déjà prise...)
+_user_numbers = defaultdict(itertools.count)
+
+
+def mark(order_id, stage):
+    """Horodate la première observation d'une étape du cycle de vie"""
+    ORDER_TIMELINE[order_id].setdefault(stage, time.time())
+
+
+@events.init_command_line_parser.add_listener
+def add_arguments(parser):
+    parser.add_argument('--seed-redis-url', default='',
+                        help="crée les comptes et données de test dans cette base Redis")
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--restaurants', type=int, default=50)
+    parser.add_argument('--livreurs', type=int, default=200)
+    parser.add_argument('--managers', type=int, default=5)
+    parser.add_argument('--events-url', default='/events',
+                        help="flux SSE (ex: http://127.0.0.1:5001/events pour events_server.py)")
+    parser.add_argument('--slo-report', default='', help="rapport JSON à écrire")
+    parser.add_argument('--slo-baseline', default='', help="rapport JSON précédent à comparer")
+
+
+@events.test_start.add_listener
+def seed(environment, **kwargs):
+    options = environment.parsed_options
+    if not options or not options.seed_redis_url:
+        return
+    import hashlib
+    import redis
+    import app_redis
+
+    app_redis.r = redis.Redis.from_url(options.seed_redis_url, decode_responses=True)
+    password_hash = hashlib.sha256(PASSWORD.encode()).hexdigest()
+    pipe = app_redis.r.pipeline(transaction=False)
+    for role, count in (('client', options.clients), ('restaurant', options.restaurants),
+                        ('livreur', options.livreurs), ('manager', options.managers)):
+        pipe.hset("users", mapping={f"{role}{i}": f"{password_hash}:{role}"
+                                    for i in range(1, count + 1)})
+    for i in range(1, options.livreurs + 1):
+        lon, lat = random_point()
+        pipe.geoadd("livreurs:positions", (lon, lat, f"livreur{i}"))
+        pipe.zadd("livreurs:scores", {f"livreur{i}": round(random.uniform(3.5, 5), 2)}, nx=True)
+    pipe.execute()
+    for i in range(1, options.restaurants + 1):
+        lon, lat = random_point()
+        app_redis.save_restaurant_info(f"restaurant{i}", f"Restaurant {i}", lon, lat)
+        app_redis.save_menu(f"restaurant{i}", MENU)
+    print(f"✅ Données de test créées dans {options.seed_redis_url}")
+
+
+def random_point():
+    return (CENTER[0] + random.uniform(-GPS_SPREAD, GPS_SPREAD),
+            CENTER[1] + random.uniform(-GPS_SPREAD, GPS_SPREAD))
+
+
+class RoleUser(HttpUser):
+    """Utilisateur connecté avec un compte de son rôle et un flux SSE ouvert"""
+    abstract = True
+    role = None
+    pool_option = None
 
     def on_start(self):
-        """Simulate login once per user session"""
+        options = self.environment.parsed_options
+        pool = getattr(options, self.pool_option, 1) if options else 1
+        self.username = f"{self.role}{next(_user_numbers[self.role]) % pool + 1}"
         response = self.client.post("/login", data={
-            "username": "client1",
-            "password": "123456",   # <- plain text, matches hash in JSON
-            "role": "client"
-        }, allow_redirects=False)
-        
-        if response.status_code != 302:  # Flask redirects after successful login
-            print("❌ Login failed:", response.status_code, response.text)
-        else:
-            print("✅ Logged in as client1")
+            "username": self.username, "password": PASSWORD, "role": self.role
+        }, allow_redirects=False, name="/login")
+        if response.status_code != 302:
+            print(f"❌ Connexion impossible pour {self.username}: {response.status_code}")
+        self.events_url = options.events_url if options else '/events'
+        self.listener = gevent.spawn(self.listen_events)
+
+    def on_stop(self):
+        self.listener.kill(block=False)
+
+    def listen_events(self):
+        """Garde /events ouvert et mesure le délai de livraison de chaque événement"""
+        while True:
+            try:
+                response = self.client.get(self.events_url, stream=True, name="/events",
+                                           timeout=(5, None))
+                for line in response.iter_lines():
+                    if not line.startswith(b'data: '):
+                        continue
+                    message = json.loads(line[6:])
+                    if 'timestamp' in message:
+                        sent = datetime.fromisoformat(message['timestamp']).timestamp()
+                        events.request.fire(request_type='SSE', name=message['type'],
+                                            response_time=(time.time() - sent) * 1000,
+                                            response_length=len(line), exception=None,
+                                            context={})
+            except Exception as e:
+                events.request.fire(request_type='SSE', name='connexion', response_time=0,
+                                    response_length=0, exception=e, context={})
+            gevent.sleep(1)
+
+    def post_action(self, url, name, payload=None, expected_conflict=False):
+        """POST d'une action; un refus attendu (course perdue) n'est pas un échec"""
+        with self.client.post(url, json=payload, name=name, catch_response=True) as response:
+            try:
+                body = response.json()
+            except ValueError:
+                response.failure(f"Réponse non JSON ({response.status_code})")
+                return None
+            if response.status_code == 200 and body.get('status') == 'success':
+                return body
+            if expected_conflict and response.status_code == 200:
+                CONFLICTS[name] += 1
+                response.success()
+                return None
+            response.failure(body.get('message', response.status_code))
+            return None
+
+    def dashboard(self):
+        response = self.client.get("/get_dashboard_data", name="/get_dashboard_data")
+        try:
+            return response.json()
+        except ValueError:
+            return {}
+
+
+class ClientUser(RoleUser):
+    role = 'client'
+    pool_option = 'clients'
+    weight = 10
+    wait_time = between(2, 5)
+
+    @task(3)
+    def browse(self):
+        page = self.client.get("/get_restaurants_paginated?page=1&per_page=20",
+                               name="/get_restaurants_paginated").json()
+        restaurants = page.get('restaurants') or []
+        if restaurants:
+            restaurant_id = random.choice(restaurants)['id']
+            self.client.get(f"/get_menu/{restaurant_id}", name="/get_menu/[id]")
+
+    @task(1)
+    def order(self):
+        options = self.environment.parsed_options
+        restaurant = f"restaurant{random.randint(1, options.restaurants if options else 1)}"
+        items = [{"item": item, "quantity": random.randint(1, 2), "price": price}
+                 for item, price in random.sample(sorted(MENU.items()), 2)]
+        body = self.post_action("/passer_commande", "/passer_commande",
+                                {"restaurant_id": restaurant, "items": items})
+        if body:
+            mark(body['order_id'], 'created')
 
     @task(2)
-    def get_restaurants(self):
-        self.client.get("/get_restaurants")
+    def track_and_rate(self):
+        for order in self.dashboard().get('orders', []):
+            order_id = order.get('id')
+            if order_id not in ORDER_TIMELINE:
+                continue
+            if order.get('status') == 'delivered' and 'client_rating' not in order:
+                mark(order_id, 'delivered')
+                if self.post_action(f"/noter_livreur/{order_id}", "/noter_livreur/[id]",
+                                    {"note": random.randint(3, 5)}, expected_conflict=True):
+                    mark(order_id, 'rated')
+
+
+class RestaurantUser(RoleUser):
+    role = 'restaurant'
+    pool_option = 'restaurants'
+    weight = 2
+    wait_time = between(1, 3)
+
+    @task
+    def prepare(self):
+        now = time.time()
+        for order in self.dashboard().get('orders', []):
+            order_id = order.get('id')
+            created = ORDER_TIMELINE.get(order_id, {}).get('created')
+            if order.get('status') != 'pending' or not created:
+                continue
+            if now - created >= PREPARATION_SECONDS:
+                if self.post_action(f"/marquer_prete/{order_id}", "/marquer_prete/[id]",
+                                    expected_conflict=True):
+                    mark(order_id, 'ready')
+
+
+class LivreurUser(RoleUser):
+    role = 'livreur'
+    pool_option = 'livreurs'
+    weight = 4
+    wait_time = constant(1)
+
+    def on_start(self):
+        super().on_start()
+        self.position = list(random_point())
+        self.assigned_since = {}
+
+    @task(5)
+    def send_position(self):
+        self.position[0] += random.uniform(-0.0001, 0.0001)
+        self.position[1] += random.uniform(-0.0001, 0.0001)
+        self.post_action("/update_position", "/update_position",
+                         {"longitude": self.position[0], "latitude": self.position[1]})
+
+    @task(2)
+    def work(self):
+        data = self.dashboard()
+        available = [order for order in data.get('available_orders', [])
+                     if order.get('id') in ORDER_TIMELINE]
+        if available:
+            order_id = random.choice(available)['id']
+            if self.post_action(f"/montrer_interet/{order_id}", "/montrer_interet/[id]",
+                                expected_conflict=True):
+                mark(order_id, 'interest')
+        now = time.time()
+        for order in data.get('assigned_orders', []):
+            order_id = order.get('id')
+            if order.get('status') != 'assigned' or order_id not in ORDER_TIMELINE:
+                continue
+            mark(order_id, 'assigned')
+            since = self.assigned_since.setdefault(order_id, now)
+            if now - since >= DELIVERY_SECONDS:
+                if self.post_action(f"/marquer_livree/{order_id}", "/marquer_livree/[id]"):
+                    mark(order_id, 'delivered')
+                    self.assigned_since.pop(order_id, None)
+
+
+class ManagerUser(RoleUser):
+    role = 'manager'
+    pool_option = 'managers'
+    weight = 1
+    wait_time = between(2, 4)
 
     @task(1)
-    def passer_commande(self):
-        payload = {
-            "restaurant_id": "restaurant1",
-            "items": [
-                {"item": "Pizza", "quantity": 1, "price": 12.0},
-                {"item": "Boisson", "quantity": 1, "price": 3.0}
-            ]
-        }
-        self.client.post("/passer_commande", json=payload)
+    def watch_stats(self):
+        self.client.get("/manager/stats")
+
+    @task(3)
+    def supervise(self):
+        ready = [order for order in self.dashboard().get('orders', [])
+                 if order.get('status') == 'ready' and order.get('id') in ORDER_TIMELINE]
+        if ready:
+            ids = ','.join(order['id'] for order in ready)
+            self.client.get(f"/get_timer_status?ids={ids}", name="/get_timer_status")
+        for order in ready:
+            order_id = order['id']
+            if not order.get('candidates_count') or random.random() > MANAGER_PICK_RATIO:
+                continue
+            candidates = self.client.get(f"/get_order_candidates/{order_id}",
+                                         name="/get_order_candidates/[id]").json()
+            ranked = candidates.get('candidates') or []
+            if ranked:
+                livreur = ranked[0]['id']
+                if self.post_action(f"/choisir_livreur/{order_id}/{livreur}",
+                                    "/choisir_livreur/[id]/[livreur]", expected_conflict=True):
+                    mark(order_id, 'assigned')
+
+
+# === Rapport SLO ===
+def percentiles(values):
+    return {f"p{q}": float(np.percentile(values, q)) for q in (50, 95, 99)}
+
+
+def endpoint_report(stats):
+    report = {}
+    for (name, method), entry in sorted(stats.entries.items()):
+        if not entry.num_requests:
+            continue
+        slo = SSE_SLO_MS if method == 'SSE' else SLO_MS.get(name, SLO_MS['default'])
+        row = {f"p{q}": entry.get_response_time_percentile(q / 100) for q in (50, 95, 99)}
+        row.update(requests=entry.num_requests, fail_ratio=round(entry.fail_ratio, 4),
+                   slo_p95=slo[0], slo_p99=slo[1])
+        row['ok'] = (row['p95'] <= slo[0] and row['p99'] <= slo[1] and
+                     entry.fail_ratio <= MAX_FAILURE_RATIO)
+        report[f"{method} {name}"] = row
+    return report
+
+
+def order_report():
+    report = {}
+    for stage in STAGES[1:]:
+        durations = [timeline[stage] - timeline['created']
+                     for timeline in ORDER_TIMELINE.values()
+                     if 'created' in timeline and stage in timeline]
+        if not durations:
+            continue
+        row = percentiles(durations)
+        row['orders'] = len(durations)
+        if stage in ORDER_SLO_SECONDS:
+            slo = ORDER_SLO_SECONDS[stage]
+            row.update(slo_p95=slo[0], slo_p99=slo[1], ok=row['p95'] <= slo[0] and row['p99'] <= slo[1])
+        report[stage] = row
+    return report
+
+
+def compare_to_baseline(report, baseline):
+    """Régressions du p95 au-delà de BASELINE_TOLERANCE par rapport au rapport précédent"""
+    regressions = []
+    for section in ('endpoints', 'orders'):
+        for key, row in report[section].items():
+            previous = baseline.get(section, {}).get(key)
+            if previous and previous['p95'] and row['p95'] > previous['p95'] * (1 + BASELINE_TOLERANCE):
+                regressions.append(f"{key}: p95 {previous['p95']:.0f} -> {row['p95']:.0f}")
+    return regressions
+
+
+@events.quitting.add_listener
+def report_slo(environment, **kwargs):
+    options = environment.parsed_options
+    report = {'endpoints': endpoint_report(environment.stats), 'orders': order_report(),
+              'conflicts': dict(CONFLICTS), 'created_orders': len(ORDER_TIMELINE)}
+
+    print(f"\n{'Endpoint':<45}{'req':>8}{'p50':>8}{'p95':>8}{'p99':>8}{'échecs':>8}  SLO")
+    for key, row in report['endpoints'].items():
+        print(f"{key[:44]:<45}{row['requests']:>8}{row['p50']:>8.0f}{row['p95']:>8.0f}"
+              f"{row['p99']:>8.0f}{row['fail_ratio']:>8.1%}  {'✅' if row['ok'] else '❌'}")
+    print(f"\n{'Commande (depuis création, s)':<45}{'n':>8}{'p50':>8}{'p95':>8}{'p99':>8}")
+    for stage, row in report['orders'].items():
+        status = {True: '✅', False: '❌'}.get(row.get('ok'), '')
+        print(f"{stage:<45}{row['orders']:>8}{row['p50']:>8.1f}{row['p95']:>8.1f}"
+              f"{row['p99']:>8.1f}  {status}")
+    if CONFLICTS:
+        print(f"\nCourses perdues (attendues): {dict(CONFLICTS)}")
+
+    failed = [key for key, row in report['endpoints'].items() if not row['ok']]
+    failed += [stage for stage, row in report['orders'].items() if row.get('ok') is False]
+    regressions = []
+    if options and options.slo_baseline:
+        with open(options.slo_baseline) as f:
+            regressions = compare_to_baseline(report, json.load(f))
+    report['passed'] = not failed and not regressions
+    report['regressions'] = regressions
+    if options and options.slo_report:
+        with open(options.slo_report, 'w') as f:
+            json.dump(report, f, indent=2)
 
+    for regression in regressions:
+        print(f"❌ Régression: {regression}")
+    if report['passed']:
+        print("\n✅ SLO respectés")
+    else:
+        print(f"\n❌ SLO non respectés: {', '.join(failed + [r.split(':')[0] for r in regressions])}")
+        environment.process_exit_code = 1
@@ -0,0 +1,85 @@
+"""Tests de la boucle de fond et de son bail Redis.
+
+Nécessitent un serveur Redis: base REDIS_URL (par défaut
+redis://localhost:6379/15); seules les clés lease:test et timers:* sont
+modifiées. Ignorés si Redis est injoignable.
+
+Usage:
+    python -m pytest tests
+"""
+import os
+import threading
+import time
+
+import pytest
+import redis
+
+os.environ.setdefault('REDIS_URL', 'redis://localhost:6379/15')
+os.environ.setdefault('SEED_ON_START', '0')
+
+import app_redis
+
+LEASE_KEY = 'lease:test'
+LEASE_SECONDS = 3  # renouvelé toutes les secondes
+
+
+@pytest.fixture
+def background(monkeypatch):
+    """Lance background_loop avec un bail court; retourne (thread, bail, stop)"""
+    try:
+        app_redis.r.ping()
+    except redis.RedisError:
+        pytest.skip("Redis injoignable")
+    app_redis.r.delete(LEASE_KEY, 'timers:due', 'timers:inflight')
+    monkeypatch.setattr(app_redis, 'TIMER_POLL_INTERVAL', 0.05)
+    stop = threading.Event()
+    lease = app_redis.RedisLease(LEASE_KEY, LEASE_SECONDS)
+    thread = threading.Thread(target=app_redis.background_loop, args=(stop, lease), daemon=True)
+    yield thread, lease, stop
+    stop.set()
+    thread.join(5)
+    app_redis.r.delete(LEASE_KEY, 'timers:due', 'timers:inflight')
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_failing_takeover_keeps_running_timers(background, monkeypatch):
+    thread, lease, stop = background
+    fired = []
+
+    def failing_takeover():
+        raise KeyError('password_hash')
+
+    monkeypatch.setattr(app_redis, 'on_lease_acquired', failing_takeover)
+    monkeypatch.setitem(app_redis.TIMER_HANDLERS, 'test_duty', fired.append)
+    app_redis.schedule_timer('test_duty', 'o1', 0)
+    thread.start()
+
+    assert wait_for(lambda: fired == ['o1'])
+    assert thread.is_alive()
+    assert app_redis.r.get(LEASE_KEY) == lease.token
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_lease_released_when_background_thread_dies(background, monkeypatch):
+    thread, lease, stop = background
+
+    def dying_duty(now=None):
+        # BaseException: échappe au filet de la boucle et tue le thread
+        raise SystemExit("tâche de fond interrompue")
+
+    monkeypatch.setattr(app_redis, 'run_due_timers', dying_duty)
+    thread.start()
+
+    thread.join(5)
+    assert not thread.is_alive()
+    # Libéré par le thread de renouvellement, bien avant son expiration
+    assert wait_for(lambda: app_redis.r.get(LEASE_KEY) is None, timeout=LEASE_SECONDS / 2)
+    assert not lease.held
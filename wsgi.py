@@ -0,0 +1,10 @@
+"""Point d'entrée WSGI de production (gunicorn -c gunicorn.conf.py wsgi:app).
+
+Chargé dans chaque worker après le fork (preload_app = False): chaque processus
+a son propre pool de connexions Redis, son tampon de positions et son
+abonnement pub/sub. Les tâches de fond démarrent dans tous les workers mais ne
+s'exécutent que dans celui qui détient le bail Redis (voir RedisLease).
+"""
+from app_redis import app, start_background_duties
+
+start_background_duties()